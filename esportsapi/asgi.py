@@ -0,0 +1,246 @@
+import asyncio
+import concurrent.futures
+import sys
+import threading
+import urllib.parse
+from . import db_functions as db
+from . import service as s
+from . import subscriptions
+
+http_method_not_allowed = 405
+http_content_too_large = 413
+http_service_unavailable = 503
+http_gateway_timeout = 504
+http_internal_server_error = 500
+
+# The largest body of a POST request.
+max_body_bytes = 2**20
+
+async def _body(receive):
+    """Returns the body of the request, or None if it is too large."""
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return b""
+        body += message.get("body", b"")
+        if len(body) > max_body_bytes:
+            return None
+        if not message.get("more_body"):
+            return body
+
+def _args(query_string):
+    # Like Flask's request.args.get, the first value of an argument wins.
+    args = {}
+    for k, v in urllib.parse.parse_qsl(query_string.decode("latin-1"),
+                                       keep_blank_values=True):
+        args.setdefault(k, v)
+    return args
+
+class _Job:
+    """A call that runs in a pool thread. It keeps a database connection
+    checked out while it runs, so that its queries can be interrupted after
+    a timeout."""
+    def __init__(self, f, *args):
+        self.f = f
+        self.args = args
+        self.conn = None
+        self.done = False
+        self.lock = threading.Lock()
+
+    def run(self):
+        with db.checked_out() as conn:
+            with self.lock:
+                self.conn = conn
+            try:
+                return self.f(*self.args)
+            finally:
+                with self.lock:
+                    self.done = True
+
+    def interrupt(self):
+        with self.lock:
+            if self.conn is not None and not self.done:
+                self.conn.interrupt()
+
+class AsgiApp:
+    """Serves a `Service` as an ASGI application. The blocking service calls
+    run in a pool of `threads` threads, so slow queries do not hold up the
+    event loop. At most `max_pending` requests are running or waiting for a
+    thread, and further requests get 503 until one finishes. Requests that
+    take longer than `timeout` seconds get 504, and their queries are
+    interrupted. Streamed responses keep their thread until they end, but
+    have no timeout."""
+    def __init__(self, service, threads=8, max_pending=64, timeout=30.0,
+                 stream_buffer=16):
+        self.service = service
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.stream_buffer = stream_buffer
+        self.pending = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            threads, thread_name_prefix="esportsapi")
+
+    def _submit(self, job):
+        # `pending` is only changed on the event loop, and only goes down when
+        # the thread is actually done, also after a timeout.
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        future = self.executor.submit(job.run)
+        future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(self._release))
+        return future
+
+    def _release(self):
+        self.pending -= 1
+
+    async def _call(self, f, *args):
+        job = _Job(f, *args)
+        future = self._submit(job)
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(future)), self.timeout)
+        except asyncio.TimeoutError:
+            future.cancel()
+            job.interrupt()
+            raise
+
+    async def _send_reply(self, send, reply, headers=()):
+        headers = [(name.lower().encode(), value.encode())
+                   for name, value in reply.headers] + list(headers)
+        await send({"type": "http.response.start", "status": reply.status,
+                    "headers": [(b"content-type", reply.content_type.encode())]
+                    + headers})
+        await send({"type": "http.response.body", "body": reply.body})
+
+    async def _send_stream(self, send, reply):
+        """Sends the parts of a streamed reply. The parts are produced in one
+        pool thread, because the transaction of the stream belongs to the
+        thread's connection, and the thread waits while the client is slow
+        to read."""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(self.stream_buffer)
+        stopped = threading.Event()
+        def put(part):
+            asyncio.run_coroutine_threadsafe(queue.put(part), loop).result()
+        def produce():
+            try:
+                for part in reply.body:
+                    if stopped.is_set():
+                        break
+                    put(part.encode())
+            finally:
+                reply.body.close()
+                put(None)
+        self._submit(_Job(produce))
+        await send({"type": "http.response.start", "status": reply.status,
+                    "headers": [(b"content-type",
+                                 reply.content_type.encode())]})
+        try:
+            while True:
+                part = await queue.get()
+                if part is None:
+                    break
+                await send({"type": "http.response.body", "body": part,
+                            "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        except BaseException:
+            # Let the producer finish, so that its thread is released.
+            stopped.set()
+            while await queue.get() is not None:
+                pass
+            raise
+
+    async def _send_events(self, receive, send, reply):
+        """Sends the events of a subscription until the client disconnects.
+        Subscriptions wait on the event loop and do not use a thread."""
+        loop = asyncio.get_running_loop()
+        stream = reply.body
+        arrived = asyncio.Event()
+        stream.subscriber.wake = lambda: loop.call_soon_threadsafe(arrived.set)
+        async def disconnected():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+        disconnect = asyncio.ensure_future(disconnected())
+        try:
+            await send({"type": "http.response.start", "status": reply.status,
+                        "headers": [(b"content-type",
+                                     reply.content_type.encode()),
+                                    (b"cache-control", b"no-cache")]})
+            events = [subscriptions.keepalive]
+            while not disconnect.done():
+                for event in events:
+                    await send({"type": "http.response.body", "body": event,
+                                "more_body": True})
+                waiting = asyncio.ensure_future(arrived.wait())
+                await asyncio.wait([waiting, disconnect],
+                                   timeout=stream.keepalive_interval,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                waiting.cancel()
+                arrived.clear()
+                events = stream.subscriber.take() or [subscriptions.keepalive]
+        finally:
+            disconnect.cancel()
+            stream.close()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+        if scope["method"] not in ["GET", "HEAD", "POST"]:
+            return await self._send_reply(send, s.json_reply(
+                {"error": "Method not allowed"}, http_method_not_allowed))
+        if self.pending >= self.max_pending:
+            return await self._send_reply(
+                send, s.json_reply({"error": "Too many requests pending"},
+                                   http_service_unavailable),
+                [(b"retry-after", b"1")])
+        if scope["method"] == "POST":
+            handle = self.service.handle_post
+            args = await _body(receive)
+            if args is None:
+                return await self._send_reply(send, s.json_reply(
+                    {"error": "The body is too large"},
+                    http_content_too_large))
+        else:
+            handle = self.service.handle
+            args = _args(scope.get("query_string", b""))
+        if self.service.metrics is not None:
+            handle = self.service.metrics.timed(handle)
+        try:
+            client = scope.get("client")
+            headers = {name.decode("latin-1"): value.decode("latin-1")
+                       for name, value in scope.get("headers", [])}
+            reply = await self._call(handle, scope["path"], args,
+                                     client and client[0], headers)
+        except asyncio.TimeoutError:
+            reply = s.json_reply({"error": "Timed out"}, http_gateway_timeout)
+        except Exception as e:
+            reply = s.json_reply({"error": str(e)},
+                                 http_internal_server_error)
+        if isinstance(reply.body, bytes):
+            await self._send_reply(send, reply)
+        elif isinstance(reply.body, subscriptions.EventStream):
+            await self._send_events(receive, send, reply)
+        else:
+            await self._send_stream(send, reply)
+
+def run(app, host="127.0.0.1", port=5000, fd=None):
+    """Serves `app` with uvicorn, on `host` and `port` or on the already
+    listening socket `fd`."""
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit("The asgi server needs uvicorn: pip3 install uvicorn")
+    uvicorn.run(app, host=host, port=port, fd=fd)
@@ -0,0 +1,510 @@
+import argparse
+import concurrent.futures
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import time
+import timeit
+import urllib.parse
+import urllib.request
+import graphene as g
+from . import bulk_load
+from . import db_functions as db
+from . import graphql
+from . import times
+
+def _match_rows(n_matches, players_per_team):
+    """Rows like the ones the default match query reads from match_read."""
+    names = db._match_default_fields
+    def player(id):
+        return [id, f"Player {id}", 700000000 + id, "South Korea",
+                "KT Rolster", 1, [1, 2], ["Game 1", "Game 2"]]
+    rows = []
+    for id in range(1, n_matches + 1):
+        teams = [[player((id + team * players_per_team + i) % 1000 + 1)
+                  for i in range(players_per_team)]
+                 for team in [1, 2]]
+        rows.append((id, 1587852000 + 3600 * id, "StarCraft II", 1,
+                     "ASL Season 9", 2, 1, json.dumps(teams)))
+    return names, rows
+
+def _player_rows(n_players, games_per_player):
+    names = db._player_default_fields
+    return names, [(id, f"Player {id}", 700000000 + id, "South Korea",
+                    "KT Rolster", f"Game {g}")
+                   for id in range(1, n_players + 1)
+                   for g in range(games_per_player)]
+
+def _best(f, number, repeat=5):
+    return min(timeit.repeat(f, number=number, repeat=repeat)) / number
+
+def hydration(n_matches=1000, players_per_team=5):
+    """Measures the time to turn the rows of the match and player queries
+    into records, per match and per player."""
+    match_names, match_rows = _match_rows(n_matches, players_per_team)
+    player_names, player_rows = _player_rows(1000, 2)
+    match_time = _best(lambda: db._read_matches(match_rows, match_names,
+                                                None), 10) / n_matches
+    player_time = _best(lambda: db._players_dict(player_rows, player_names),
+                        10) / 1000
+    print(f"match hydration: {match_time * 1e6:.1f} us per match "
+          f"({2 * players_per_team} players)")
+    print(f"player hydration: {player_time * 1e6:.1f} us per player "
+          "(2 rows)")
+    return {"match_us": match_time * 1e6, "player_us": player_time * 1e6}
+
+_games = ["StarCraft II", "DOTA 2", "Counter-Strike 2", "League of Legends",
+          "Valorant", "Rocket League", "QuakeLive", "StarCraft: Brood War"]
+_game_weights = [3, 4, 5, 5, 3, 2, 1, 2]
+_nations = ["South Korea", "China", "United States", "Sweden", "Denmark",
+            "France", "Germany", "Brazil", "Finland", "Poland", "Ukraine",
+            "Canada", "Russia", "Vietnam", "Japan", "Spain", "Peru"]
+_syllables = ["ba", "bi", "da", "flash", "fy", "jae", "dong", "ka", "ko", "li",
+              "ma", "na", "no", "ra", "rex", "sa", "sky", "sto", "to", "zy",
+              "ö", "ä", "é", "mü"]
+_team_words = [["Team", "Natus", "Evil", "Royal", "Cloud", "Golden", "Fnatic",
+                "Virtus", "Ninjas", "Invictus"],
+               ["Liquid", "Vincere", "Geniuses", "Never Give Up", "Nine",
+                "Guardians", "Pro", "Wolves", "Gaming", "Rolster"]]
+_series = ["ASL", "GSL", "ESL Pro League", "The International", "Worlds",
+           "Major", "Masters", "Champions", "Invitational", "Open"]
+
+def _unique_name(rng, used, make):
+    name = make()
+    while name in used:
+        name = f"{make()} {rng.randint(2, 99)}"
+    used.add(name)
+    return name
+
+def _player_name(rng):
+    return "".join(rng.choice(_syllables)
+                   for _ in range(rng.randint(1, 3))).capitalize()
+
+def _generated_players(rng, n_players, players_per_team, team_ids,
+                       team_games, game_ids):
+    """Players in teams of `players_per_team` that play their team's game
+    and sometimes another one. A tenth of them are stand-ins without a
+    team."""
+    first = times.to_int(datetime.date(1985, 1, 1))
+    days = (datetime.date(2005, 1, 1) - datetime.date(1985, 1, 1)).days
+    for i in range(n_players):
+        team = i // players_per_team
+        games = {team_games[team]}
+        if rng.random() < 0.2:
+            games.add(rng.choice(game_ids))
+        yield {"name": _player_name(rng),
+               "birthday": first + 86400 * rng.randrange(days),
+               "from_nation": rng.choice(_nations),
+               "team_id": None if rng.random() < 0.1 else team_ids[team],
+               "game_ids": sorted(games)}
+
+def _generated_matches(rng, n_matches, rosters, tournament_games,
+                       tournament_ids, game_ids):
+    """Matches between the rosters of two teams of the same game, over ten
+    years up to 2025, in tournaments of about 1000 consecutive matches or
+    in none. The matches of the last six months are not finished yet."""
+    start = times.to_int(datetime.date(2015, 1, 1))
+    now = times.to_int(datetime.date(2024, 7, 1))
+    step = (times.to_int(datetime.date(2025, 1, 1)) - start) / n_matches
+    for i in range(n_matches):
+        date = int(start + step * i + rng.random() * step)
+        tournament = i // 1000
+        if tournament < len(tournament_ids) and rng.random() < 0.8:
+            tournament_id = tournament_ids[tournament]
+            game_id = tournament_games[tournament]
+        else:
+            tournament_id = None
+            game_id = rng.choice(game_ids)
+        teams = rng.sample(rosters[game_id], 2)
+        finished = date < now
+        winner = rng.choice([1, 2]) if finished else 0
+        loser_score = rng.randint(0, 1) if finished else 0
+        yield {"date": date, "game_id": game_id, "finished": finished,
+               "tournament_id": tournament_id,
+               "team1_score": 2 if winner == 1 else loser_score,
+               "team2_score": 2 if winner == 2 else loser_score,
+               "teams": teams}
+
+def generate(n_players=10000, n_matches=1000000, players_per_team=5, seed=0,
+             batch_size=5000):
+    """Recreates the database and fills it with `n_players` players and
+    `n_matches` matches of random but realistic data, the same for the same
+    `seed`. Returns the number of seconds it took."""
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    db.recreate_db()
+    game_ids = [db.insert_game(name) for name in _games]
+    n_teams = -(-n_players // players_per_team)
+    used = set()
+    team_ids = [db.insert_team(_unique_name(
+        rng, used, lambda: " ".join(map(rng.choice, _team_words))))
+                for _ in range(n_teams)]
+    weights = dict(zip(game_ids, _game_weights))
+    team_games = rng.choices(game_ids, _game_weights, k=n_teams)
+    players = _generated_players(rng, n_players, players_per_team, team_ids,
+                                 team_games, game_ids)
+    player_ids = []
+    for batch in bulk_load._batches(players, batch_size):
+        player_ids += db.insert_players(batch)
+    rosters = {id: [] for id in game_ids}
+    for team, game_id in enumerate(team_games):
+        rosters[game_id].append(player_ids[team * players_per_team:
+                                           (team + 1) * players_per_team])
+    # Matches are only played in games with at least two teams.
+    game_ids = [id for id in game_ids if len(rosters[id]) >= 2]
+    if not game_ids:
+        raise ValueError("Too few players for two teams")
+    n_tournaments = -(-n_matches // 1000)
+    used = set()
+    tournament_ids = [db.insert_tournament(_unique_name(
+        rng, used, lambda: f"{rng.choice(_series)} {rng.randint(2015, 2024)}"))
+                      for _ in range(n_tournaments)]
+    tournament_games = rng.choices(
+        game_ids, [weights[id] for id in game_ids], k=n_tournaments)
+    matches = _generated_matches(rng, n_matches, rosters, tournament_games,
+                                 tournament_ids, game_ids)
+    for i, batch in enumerate(bulk_load._batches(matches, batch_size)):
+        db.insert_matches(batch)
+        if i % 20 == 19:
+            print(f"{(i + 1) * batch_size} matches", file=sys.stderr)
+    return time.perf_counter() - start
+
+def load(url, query, requests=2000, concurrency=16):
+    """Sends `requests` GET requests with `query` to a running server from
+    `concurrency` threads, and reports the throughput."""
+    url += "?" + urllib.parse.urlencode({"query": query})
+    def get(_):
+        start = time.perf_counter()
+        with urllib.request.urlopen(url) as response:
+            response.read()
+        return time.perf_counter() - start
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        latencies = sorted(executor.map(get, range(requests)))
+    seconds = time.perf_counter() - start
+    print(f"{requests} requests in {seconds:.2f} s, "
+          f"{requests / seconds:.0f} requests/s, median latency "
+          f"{latencies[len(latencies) // 2] * 1000:.1f} ms")
+    return requests / seconds
+
+# The suite writes matches on this date, after the generated ones, and
+# arguments are only taken from matches before it. So the same seed picks
+# the same arguments on every run.
+_written_date = "2030-01-01T00:00:00"
+
+# The example queries of the readme. The tournament is one of the generated
+# ones, `between` covers a week instead of every match, which is what
+# `/stream` is for, the lists of matches take a full page with `first`, since
+# there are more, and created matches are on `_written_date`.
+_example_queries = {
+    "matches by tournament name": """{
+        matches(tournamentName: "%(tournament)s", first: 100) {
+        date game finished tournament team1Score team2Score
+        teams {id name birthday fromNation team games}}}""",
+    "matches between": """{matches(between: ["%(start)s", "%(end)s"],
+                                   first: 100) {
+        date game finished tournament team1Score team2Score
+        teams {name fromNation team}}}""",
+    "search": """{search(text: "%(prefix)s", first: 10) {
+        ... on Player {playerId: id name team games}
+        ... on Team {id name} ... on Tournament {id name}}}"""}
+_example_mutations = {
+    "createMatch": """mutation {createMatch(data: {
+        date: "%(written)s", gameId: 3, finished: false,
+        team1Score: 0, team2Score: 0, teams: [[3, 4], [6, 7]]}) {
+        match {id game date finished tournament team1Score team2Score
+               teams {name fromNation team games}}}}""",
+    "updateMatch": """mutation {updateMatch(data: {
+        id: 4, finished: true, team1Score: 10, team2Score: 0}) {
+        match {game date finished tournament team1Score team2Score
+               teams {name fromNation team}}}}"""}
+
+# Cases that change many rows, or read a whole tournament, run at most this
+# many times.
+_heavy = {"rename_team", "rename_tournament", "iter_matches",
+          "get_matches_by_tournament_id", "get_matches_by_tournament_name",
+          "get_player_standings all time", "graphql matches by tournament name"}
+_heavy_repeat = 5
+
+def _cases(rng):
+    """The benchmark cases, as a dict from names to functions, with arguments
+    taken at random from the generated matches. Reads come before writes."""
+    conn = db.connection()
+    def one(query, *args):
+        return conn.execute(query, args).fetchone()[0]
+    def first_of(column, table, ids):
+        return one(f"""SELECT {column} FROM {table} WHERE {column} NOT NULL
+                       AND id IN (SELECT value FROM json_each(?))
+                       LIMIT 1;""", json.dumps(ids))
+    last = one("SELECT max(id) FROM matches WHERE date < ?;",
+               times.to_int(_written_date))
+    match_ids = [rng.randint(1, last) for _ in range(100)]
+    player_ids = [one("SELECT player_id FROM match_teams WHERE match_id == ?;",
+                      id) for id in match_ids]
+    player_names = [one("SELECT name FROM players WHERE id == ?;", id)
+                    for id in player_ids[:10]]
+    team_id = first_of("team_id", "players", player_ids[:50])
+    tournament_id = first_of("tournament_id", "matches", match_ids[:50])
+    # Renames change other rows than the reads, so that names stay valid.
+    renamed_team_id = first_of("team_id", "players", player_ids[50:])
+    renamed_tournament_id = first_of("tournament_id", "matches",
+                                     match_ids[50:])
+    game_id, day = conn.execute("SELECT game_id, date FROM matches "
+                                "WHERE id == ?;", [match_ids[0]]).fetchone()
+    game = one("SELECT name FROM games WHERE id == ?;", game_id)
+    team = one("SELECT name FROM teams WHERE id == ?;", team_id)
+    tournament = one("SELECT name FROM tournaments WHERE id == ?;",
+                     tournament_id)
+    week = (day, day + 7 * 86400)
+    # Autocomplete of a player's name.
+    prefix = player_names[0][:3]
+    teams = [[], []]
+    for number, id in conn.execute("SELECT team_number, player_id FROM "
+                                   "match_teams WHERE match_id == ?;",
+                                   [match_ids[0]]):
+        teams[number - 1].append(id)
+    match = {"date": _written_date, "game_id": game_id, "finished": False,
+             "teams": teams}
+    # Names of new rows must differ between runs on the same database.
+    unique = (f"{os.getpid()} {time.time_ns()} {n}" for n in itertools.count())
+    match_names, match_rows = _match_rows(100, 5)
+    player_row_names, player_rows = _player_rows(100, 2)
+    schema = g.Schema(query=graphql.Query, mutation=graphql.Mutation)
+    def execute(query):
+        def f():
+            result = schema.execute(query, context_value=graphql.Context())
+            if result.errors:
+                raise result.errors[0]
+        return f
+    cases = {
+        "get_game": lambda: db.get_game(game_id),
+        "get_games": lambda: db.get_games([game_id]),
+        "get_game_ids": lambda: db.get_game_ids([game]),
+        "get_team": lambda: db.get_team(team_id),
+        "get_teams": lambda: db.get_teams([team_id]),
+        "get_team_ids": lambda: db.get_team_ids([team]),
+        "get_tournament": lambda: db.get_tournament(tournament_id),
+        "get_tournaments": lambda: db.get_tournaments([tournament_id]),
+        "get_tournament_ids": lambda: db.get_tournament_ids([tournament]),
+        "get_data_versions": lambda: db.get_data_versions(),
+        "get_row_estimates": lambda: db.get_row_estimates(),
+        "get_matches": lambda: db.get_matches(match_ids),
+        "get_matches_between": lambda: db.get_matches_between(*week),
+        "get_matches_on_day": lambda: db.get_matches_on_day(day),
+        "get_matches_by_tournament_id": lambda:
+            db.get_matches_by_tournament_id(tournament_id),
+        "get_matches_by_tournament_name": lambda:
+            db.get_matches_by_tournament_name(tournament),
+        "get_matches_page": lambda: db.get_matches_page(
+            {"tournament_id": tournament_id}, 50),
+        "get_matches_page player": lambda: db.get_matches_page(
+            {"player_id": player_ids[0]}, 20, descending=True),
+        "get_matches_page head to head": lambda: db.get_matches_page(
+            {"head_to_head": (teams[0][0], teams[1][0])}, 20,
+            descending=True),
+        "get_player_match_pages": lambda: db.get_player_match_pages(
+            [(id, 2, None, None) for id in player_ids[:50]]),
+        "iter_matches": lambda: list(db.iter_matches(
+            {"tournament_id": tournament_id})),
+        "get_match_teams": lambda: db.get_match_teams(match_ids),
+        "get_players": lambda: db.get_players(player_ids),
+        "get_players_by_names": lambda:
+            db.get_players_by_names(player_names),
+        "get_players_page": lambda: db.get_players_page(
+            {}, 50, (player_ids[0],)),
+        "get_player_stats": lambda: db.get_player_stats(
+            [(id, 0) for id in player_ids]),
+        "get_team_stats": lambda: db.get_team_stats([(team_id, 0)]),
+        "get_player_standings": lambda:
+            db.get_player_standings(tournament_id),
+        "get_player_standings all time": lambda: db.get_player_standings(0),
+        "get_team_standings": lambda: db.get_team_standings(tournament_id),
+        "_read_matches 100": lambda: db._read_matches(match_rows, match_names,
+                                                      None),
+        "_players_dict 100": lambda: db._players_dict(player_rows,
+                                                     player_row_names),
+        "search": lambda: db.search(prefix),
+        "search short prefix": lambda: db.search(prefix[:1])}
+    values = {"tournament": tournament, "prefix": prefix,
+              "start": times.to_date_string(week[0]),
+              "end": times.to_date_string(week[1]), "written": _written_date}
+    for name, query in _example_queries.items():
+        cases["graphql " + name] = execute(query % values)
+    cases.update({
+        "insert_game": lambda: db.insert_game(f"Game {next(unique)}"),
+        "insert_team": lambda: db.insert_team(f"Team {next(unique)}"),
+        "insert_tournament": lambda:
+            db.insert_tournament(f"Tournament {next(unique)}"),
+        "insert_player": lambda: db.insert_player(
+            {"name": "Stork", "team_id": team_id, "game_ids": [game_id]}),
+        "insert_players": lambda: db.insert_players(
+            [{"name": "Stork", "team_id": team_id, "game_ids": [game_id]}]
+            * 100),
+        "insert_match": lambda: db.insert_match(match),
+        "insert_matches": lambda: db.insert_matches([match] * 100),
+        "update_match": lambda: db.update_match(
+            {"id": match_ids[1], "team1_score": rng.randint(0, 3)}),
+        "rename_team": lambda: db.rename_team(renamed_team_id,
+                                              f"Team {next(unique)}"),
+        "rename_tournament": lambda: db.rename_tournament(
+            renamed_tournament_id, f"Tournament {next(unique)}")})
+    for name, query in _example_mutations.items():
+        cases["graphql " + name] = execute(query % values)
+    return cases
+
+# Maintenance functions that read or write every match are not part of the
+# suite, and neither is rename_game, which rewrites the match_read rows of a
+# whole game.
+_not_benchmarked = {"rename_game", "rebuild_match_read", "check_match_read",
+                    "check_standings", "rebuild_search"}
+
+def _percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+def measure(f, repeat):
+    """Calls `f` once to warm up and then `repeat` times, and returns the
+    50th, 90th and 99th percentiles of its latency in milliseconds and the
+    number of statements that one call runs."""
+    f()
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    statements = []
+    with db.checked_out() as conn:
+        conn.set_trace_callback(statements.append)
+        try:
+            f()
+        finally:
+            conn.set_trace_callback(None)
+    result = {f"p{p}_ms": round(_percentile(latencies, p), 4)
+              for p in [50, 90, 99]}
+    result["queries"] = len([s for s in statements
+                             if not s.startswith(("BEGIN", "COMMIT",
+                                                  "SAVEPOINT", "RELEASE"))])
+    return result
+
+def _counts():
+    conn = db.connection()
+    return {table: conn.execute(f"SELECT count(*) FROM {table};").fetchone()[0]
+            for table in ["players", "matches", "match_teams"]}
+
+def suite(repeat=50, seed=0, only=None):
+    """Runs the benchmark cases whose names contain `only`, on the current
+    database, and returns the results and a description of the database.
+    The cases write to the database."""
+    cases = _cases(random.Random(seed))
+    results = {}
+    for name, f in cases.items():
+        if only is None or only in name:
+            results[name] = measure(f, min(repeat, _heavy_repeat)
+                                    if name in _heavy else repeat)
+            print(f"{name}: {results[name]}", file=sys.stderr)
+    return {"database": _counts(), "repeat": repeat, "seed": seed,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version, "cases": results}
+
+# Medians within this many milliseconds of the baseline are noise.
+_noise_ms = 0.02
+
+def regressions(results, baseline, threshold=0.3):
+    """Returns the names of the cases in `results` whose median latency is
+    more than `threshold` (0.3 is 30%) above the one in `baseline`, or that
+    run more queries, with a description of the difference."""
+    found = {}
+    for name, result in results["cases"].items():
+        before = baseline["cases"].get(name)
+        if before is None:
+            continue
+        reasons = []
+        if result["p50_ms"] > before["p50_ms"] * (1 + threshold) and \
+           result["p50_ms"] - before["p50_ms"] > _noise_ms:
+            reasons.append(f"median {before['p50_ms']:.3f} ms -> "
+                           f"{result['p50_ms']:.3f} ms")
+        if result["queries"] > before["queries"]:
+            reasons.append(f"queries {before['queries']} -> "
+                           f"{result['queries']}")
+        if reasons:
+            found[name] = ", ".join(reasons)
+    return found
+
+def _report(results):
+    width = max(map(len, results["cases"]))
+    print(f"{'case':{width}} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} "
+          "queries")
+    for name, result in results["cases"].items():
+        print(f"{name:{width}} {result['p50_ms']:9.3f} "
+              f"{result['p90_ms']:9.3f} {result['p99_ms']:9.3f} "
+              f"{result['queries']:7}")
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python3 -m esportsapi.benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    subparsers.add_parser("hydration")
+    subparser = subparsers.add_parser(
+        "generate", help="fill a new database with random data")
+    subparser.add_argument("--db", default="benchmark.db")
+    subparser.add_argument("--players", type=int, default=10000)
+    subparser.add_argument("--matches", type=int, default=1000000)
+    subparser.add_argument("--players-per-team", type=int, default=5)
+    subparser.add_argument("--seed", type=int, default=0)
+    subparser = subparsers.add_parser(
+        "suite", help="measure every database function and the example "
+        "queries on a generated database")
+    subparser.add_argument("--db", default="benchmark.db")
+    subparser.add_argument("--repeat", type=int, default=50)
+    subparser.add_argument("--seed", type=int, default=0)
+    subparser.add_argument("--only",
+                           help="only run the cases whose names contain this")
+    subparser.add_argument("--save", metavar="FILE",
+                           help="save the results as a JSON baseline")
+    subparser.add_argument("--baseline", metavar="FILE",
+                           help="compare with a saved baseline, and fail if "
+                           "any case regressed")
+    subparser.add_argument("--threshold", type=float, default=0.3,
+                           help="the allowed slowdown of the median, by "
+                           "default 0.3 (30%%)")
+    subparser = subparsers.add_parser(
+        "load", help="measure the throughput of a running server")
+    subparser.add_argument("--url", default="http://127.0.0.1:5000/")
+    subparser.add_argument("--query", default="{ matches(first: 100) { id "
+                           "date game tournament teams { name team } } }")
+    subparser.add_argument("--requests", type=int, default=2000)
+    subparser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args(argv)
+    if args.benchmark == "hydration":
+        hydration()
+    elif args.benchmark == "generate":
+        db.db_name = args.db
+        seconds = generate(args.players, args.matches, args.players_per_team,
+                           args.seed)
+        print(f"Generated {args.players} players and {args.matches} matches "
+              f"in {args.db} in {seconds:.0f} s")
+    elif args.benchmark == "suite":
+        if not os.path.exists(args.db):
+            sys.exit(f"{args.db} does not exist, run generate first")
+        db.db_name = args.db
+        results = suite(args.repeat, args.seed, args.only)
+        _report(results)
+        if args.save:
+            with open(args.save, "w") as f:
+                json.dump(results, f, indent=1)
+        if args.baseline:
+            with open(args.baseline) as f:
+                found = regressions(results, json.load(f), args.threshold)
+            for name, reason in found.items():
+                print(f"REGRESSION {name}: {reason}")
+            if found:
+                sys.exit(1)
+    else:
+        load(args.url, args.query, args.requests, args.concurrency)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
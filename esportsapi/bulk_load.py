@@ -0,0 +1,232 @@
+import argparse
+import csv
+import datetime
+import itertools
+import json
+import random
+import sys
+import time
+from . import db_functions as db
+from . import times
+
+class LoadError(Exception):
+    pass
+
+def read_records(filename):
+    """Yields the records of a JSONL file, or of a CSV file if the name ends
+    with .csv. In CSV files lists (games, team1 and team2) are separated by
+    semicolons."""
+    with open(filename, 'r', newline='') as f:
+        if filename.endswith(".csv"):
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def _split(value):
+    return [x.strip() for x in (value or "").split(";") if x.strip()]
+
+def _player_reference(x):
+    # Numbers are player ids and anything else player names.
+    return int(x) if isinstance(x, str) and x.isdigit() else x
+
+def _from_csv(record):
+    """Converts a CSV row to the same form as a JSONL record."""
+    record = {k: v for k, v in record.items() if v not in ("", None)}
+    for k in ["team1_score", "team2_score", "team_id", "game_id",
+              "tournament_id"]:
+        if k in record:
+            record[k] = int(record[k])
+    if "finished" in record:
+        record["finished"] = record["finished"].lower() in ["1", "true", "yes"]
+    if "games" in record:
+        record["games"] = _split(record["games"])
+    if "team1" in record or "team2" in record:
+        record["teams"] = [list(map(_player_reference,
+                                    _split(record.pop(k, None))))
+                           for k in ["team1", "team2"]]
+    return record
+
+class NameResolver:
+    """Resolves names of games, teams, tournaments and players to ids. Names
+    are looked up once per batch and kind, and remembered."""
+    _kinds = {"games": (db.get_game_ids, db.insert_game),
+              "teams": (db.get_team_ids, db.insert_team),
+              "tournaments": (db.get_tournament_ids, db.insert_tournament)}
+
+    def __init__(self, create_missing=False):
+        self.create_missing = create_missing
+        self._ids = {kind: {} for kind in list(self._kinds) + ["players"]}
+
+    def _player_ids(self, names):
+        players = db.get_players_by_names(names, {"name": {}})
+        ids = {}
+        for player in players.values():
+            if player["name"] in ids:
+                raise LoadError(f"Player name {player['name']} is ambiguous")
+            ids[player["name"]] = player["id"]
+        return ids
+
+    def prefetch(self, kind, names):
+        known = self._ids[kind]
+        names = list({n for n in names if n is not None and n not in known})
+        if not names:
+            return
+        if kind == "players":
+            known.update(self._player_ids(names))
+        else:
+            get_ids, insert = self._kinds[kind]
+            known.update(get_ids(names))
+            if self.create_missing:
+                for name in names:
+                    if name not in known:
+                        known[name] = insert(name)
+
+    def id(self, kind, name):
+        if name is None or isinstance(name, int):
+            return name
+        if name not in self._ids[kind]:
+            self.prefetch(kind, [name])
+        if name not in self._ids[kind]:
+            raise LoadError(f"Unknown name in {kind}: {name}")
+        return self._ids[kind][name]
+
+    def _field(self, record, kind, name_key, id_key):
+        return record[id_key] if id_key in record \
+            else self.id(kind, record.get(name_key))
+
+    def player(self, record):
+        data = {k: record.get(k) for k in ["name", "birthday", "from_nation"]}
+        data["team_id"] = self._field(record, "teams", "team", "team_id")
+        data["game_ids"] = record.get("game_ids") or \
+            [self.id("games", name) for name in record.get("games", [])]
+        return data
+
+    def match(self, record):
+        data = {k: record.get(k) for k in ["date", "finished", "team1_score",
+                                           "team2_score"]}
+        data["game_id"] = self._field(record, "games", "game", "game_id")
+        data["tournament_id"] = self._field(record, "tournaments",
+                                            "tournament", "tournament_id")
+        data["teams"] = [[self.id("players", p) for p in team]
+                         for team in record.get("teams", [])]
+        return data
+
+def _batches(iterable, n):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, n))
+        if not batch:
+            return
+        yield batch
+
+def load_players(records, resolver, batch_size=5000):
+    count = 0
+    for batch in _batches(records, batch_size):
+        resolver.prefetch("teams", [r.get("team") for r in batch])
+        resolver.prefetch("games", [g for r in batch
+                                    for g in r.get("games", [])])
+        count += len(db.insert_players(list(map(resolver.player, batch))))
+    return count
+
+def load_matches(records, resolver, batch_size=5000):
+    count = 0
+    for batch in _batches(records, batch_size):
+        resolver.prefetch("games", [r.get("game") for r in batch])
+        resolver.prefetch("tournaments", [r.get("tournament") for r in batch])
+        resolver.prefetch("players", [p for r in batch
+                                      for team in r.get("teams", [])
+                                      for p in team
+                                      if not isinstance(p, int)])
+        count += len(db.insert_matches(list(map(resolver.match, batch))))
+    return count
+
+def _random_matches(player_ids, game_ids, n, players_per_team):
+    start = times.to_int(datetime.date(2020, 1, 1))
+    for i in range(n):
+        players = random.sample(player_ids, 2 * players_per_team)
+        yield {"date": start + 3600 * i,
+               "game_id": random.choice(game_ids),
+               "finished": True,
+               "team1_score": random.randint(0, 3),
+               "team2_score": random.randint(0, 3),
+               "teams": [players[:players_per_team],
+                         players[players_per_team:]]}
+
+def benchmark(n_matches, n_single, players_per_team, batch_size):
+    """Compares inserting matches one by one with `insert_match` to
+    inserting them in batches with `insert_matches`, in a new database."""
+    random.seed(0)
+    db.recreate_db()
+    game_ids = [db.insert_game(f"Game {i}") for i in range(5)]
+    player_ids = db.insert_players([{"name": f"Player {i}"}
+                                    for i in range(1000)])
+    rows_per_match = 1 + 2 * players_per_team
+    def report(name, n, seconds):
+        print(f"{name}: {n} matches in {seconds:.2f} s, "
+              f"{n / seconds:.0f} matches/s, "
+              f"{n * rows_per_match / seconds:.0f} rows/s")
+    matches = list(_random_matches(player_ids, game_ids, n_single,
+                                   players_per_team))
+    start = time.perf_counter()
+    for match in matches:
+        db.insert_match(match)
+    report("insert_match", n_single, time.perf_counter() - start)
+    matches = list(_random_matches(player_ids, game_ids, n_matches,
+                                   players_per_team))
+    start = time.perf_counter()
+    for batch in _batches(matches, batch_size):
+        db.insert_matches(batch)
+    report("insert_matches", n_matches, time.perf_counter() - start)
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="python3 -m esportsapi.bulk_load",
+        description="Loads players or matches from JSONL or CSV files.")
+    parser.add_argument("--db", help="the database file, by default "
+                        f"{db.db_name}, or benchmark.db for benchmark")
+    parser.add_argument("--batch-size", type=int, default=5000,
+                        help="the number of records inserted per transaction")
+    parser.add_argument("--timezone",
+                        help="the timezone of dates without one, by default "
+                        "the local timezone")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for kind in ["players", "matches"]:
+        subparser = subparsers.add_parser(kind)
+        subparser.add_argument("file")
+        subparser.add_argument("--create-missing", action="store_true",
+                               help="create unknown games, teams and "
+                               "tournaments instead of failing")
+    subparser = subparsers.add_parser(
+        "benchmark", help="measure insert throughput in a new database")
+    subparser.add_argument("--matches", type=int, default=100000)
+    subparser.add_argument("--single", type=int, default=2000,
+                           help="the number of matches to insert one by one")
+    subparser.add_argument("--players-per-team", type=int, default=5)
+    args = parser.parse_args(argv)
+    times.set_timezone(args.timezone)
+    if args.command == "benchmark":
+        # The benchmark recreates the database, so never use the default one.
+        db.db_name = args.db or "benchmark.db"
+        benchmark(args.matches, args.single, args.players_per_team,
+                  args.batch_size)
+        return
+    db.db_name = args.db or db.db_name
+    db.create_or_migrate_db()
+    records = read_records(args.file)
+    if args.file.endswith(".csv"):
+        records = map(_from_csv, records)
+    load = load_players if args.command == "players" else load_matches
+    start = time.perf_counter()
+    try:
+        count = load(records, NameResolver(args.create_missing),
+                     args.batch_size)
+    except LoadError as e:
+        sys.exit(f"Error: {e}")
+    seconds = time.perf_counter() - start
+    print(f"Loaded {count} {args.command} in {seconds:.2f} s "
+          f"({count / max(seconds, 1e-9):.0f}/s)")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,56 @@
+import collections
+import threading
+
+class ResponseCache:
+    """An LRU cache of serialized responses that holds at most `max_bytes`
+    bytes of responses. Each entry remembers the versions of the database
+    tables it was computed from (see `db_functions.get_data_versions`) and is
+    only served while the tables still have those versions."""
+    def __init__(self, max_bytes=64 * 2**20):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        _, _, body = self._entries.pop(key)
+        self.bytes -= len(body)
+
+    def get(self, key, versions):
+        """Returns the cached response for `key` if it is still valid for the
+        current table `versions`, and otherwise None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                tables, snapshot, body = entry
+                if tuple(versions.get(t) for t in tables) == snapshot:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return body
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, versions, tables, body):
+        """Caches `body`, which was computed from `tables` when the tables had
+        the given `versions`."""
+        if len(body) > self.max_bytes:
+            return
+        tables = tuple(sorted(tables))
+        snapshot = tuple(versions.get(t) for t in tables)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (tables, snapshot, body)
+            self.bytes += len(body)
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "size": len(self._entries),
+                "bytes": self.bytes, "max_bytes": self.max_bytes}
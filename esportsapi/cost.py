@@ -0,0 +1,266 @@
+import collections
+import threading
+import time
+from graphql.execution.values import get_argument_values
+from graphql.language import ast
+from graphql.type import GraphQLList, GraphQLNonNull
+from . import db_functions as db
+from . import documents
+from . import graphql
+from . import times
+
+class QueryCostError(Exception):
+    pass
+
+def _unwrap(field_type):
+    """Returns the named type of a field type, and whether it is a list."""
+    is_list = False
+    while isinstance(field_type, (GraphQLList, GraphQLNonNull)):
+        is_list = is_list or isinstance(field_type, GraphQLList)
+        field_type = field_type.of_type
+    return field_type, is_list
+
+def _given(value):
+    # Arguments that are not given have the default value -1.
+    return value is not None and value != -1
+
+# Lists whose length is not estimated from the arguments or the database.
+_default_list_size = 10
+
+class QueryCosts:
+    """Estimates the cost of GraphQL documents before they are executed, as
+    the number of fields that resolving them would produce. Lists multiply
+    the cost of their fields by their estimated length: `ids` and `names`
+    by their length, `between` and `onDate` by the matches in the range,
+    tournaments by the average matches per tournament, and the players of
+    matches, and the games and matches of players, by their averages. Pages
+    of matches and players are at most their page size, except when
+    streamed, and search results are at most theirs.
+
+    The averages come from `db.get_row_estimates`, which is read again
+    after `max_age` seconds. Documents that cost more than `max_cost` or
+    nest deeper than `max_depth` are rejected.
+
+    The estimated costs and the time it took to execute the documents are
+    added up, so that the time per unit of cost can be seen in `stats`."""
+    def __init__(self, max_cost=1000000, max_depth=10, max_age=60):
+        self.max_cost = max_cost
+        self.max_depth = max_depth
+        self.max_age = max_age
+        self._estimates = None
+        self._read_at = None
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.units = 0
+        self.seconds = 0.0
+        self.rejected = 0
+
+    def estimates(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._estimates is None or now - self._read_at > self.max_age:
+                self._estimates = db.get_row_estimates()
+                self._read_at = now
+            return self._estimates
+
+    def _matches(self, args):
+        estimates = self.estimates()
+        matches = estimates["matches"]
+        if _given(args.get("ids")):
+            return len(args["ids"])
+        between = args.get("between")
+        if _given(between) and (len(between) != 2 or None in between):
+            # Malformed, so the query fails, but it is not estimated lower
+            # than any other.
+            return matches
+        if _given(between) or _given(args.get("on_date")):
+            first, last = estimates["first_date"], estimates["last_date"]
+            if first is None:
+                return 0
+            start, end = [times.to_int(d) for d in between] \
+                if _given(between) else times.day_bounds(args["on_date"])
+            overlap = min(end, last + 1) - max(start, first)
+            return max(0, round(matches * overlap / (last + 1 - first)))
+        if _given(args.get("tournament_name")) or \
+           (_given(args.get("tournament_id")) and args["tournament_id"] != 0):
+            return round(matches / max(estimates["tournaments"], 1))
+        return matches
+
+    def _players(self, args):
+        for name in ["ids", "names"]:
+            if _given(args.get(name)):
+                return len(args[name])
+        return self.estimates()["players"]
+
+    def _average(self, table, per):
+        estimates = self.estimates()
+        return estimates[table] / max(estimates[per], 1)
+
+    def _page(self, rows, args, paged):
+        first = args.get("first")
+        page = graphql.max_page_size if first is None or first < 0 \
+            else min(first, graphql.max_page_size)
+        return min(rows, page) if paged else rows
+
+    def _size(self, parent, name, args, inherited, paged):
+        """The estimated length of the list of field `name` of `parent`,
+        or the value inherited by the fields of connections and mutation
+        payloads."""
+        if parent == "Query":
+            if name in ["matches", "matchesConnection"]:
+                return self._page(self._matches(args), args, paged)
+            if name in ["players", "playersConnection"]:
+                return self._page(self._players(args), args, paged)
+            if name == "standings":
+                return self._matches(args)
+            if name == "search":
+                return self._page(graphql.max_page_size, args, True)
+            if name == "headToHead":
+                return self._page(self._average("match_teams", "players"),
+                                  args, True)
+        if parent == "Mutation":
+            data = args.get("data")
+            return len(data) if isinstance(data, list) else 1
+        if name == "edges" or parent in ["CreateMatches", "CreatePlayers"]:
+            return inherited
+        if (parent, name) == ("Match", "teams"):
+            return self._average("match_teams", "matches")
+        if (parent, name) == ("Player", "games"):
+            return self._average("player_games", "players")
+        if (parent, name) == ("Player", "matches"):
+            return self._page(self._average("match_teams", "players"), args,
+                              True)
+        if parent == "Standings":
+            # The players and teams of the matches of the tournament.
+            table = "players" if name == "players" else "teams"
+            return min(self.estimates()[table],
+                       inherited * self._average("match_teams", "matches"))
+        return _default_list_size
+
+    def _selection_cost(self, schema, selection_set, parent_type,
+                        multiplier, depth, inherited, fragments, variables,
+                        paged):
+        if depth > self.max_depth:
+            raise QueryCostError(f"The query is nested deeper than the "
+                                 f"limit of {self.max_depth} levels")
+        cost = 0
+        for selection in selection_set.selections:
+            if isinstance(selection, ast.FragmentSpread):
+                selection = fragments[selection.name.value]
+            if not isinstance(selection, ast.Field):
+                # The fragments on each type of a union are all counted,
+                # as if every item had each type.
+                condition = selection.type_condition
+                fragment_type = schema.get_type(condition.name.value) \
+                    if condition else parent_type
+                cost += self._selection_cost(
+                    schema, selection.selection_set, fragment_type, multiplier,
+                    depth, inherited, fragments, variables, paged)
+                continue
+            name = selection.name.value
+            # Unions have no fields but __typename.
+            field_def = getattr(parent_type, "fields", {}).get(name)
+            if field_def is None:
+                # Introspection
+                cost += multiplier
+                continue
+            field_type, is_list = _unwrap(field_def.type)
+            args = get_argument_values(field_def.args, selection.arguments,
+                                       variables)
+            size = self._size(parent_type.name, name, args, inherited, paged)
+            count = multiplier * size if is_list else multiplier
+            cost += count
+            if selection.selection_set is not None:
+                cost += self._selection_cost(
+                    schema, selection.selection_set, field_type, count,
+                    depth + 1, size, fragments, variables, paged)
+        return cost
+
+    def cost(self, schema, document, paged=True, variables=None,
+             operation_name=None):
+        """Returns the estimated cost of an operation of a validated
+        `Document`, with the values of its `variables`. Raises
+        QueryCostError if it nests too deep."""
+        operation = documents.get_operation(document.ast, operation_name)
+        root_type = {"query": schema.get_query_type(),
+                     "mutation": schema.get_mutation_type(),
+                     "subscription": schema.get_subscription_type()}[
+                         operation.operation]
+        fragments = {d.name.value: d for d in document.ast.definitions
+                     if isinstance(d, ast.FragmentDefinition)}
+        return round(self._selection_cost(schema, operation.selection_set,
+                                          root_type, 1, 1, 1, fragments,
+                                          variables or {}, paged))
+
+    def check(self, schema, document, paged=True, variables=None,
+              operation_name=None):
+        """Returns the estimated cost of an operation, or raises
+        QueryCostError if it is over the limits."""
+        try:
+            cost = self.cost(schema, document, paged, variables,
+                             operation_name)
+            if self.max_cost and cost > self.max_cost:
+                raise QueryCostError(
+                    f"The estimated cost of the query is {cost}, which is "
+                    f"over the limit of {self.max_cost}. Select fewer "
+                    "fields, or fewer matches or players with `first`, "
+                    "`ids` or a shorter `between`.")
+        except QueryCostError:
+            with self._lock:
+                self.rejected += 1
+            raise
+        return cost
+
+    def record(self, cost, seconds):
+        """Adds the estimated cost and the actual execution time of a
+        document, to calibrate the estimates."""
+        with self._lock:
+            self.requests += 1
+            self.units += cost
+            self.seconds += seconds
+
+    def stats(self):
+        with self._lock:
+            return {"max_cost": self.max_cost, "requests": self.requests,
+                    "units": self.units, "seconds": round(self.seconds, 6),
+                    "us_per_unit": round(self.seconds * 1e6 / self.units, 3)
+                    if self.units else None,
+                    "rejected": self.rejected}
+
+class ClientBudgets:
+    """Per-client budgets of query cost, as token buckets that hold at most
+    `burst` units and refill at `rate` units per second. A query may run
+    while its client's bucket is not empty, and its cost may take the
+    bucket below zero, so expensive queries make their client wait longer
+    afterwards. Only the `max_clients` most recently seen clients are
+    remembered."""
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.limited = 0
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def spend(self, client, cost):
+        """Takes `cost` from the budget of `client`. Returns 0 if the query
+        may run, and otherwise the seconds until it may."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, then = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - then) * self.rate)
+            if tokens <= 0:
+                self.limited += 1
+                wait = max(-tokens, 1) / self.rate
+            else:
+                tokens -= cost
+                wait = 0
+            self._buckets[client] = (tokens, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def stats(self):
+        with self._lock:
+            return {"rate": self.rate, "burst": self.burst,
+                    "clients": len(self._buckets), "limited": self.limited}
@@ -1,87 +1,419 @@
-import datetime
-import dateutil.parser as dup
+import contextlib
+import functools
+import json
 import os
+import pathlib
 import sqlite3
-import time
+import threading
+from . import times
 from . import utils as u
 
 db_name = "database.db"
 
+_pragmas = ["PRAGMA foreign_keys = ON;",
+            "PRAGMA journal_mode = WAL;",
+            "PRAGMA synchronous = NORMAL;",
+            "PRAGMA temp_store = MEMORY;",
+            "PRAGMA cache_size = -16000;",
+            "PRAGMA busy_timeout = 5000;"]
+_statement_cache_size = 256
+
+# Replaced by `metrics.Metrics.install` with connections that time their
+# statements.
+connection_factory = sqlite3.Connection
+
+# Processes that only serve reads open the database read-only. The
+# journal mode is then left as it is, since changing it is a write.
+read_only = False
+
+# Set by `replica.Replica.install` to the file of a copy of the database in
+# memory, which connections then read instead, memory mapped.
+replica_path = None
+_replica_mmap_size = 2**40
+
+# Connections are shared by the threads through a pool. A thread checks
+# one out when it first needs one, and all its `_db_query` functions share
+# it until its outermost `transaction` or `checked_out` scope ends, when it
+# goes back to the pool. At most `pool_size` idle connections are kept
+# open, so servers that start a thread per request still reuse them.
+# `_generation` is bumped whenever the database file is replaced, so that
+# connections to the old file get reopened on their next use.
+_local = threading.local()
+_generation = 0
+pool_size = 16
+_pool = []
+_pool_lock = threading.Lock()
+
+def _connect():
+    if replica_path is not None:
+        uri = pathlib.Path(replica_path).as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, isolation_level=None,
+                               cached_statements=_statement_cache_size,
+                               factory=connection_factory,
+                               check_same_thread=False)
+        pragmas = [p for p in _pragmas if "journal_mode" not in p] + \
+            [f"PRAGMA mmap_size = {_replica_mmap_size};"]
+    elif read_only:
+        uri = pathlib.Path(db_name).absolute().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, isolation_level=None,
+                               cached_statements=_statement_cache_size,
+                               factory=connection_factory,
+                               check_same_thread=False)
+        pragmas = [p for p in _pragmas if "journal_mode" not in p]
+    else:
+        conn = sqlite3.connect(db_name, isolation_level=None,
+                               cached_statements=_statement_cache_size,
+                               factory=connection_factory,
+                               check_same_thread=False)
+        pragmas = _pragmas
+    for pragma in pragmas:
+        conn.execute(pragma)
+    return conn
+
+def _check_out(key):
+    with _pool_lock:
+        while _pool:
+            pooled_key, conn = _pool.pop()
+            if pooled_key == key:
+                return conn
+            conn.close()
+    return _connect()
+
+def _check_in():
+    """Returns the connection of the current thread to the pool, or closes
+    it if the pool is full or the connection is to an old file."""
+    conn, key = getattr(_local, "conn", None), getattr(_local, "key", None)
+    _local.conn = None
+    _local.key = None
+    if conn is None:
+        return
+    with _pool_lock:
+        if key == (db_name, _generation) and len(_pool) < pool_size:
+            _pool.append((key, conn))
+            return
+    conn.close()
+
+def connection():
+    """Returns the connection of the current thread, checking one out of the
+    pool if needed."""
+    key = (db_name, _generation)
+    if getattr(_local, "key", None) != key:
+        conn = getattr(_local, "conn", None)
+        if conn is not None:
+            conn.close()
+        _local.conn = _check_out(key)
+        _local.key = key
+        _local.depth = 0
+        _local.changes = []
+    return _local.conn
+
+@contextlib.contextmanager
+def checked_out():
+    """Keeps the connection of the current thread for the body, and yields
+    it. It goes back to the pool when the outermost scope ends."""
+    conn = connection()
+    holds = getattr(_local, "holds", 0)
+    _local.holds = holds + 1
+    try:
+        yield conn
+    finally:
+        _local.holds = holds
+        if holds == 0:
+            _check_in()
+
+def close_connection():
+    """Closes the connection of the current thread and the idle connections
+    of the pool, which must not be shared with forked processes."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+    _local.conn = None
+    _local.key = None
+    _local.depth = 0
+    _local.changes = []
+    with _pool_lock:
+        pooled = _pool[:]
+        del _pool[:]
+    for _, conn in pooled:
+        conn.close()
+
+def _reset_connections():
+    global _generation
+    close_connection()
+    _generation += 1
+
+# Functions that are called as f(table, ids) with the ids of the records
+# that a transaction inserted or updated, after it has committed.
+_listeners = []
+
+def add_listener(f):
+    _listeners.append(f)
+
+def remove_listener(f):
+    _listeners.remove(f)
+
+def _record_changes(table, ids):
+    if _listeners:
+        _local.changes.extend((table, id) for id in ids)
+
+def _notify(changes):
+    by_table = {}
+    for table, id in changes:
+        by_table.setdefault(table, []).append(id)
+    for table, ids in by_table.items():
+        for f in list(_listeners):
+            f(table, ids)
+
+@contextlib.contextmanager
+def transaction():
+    """Runs the body in a transaction on the current thread's connection and
+    yields the connection. Nested scopes become savepoints, so a failure in
+    an inner scope only undoes the inner scope's writes."""
+    with checked_out() as conn:
+        depth = _local.depth
+        savepoint = f"s{depth}"
+        changes = len(_local.changes)
+        conn.execute("BEGIN;" if depth == 0 else f"SAVEPOINT {savepoint};")
+        _local.depth = depth + 1
+        try:
+            yield conn
+            conn.execute("COMMIT;" if depth == 0 else
+                         f"RELEASE {savepoint};")
+        except BaseException:
+            del _local.changes[changes:]
+            if conn.in_transaction:
+                if depth == 0:
+                    conn.execute("ROLLBACK;")
+                else:
+                    conn.execute(f"ROLLBACK TO {savepoint};")
+                    conn.execute(f"RELEASE {savepoint};")
+            raise
+        finally:
+            _local.depth = depth
+        if depth == 0 and _local.changes:
+            committed, _local.changes = _local.changes, []
+            _notify(committed)
+
 def load_sql(filename):
     with open(filename, 'r') as s:
         script = s.read()
-    conn = sqlite3.connect(db_name)
-    conn.executescript(script)
-    conn.commit()
+    with contextlib.closing(sqlite3.connect(db_name)) as conn:
+        conn.executescript(script)
+        conn.commit()
+
+# sql/tables.sql is the first version of the schema, and each script in
+# sql/migrations upgrades it to the next version. The number in the name of
+# a script is the version that it upgrades to, which is kept in the
+# database's user_version. A migration can also have a function that runs
+# after its script, in the same transaction.
+_migrations_dir = "sql/migrations"
+_migration_steps = {3: lambda: rebuild_match_read()}
+
+def _statements(script):
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement
+            statement = ""
+
+def _migrations():
+    names = sorted(name for name in os.listdir(_migrations_dir)
+                   if name.endswith(".sql"))
+    for version, name in enumerate(names, 1):
+        if int(name.split("_")[0]) != version:
+            raise RuntimeError(f"Migration {name} should be number {version}")
+    return names
+
+def schema_version():
+    return connection().execute("PRAGMA user_version;").fetchone()[0]
+
+def migrate():
+    """Upgrades the database in place to the latest schema, each migration
+    in its own transaction, and returns the number of migrations applied."""
+    names = _migrations()
+    current = schema_version()
+    if current > len(names):
+        raise RuntimeError(f"The database has schema version {current}, "
+                           f"newer than the {len(names)} migrations known")
+    for version, name in enumerate(names[current:], current + 1):
+        with open(os.path.join(_migrations_dir, name), "r") as f:
+            script = f.read()
+        with transaction() as conn:
+            for statement in _statements(script):
+                conn.execute(statement)
+            if version in _migration_steps:
+                _local.migration = version
+                try:
+                    _migration_steps[version]()
+                finally:
+                    _local.migration = None
+            conn.execute(f"PRAGMA user_version = {version};")
+    return len(names) - current
 
 def recreate_db():
-    if os.path.exists(db_name):
-        os.remove(db_name)
+    _reset_connections()
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists(db_name + suffix):
+            os.remove(db_name + suffix)
     load_sql("sql/tables.sql")
+    migrate()
 
 def load_example_data():
     load_sql("sql/some_data.sql")
+    rebuild_match_read()
+    rebuild_search()
 
-def create_db_if_nonexistent():
-    if not os.path.exists(db_name):
+def create_or_migrate_db():
+    """Creates the database if it does not exist, and otherwise upgrades it
+    in place."""
+    if os.path.exists(db_name):
+        migrate()
+    else:
         recreate_db()
 
+# When set, `_db_query` functions are called through
+# `query_observer(function, call)`, which returns `call()` (see `metrics`).
+query_observer = None
+
 def _db_query(f):
-    def inner(*args, **kwargs):
-        try:
-            conn = sqlite3.connect(db_name)
-            # conn.set_trace_callback(print)
-            conn.execute("PRAGMA foreign_keys = ON;")
+    def call(args, kwargs):
+        with transaction() as conn:
             cursor = conn.cursor()
             result = f(conn, cursor, *args, **kwargs)
-            conn.commit()
-            return result if result is not None else cursor.lastrowid
-        except:
-            conn.rollback()
-            raise
-        finally:
-            conn.close()
+        return result if result is not None else cursor.lastrowid
+    @functools.wraps(f)
+    def inner(*args, **kwargs):
+        if query_observer is not None:
+            return query_observer(inner, lambda: call(args, kwargs))
+        return call(args, kwargs)
     return inner
 
+# Stay below SQLITE_MAX_VARIABLE_NUMBER of older sqlite versions.
+_max_variables = 999
+
 def _get_values(data, columns):
     return [data[k] for k in columns if k in data]
 
 def _get_all_values(data, columns):
     return [data.get(k, None) for k in columns]
 
-def _int_time_to_string(seconds):
-    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(seconds))
+_int_time_to_string = times.to_string
+_string_time_to_int = times.to_int
+_to_int_time = times.to_int
+_to_string_time = times.to_string
+_to_string_date = times.to_date_string
 
-def _string_time_to_int(time_string):
-    t = time_string if isinstance(time_string,
-                                  (datetime.datetime, datetime.date)) \
-        else dup.parse(time_string)
-    return int(time.mktime(t.timetuple()))
+# The tables that are read when fetching each kind of record, including
+# the tables of the records that they refer to. The standings change with
+# the matches.
+tables_read = {
+    "matches": ["matches", "match_teams", "games", "tournaments",
+                "players", "player_games", "teams"],
+    "matches_connection": ["matches", "match_teams", "games", "tournaments",
+                           "players", "player_games", "teams"],
+    "players": ["players", "player_games", "teams", "games"],
+    "players_connection": ["players", "player_games", "teams", "games"],
+    "stats": ["matches", "match_teams", "players"],
+    "head_to_head": ["matches", "match_teams", "games", "tournaments",
+                     "players", "player_games", "teams"],
+    "search": ["players", "player_games", "teams", "games", "tournaments"],
+    "standings": ["matches", "match_teams", "players", "teams",
+                  "player_games", "games"]}
 
-def _to_int_time(date):
-    if date is not None:
-        return int(date) if isinstance(date, (int, float)) \
-            else _string_time_to_int(date)
+# Writes keep this many of the latest change_log entries. Replicas that
+# fall further behind copy the whole database again.
+change_log_size = 1000000
 
-def _to_string_time(date):
-    if date is not None:
-        return date if isinstance(date, str) else _int_time_to_string(date)
+# The schema version that adds change_log. The steps of earlier migrations
+# run before it exists.
+_change_log_version = 4
+
+def _log_changes(cursor, table, key_column=None, keys=(None,)):
+    """Must be called by every write, in the same transaction, with the keys
+    of the rows that it inserts, updates or deletes in `table`, or with no
+    key_column if it rewrites the whole table."""
+    migration = getattr(_local, "migration", None)
+    if migration is not None and migration < _change_log_version:
+        return
+    cursor.executemany("INSERT INTO change_log VALUES (null, ?, ?, ?);",
+                       [(table, key_column, key) for key in keys])
+
+def _bump_versions(cursor, tables):
+    """Must be called by every write, in the same transaction, with the
+    tables that it changes."""
+    qs = ", ".join("?"*len(tables))
+    cursor.execute(f"""UPDATE data_versions SET version = version + 1
+                       WHERE name IN ({qs});""", tables)
+    _log_changes(cursor, "data_versions", "name", tables)
+    cursor.execute("""DELETE FROM change_log
+                      WHERE id <= (SELECT max(id) FROM change_log) - ?;""",
+                   [change_log_size])
+
+@_db_query
+def get_data_versions(conn, cursor):
+    cursor.execute("SELECT name, version FROM data_versions;")
+    return dict(cursor.fetchall())
 
-def _to_string_date(date):
-    if date is not None:
-        return _to_string_time(date).split()[0]
+_estimated_tables = ["matches", "match_teams", "players", "player_games",
+                     "teams", "tournaments"]
+
+@_db_query
+def get_row_estimates(conn, cursor):
+    """Returns the number of rows of some tables, and the dates of the
+    first and last match. The counts are the largest ids, which only takes
+    an index lookup, and is exact unless rows have been deleted."""
+    counts = ", ".join(f"(SELECT max(id) FROM {table})"
+                       for table in _estimated_tables)
+    cursor.execute(f"""SELECT {counts}, (SELECT min(date) FROM match_read),
+                              (SELECT max(date) FROM match_read);""")
+    row = cursor.fetchone()
+    estimates = {table: count or 0
+                 for table, count in zip(_estimated_tables, row)}
+    estimates["first_date"], estimates["last_date"] = row[-2:]
+    return estimates
+
+# The full-text indexes of names (see sql/migrations/005_search.sql), by
+# the tables whose names they index.
+_search_indexes = {"players": "player_search", "teams": "team_search",
+                   "tournaments": "tournament_search"}
+
+def _index_names(cursor, table, ids, remove=False):
+    """Adds the names of the rows `ids` of `table` to its search index, or
+    removes them, which must be done before the names change."""
+    index = _search_indexes[table]
+    columns, values = (f"{index}, rowid", "'delete', id") if remove \
+        else ("rowid", "id")
+    cursor.execute(f"""INSERT INTO {index}({columns}, name)
+                       SELECT {values}, name FROM {table}
+                       WHERE id IN (SELECT value FROM json_each(?));""",
+                   [_json_list(ids)])
 
 @_db_query
 def insert_game(conn, cursor, name):
     cursor.execute("INSERT INTO games VALUES (null, ?)", (name,))
+    id = cursor.lastrowid
+    _log_changes(cursor, "games", "id", [id])
+    _bump_versions(cursor, ["games"])
+    return id
 
 @_db_query
 def insert_team(conn, cursor, name):
     cursor.execute("INSERT INTO teams VALUES (null, ?)", (name,))
+    id = cursor.lastrowid
+    _index_names(cursor, "teams", [id])
+    _log_changes(cursor, "teams", "id", [id])
+    _bump_versions(cursor, ["teams"])
+    return id
 
 @_db_query
 def insert_tournament(conn, cursor, name):
     cursor.execute("INSERT INTO tournaments VALUES (null, ?)", (name,))
+    id = cursor.lastrowid
+    _index_names(cursor, "tournaments", [id])
+    _log_changes(cursor, "tournaments", "id", [id])
+    _bump_versions(cursor, ["tournaments"])
+    return id
 
 def _simple_getter(table):
     @_db_query
@@ -91,22 +423,81 @@ def _simple_getter(table):
         return u.zipmap(fields.split(", "), cursor.fetchone())
     return getter
 
+def _select_in(cursor, query, args):
+    """Runs `query`, whose `IN ({})` is filled with placeholders, once per
+    chunk of `args` and returns all rows."""
+    rows = []
+    for chunk in u.partition_all(_max_variables, args):
+        cursor.execute(query.format(", ".join("?"*len(chunk))), chunk)
+        rows.extend(cursor.fetchall())
+    return rows
+
+def _simple_batch_getter(table):
+    @_db_query
+    def getter(conn, cursor, ids):
+        rows = _select_in(cursor,
+                          f"SELECT id, name FROM {table} WHERE id IN ({{}});",
+                          ids)
+        return {id: {"id": id, "name": name} for id, name in rows}
+    return getter
+
+def _ids_by_names_getter(table):
+    @_db_query
+    def getter(conn, cursor, names):
+        return dict(_select_in(
+            cursor, f"SELECT name, id FROM {table} WHERE name IN ({{}});",
+            names))
+    return getter
+
 get_game = _simple_getter("games")
 get_tournament = _simple_getter("tournaments")
 get_team = _simple_getter("teams")
+get_games = _simple_batch_getter("games")
+get_tournaments = _simple_batch_getter("tournaments")
+get_teams = _simple_batch_getter("teams")
+get_game_ids = _ids_by_names_getter("games")
+get_tournament_ids = _ids_by_names_getter("tournaments")
+get_team_ids = _ids_by_names_getter("teams")
+
+def _insert_all(cursor, table, rows):
+    """Inserts `rows`, which have values for every column but the id, with
+    executemany and returns their ids. The first row is inserted on its own,
+    which takes the write lock, so the ids of the other rows are the ones
+    following its id."""
+    if not rows:
+        return []
+    qs = ", ".join("?"*(len(rows[0]) + 1))
+    query = f"INSERT INTO {table} VALUES ({qs});"
+    cursor.execute(query, [None] + list(rows[0]))
+    ids = list(range(cursor.lastrowid, cursor.lastrowid + len(rows)))
+    cursor.executemany(query, ([id] + list(row)
+                               for id, row in zip(ids[1:], rows[1:])))
+    return ids
+
+def _player_values(data):
+    return [data.get("name"), _to_int_time(data.get("birthday")),
+            data.get("from_nation"), data.get("team_id")]
+
+def _insert_players(cursor, players):
+    ids = _insert_all(cursor, "players", list(map(_player_values, players)))
+    player_games = [(pid, gid) for pid, data in zip(ids, players)
+                    for gid in data.get("game_ids") or []]
+    cursor.executemany("INSERT INTO player_games VALUES (null, ?, ?);",
+                       player_games)
+    _index_names(cursor, "players", ids)
+    _log_changes(cursor, "players", "id", ids)
+    _log_changes(cursor, "player_games", "player_id", ids)
+    _bump_versions(cursor, ["players", "player_games"])
+    return ids
 
 @_db_query
 def insert_player(conn, cursor, data):
-    data = u.update(data, "birthday", _to_int_time)
-    data = u.update(data, "game_ids", lambda x: x or [])
-    values = _get_all_values(data, ["name", "birthday", "from_nation",
-                                    "team_id"])
-    cursor.execute("INSERT INTO players VALUES (null, ?, ?, ?, ?);", values)
-    pid = cursor.lastrowid
-    for gid in data["game_ids"]:
-        cursor.execute("INSERT INTO player_games VALUES (null, ?, ?);",
-                       (pid, gid))
-    return pid
+    return _insert_players(cursor, [data])[0]
+
+@_db_query
+def insert_players(conn, cursor, players):
+    """Inserts all `players` in one transaction and returns their ids."""
+    return _insert_players(cursor, players)
 
 def _prepare_teams_data(teams, match_id):
     if teams:
@@ -118,25 +509,46 @@ def _prepare_teams_data(teams, match_id):
                 result.append((team_number, match_id, player_id))
         return result
 
+def _insert_match_teams(cursor, teams_by_match_id):
+    tuples = [t for match_id, teams in teams_by_match_id
+              for t in _prepare_teams_data(teams, match_id) or []]
+    cursor.executemany("INSERT INTO match_teams VALUES (null, ?, ?, ?);",
+                       tuples)
+
 _match_columns = ["date", "game_id", "finished", "tournament_id",
                   "team1_score", "team2_score"]
 
+def _match_values(data):
+    """Returns the values of `_match_columns`, with defaults for the missing
+    ones."""
+    get = data.get
+    finished = get("finished")
+    team1_score = get("team1_score")
+    team2_score = get("team2_score")
+    return [_to_int_time(get("date")), get("game_id"),
+            False if finished is None else finished, get("tournament_id"),
+            0 if team1_score is None else team1_score,
+            0 if team2_score is None else team2_score]
+
+def _insert_matches(cursor, matches):
+    ids = _insert_all(cursor, "matches", list(map(_match_values, matches)))
+    _insert_match_teams(cursor, [(id, data.get("teams"))
+                                 for id, data in zip(ids, matches)])
+    _log_changes(cursor, "matches", "id", ids)
+    _log_changes(cursor, "match_teams", "match_id", ids)
+    _refresh_match_read(cursor, ids)
+    _bump_versions(cursor, ["matches", "match_teams"])
+    _record_changes("matches", ids)
+    return ids
+
 @_db_query
 def insert_match(conn, cursor, data):
-    def none_to_0(x):
-        return 0 if x is None else x
-    data = u.update(data, "team1_score", none_to_0)
-    data = u.update(data, "team2_score", none_to_0)
-    data = u.update(data, "date", _to_int_time)
-    data = u.update(data, "finished", lambda x: False if x is None else x)
-    values = _get_all_values(data, _match_columns)
-    cursor.execute("INSERT INTO matches VALUES (null, ?, ?, ?, ?, ?, ?);",
-                   values)
-    match_id = cursor.lastrowid
-    tuples = _prepare_teams_data(data["teams"], match_id)
-    for t in tuples:
-        cursor.execute("INSERT INTO match_teams VALUES (null, ?, ?, ?);", t)
-    return match_id
+    return _insert_matches(cursor, [data])[0]
+
+@_db_query
+def insert_matches(conn, cursor, matches):
+    """Inserts all `matches` in one transaction and returns their ids."""
+    return _insert_matches(cursor, matches)
 
 def _update_query_string(data, columns):
     qs = [k + " = ?" for k in columns if k in data]
@@ -145,124 +557,650 @@ def _update_query_string(data, columns):
 @_db_query
 def update_match(conn, cursor, data):
     id = data["id"]
+    if "date" in data:
+        data = u.assoc(data, "date", _to_int_time(data["date"]))
     values = _get_values(data, _match_columns)
     qstring = _update_query_string(data, _match_columns)
     query = f"UPDATE matches SET {qstring} WHERE id = ?;"
     cursor.execute(query, values + [id])
+    _log_changes(cursor, "matches", "id", [id])
+    changed = ["matches"]
     if "teams" in data:
         cursor.execute("DELETE FROM match_teams WHERE match_id = ?", [id])
-        tuples = _prepare_teams_data(data["teams"], id)
-        for t in tuples:
-            cursor.execute("INSERT INTO match_teams VALUES (null, ?, ?, ?);", t)
+        _insert_match_teams(cursor, [(id, data["teams"])])
+        _log_changes(cursor, "match_teams", "match_id", [id])
+        changed.append("match_teams")
+    _refresh_match_read(cursor, [id])
+    _bump_versions(cursor, changed)
+    _record_changes("matches", [id])
     return id
 
-def _match_dict(rows):
-    idpos = 8
-    player_id = u.getter(idpos)
-    team_number = u.getter(7)
-    player_ids = list(map(player_id, rows))
-    players = get_players(player_ids)
-    match = u.zipmap(["id", "date", "game", "finished", "tournament",
-                      "team1_score", "team2_score"],
-                     rows[0])
-    match = u.update(match, "date", datetime.datetime.fromtimestamp)
-    def get_player(id):
-        return players[id]
-    def team_list(rows):
-        return list(map(get_player, set(map(player_id, rows))))
-    teams = u.fmap(team_list, u.group_by(rows, team_number))
-    match["teams"] = [teams.get(1, []), teams.get(2, [])]
+# A field plan is a dict that maps the names of the requested fields to the
+# field plans of their subfields ({} for scalar fields). The plan None means
+# the default fields, which are the fields of the records that the getters
+# have always returned.
+#
+# The column lists below map field names to the SQL expressions and joins
+# needed to fetch them. The first column is always selected, since rows are
+# grouped by it.
+
+def _subplan(fields, name):
+    return None if fields is None else fields.get(name)
+
+def _projection(columns, fields, default_fields):
+    fields = default_fields if fields is None else fields
+    chosen = [c for i, c in enumerate(columns) if i == 0 or c[0] in fields]
+    names = [name for name, _, _ in chosen]
+    exprs = ", ".join(e for _, es, _ in chosen for e in es)
+    joins = "\n".join(join for _, _, join in chosen if join)
+    return names, exprs, joins
+
+# "teams" must stay last, since its columns do not map to a single field.
+_match_select_columns = [
+    ("id", ["m.id"], None),
+    ("date", ["m.date"], None),
+    ("game", ["g.name"], "LEFT JOIN games g ON m.game_id == g.id"),
+    ("finished", ["m.finished"], None),
+    ("tournament", ["t.name"],
+     "LEFT JOIN tournaments t ON m.tournament_id == t.id"),
+    ("team1_score", ["m.team1_score"], None),
+    ("team2_score", ["m.team2_score"], None),
+    ("game_id", ["m.game_id"], None),
+    ("tournament_id", ["m.tournament_id"], None),
+    ("teams", ["mt.team_number", "mt.player_id"],
+     "LEFT JOIN match_teams mt ON mt.match_id == m.id")]
+
+_match_default_fields = ["id", "date", "game", "finished", "tournament",
+                         "team1_score", "team2_score", "teams"]
+
+# Reads select from match_read, which has a column for every field above,
+# so that they need no joins. Its "teams" column has the two teams as JSON
+# lists of players, each a list of the fields in `_player_fields`. Lists
+# are about twice as fast to decode as objects.
+_match_read_columns = [(name, [f"m.{name}"], None)
+                       for name, _, _ in _match_select_columns]
+
+def _match_query(fields, where, order_by=None):
+    names, exprs, _ = _projection(_match_read_columns, fields,
+                                  _match_default_fields)
+    order = f" ORDER BY {order_by}" if order_by else ""
+    return names, f"SELECT {exprs} FROM match_read m WHERE {where}{order};"
+
+# Records are built in place from the rows: one dict per record and no
+# intermediate copies, since this runs for every row that is read. Dates
+# are converted afterwards, a whole column at a time.
+
+def _datetime_column(records, name):
+    records = list(records)
+    column = times.to_datetimes([record[name] for record in records])
+    for record, value in zip(records, column):
+        record[name] = value
+
+def _match_dict(rows, names, players):
+    # When "teams" is in `names` it gets the team number column, which is
+    # replaced below.
+    match = dict(zip(names, rows[0]))
+    if players is not None:
+        teams = [[], []]
+        for row in rows:
+            team_number = row[-2]
+            if team_number == 1 or team_number == 2:
+                team = teams[team_number - 1]
+                if row[-1] not in team:
+                    team.append(row[-1])
+        match["teams"] = [[players[id] for id in team] for team in teams]
     return match
 
-def _matches_dict(rows):
-    return u.fmap(_match_dict, u.group_by(rows, u.first))
+def _match_records(rows, names, players):
+    """Builds matches from the rows of the joined normalized tables, without
+    converting their dates."""
+    if players is None:
+        return {row[0]: _match_dict((row,), names, None) for row in rows}
+    rows_by_id = {}
+    for row in rows:
+        match_rows = rows_by_id.get(row[0])
+        if match_rows is None:
+            rows_by_id[row[0]] = [row]
+        else:
+            match_rows.append(row)
+    return {id: _match_dict(match_rows, names, players)
+            for id, match_rows in rows_by_id.items()}
 
-_match_query = """
-    SELECT m.id, m.date, g.name, m.finished, t.name,
-        m.team1_score, m.team2_score,
-        mt.team_number, p.id
-    FROM matches m
-    LEFT JOIN tournaments t ON m.tournament_id == t.id
-    LEFT JOIN games g ON m.game_id == g.id
-    LEFT JOIN match_teams mt ON mt.match_id == m.id
-    LEFT JOIN players p ON mt.player_id == p.id"""
+def _read_matches(rows, names, fields):
+    """Builds matches from match_read rows, one row per match."""
+    matches = {}
+    players = []
+    with_teams = names[-1] == "teams"
+    if with_teams:
+        player_names, _, _ = _projection(_player_select_columns,
+                                         _subplan(fields, "teams"),
+                                         _player_default_fields)
+        player_columns = [(name, _player_fields.index(name))
+                          for name in player_names]
+    for row in rows:
+        match = matches[row[0]] = dict(zip(names, row))
+        if with_teams:
+            match["teams"] = teams = [
+                [{name: player[i] for name, i in player_columns}
+                 for player in team]
+                for team in json.loads(match["teams"])]
+            for team in teams:
+                players.extend(team)
+    if "date" in names:
+        _datetime_column(matches.values(), "date")
+    if with_teams and "birthday" in player_names:
+        _datetime_column(players, "birthday")
+    return matches
+
+def _select_matches(cursor, where, args, fields):
+    names, query = _match_query(fields, where)
+    cursor.execute(query, args)
+    return _read_matches(cursor.fetchall(), names, fields)
+
+def _json_list(values):
+    # A single parameter that works for any number of values.
+    return json.dumps(list(values))
+
+def _match_filter(filters):
+    """Returns the WHERE clause and arguments that select the matches in
+    `filters`, a dict with at most one of the keys "ids", "between",
+    "on_date", "tournament_name", "tournament_id", "player_id" and
+    "head_to_head", and optionally "finished". No key selects all
+    matches."""
+    where, args = _match_selection(filters)
+    if "finished" in filters:
+        return f"({where}) AND m.finished == ?", args + [filters["finished"]]
+    return where, args
+
+def _match_selection(filters):
+    if "ids" in filters:
+        return ("m.id IN (SELECT value FROM json_each(?))",
+                [_json_list(filters["ids"])])
+    if "between" in filters or "on_date" in filters:
+        starttime, endtime = filters["between"] if "between" in filters \
+            else _day_bounds(filters["on_date"])
+        return ("m.date >= ? AND m.date < ?",
+                [_to_int_time(starttime), _to_int_time(endtime)])
+    if "tournament_name" in filters:
+        return ("""m.tournament_id ==
+                   (SELECT id FROM tournaments WHERE name == ?)""",
+                [filters["tournament_name"]])
+    if "tournament_id" in filters:
+        return "m.tournament_id == ?", [filters["tournament_id"]]
+    # The matches of players are found with matchteams_player_index.
+    if "player_id" in filters:
+        return ("""m.id IN (SELECT match_id FROM match_teams
+                            WHERE player_id == ?)""",
+                [filters["player_id"]])
+    if "head_to_head" in filters:
+        return ("""m.id IN (SELECT a.match_id FROM match_teams a
+                            JOIN match_teams b ON b.match_id == a.match_id
+                            AND b.team_number != a.team_number
+                            WHERE a.player_id == ? AND b.player_id == ?)""",
+                list(filters["head_to_head"]))
+    return "1", []
 
 @_db_query
-def get_matches_between(conn, cursor, starttime, endtime):
-    starttime = _to_int_time(starttime)
-    endtime = _to_int_time(endtime)
-    cursor.execute(_match_query + " WHERE date >= ? AND date < ?;",
-                   (starttime, endtime))
-    return _matches_dict(cursor.fetchall())
+def get_matches_between(conn, cursor, starttime, endtime, fields=None):
+    return _select_matches(
+        cursor, *_match_filter({"between": (starttime, endtime)}), fields)
 
 @_db_query
-def get_matches(conn, cursor, ids):
-    qs = ", ".join("?"*len(ids))
-    cursor.execute(_match_query + f" WHERE m.id IN ({qs});", ids)
-    return _matches_dict(cursor.fetchall())
+def get_matches(conn, cursor, ids, fields=None):
+    return _select_matches(cursor, *_match_filter({"ids": ids}), fields)
 
 @_db_query
-def get_matches_by_tournament_name(conn, cursor, name):
-    cursor.execute(_match_query + " WHERE t.name == ?;", [name])
-    return _matches_dict(cursor.fetchall())
+def get_matches_by_tournament_name(conn, cursor, name, fields=None):
+    return _select_matches(
+        cursor, *_match_filter({"tournament_name": name}), fields)
 
 @_db_query
-def get_matches_by_tournament_id(conn, cursor, id):
-    cursor.execute(_match_query + " WHERE t.id == ?;", [id])
-    return _matches_dict(cursor.fetchall())
-
-def _players_dict(rows):
-    player_rows = u.group_by(rows, u.first)
-    def make_player(pid):
-        rows = player_rows[pid]
-        pmap = u.zipmap(["id", "name", "birthday", "from_nation", "team"],
-                        rows[0])
-        if pmap["birthday"] is not None:
-            pmap = u.update(pmap, "birthday", datetime.datetime.fromtimestamp)
-        pmap["games"] = list(filter(None, map(u.last, rows)))
-        return pmap
-    return {id: make_player(id) for id in player_rows}
+def get_matches_by_tournament_id(conn, cursor, id, fields=None):
+    return _select_matches(
+        cursor, *_match_filter({"tournament_id": id}), fields)
+
+def _keyset_page(cursor, table, key_columns, where, args, first, after,
+                 descending=False):
+    """Returns the keys of the first `first` rows of `table` that come after
+    the key `after` in key order, or in reverse key order if `descending`,
+    and whether there are more rows."""
+    keys = ", ".join(key_columns)
+    order = ", ".join(f"{column} DESC" for column in key_columns) \
+        if descending else keys
+    args = list(args)
+    if after is not None:
+        qs = ", ".join("?"*len(key_columns))
+        where = f"({where}) AND ({keys}) {'<' if descending else '>'} ({qs})"
+        args += list(after)
+    cursor.execute(f"""SELECT {keys} FROM {table} WHERE {where}
+                       ORDER BY {order} LIMIT ?;""", args + [first + 1])
+    rows = cursor.fetchall()
+    return rows[:first], len(rows) > first
+
+@_db_query
+def get_matches_page(conn, cursor, filters, first, after=None, fields=None,
+                     descending=False):
+    """Returns a page of the matches in `filters` (see `_match_filter`) in
+    (date, id) order, or latest first if `descending`, as a list of (key,
+    match) pairs, and whether there are more matches. `after` is the key of
+    the match before the page."""
+    where, args = _match_filter(filters)
+    keys, has_next = _keyset_page(cursor, "match_read m",
+                                  ["m.date", "m.id"], where, args, first,
+                                  after, descending)
+    matches = _select_matches(
+        cursor, *_match_filter({"ids": [id for _, id in keys]}), fields)
+    return [(key, matches[key[1]]) for key in keys], has_next
+
+# Each page of `get_player_match_pages` takes at most 6 variables.
+_pages_per_query = _max_variables // 6
+
+@_db_query
+def get_player_match_pages(conn, cursor, pages, fields=None):
+    """Returns pages of the matches of players, latest first, for `pages` of
+    (player_id, first, after, finished) as a dict from them to pages like
+    those of `get_matches_page`. `finished` is None for all matches. The
+    keys of many pages are read with one query, of one subquery per page,
+    and the matches of all pages with another."""
+    pages = list(pages)
+    keys = [[] for _ in pages]
+    for chunk in u.partition_all(_pages_per_query, list(enumerate(pages))):
+        parts, args = [], []
+        for i, (player_id, first, after, finished) in chunk:
+            filters = {"player_id": player_id}
+            if finished is not None:
+                filters["finished"] = finished
+            where, where_args = _match_filter(filters)
+            if after is not None:
+                where = f"({where}) AND (m.date, m.id) < (?, ?)"
+                where_args += list(after)
+            parts.append(f"""SELECT * FROM (
+                                 SELECT {i}, m.date, m.id FROM match_read m
+                                 WHERE {where}
+                                 ORDER BY m.date DESC, m.id DESC LIMIT ?)""")
+            args += where_args + [first + 1]
+        cursor.execute(" UNION ALL ".join(parts) + ";", args)
+        for i, date, id in cursor.fetchall():
+            keys[i].append((date, id))
+    matches = _select_matches(cursor, *_match_filter(
+        {"ids": [id for (_, first, _, _), page in zip(pages, keys)
+                 for _, id in page[:first]]}), fields)
+    return {spec: ([(key, matches[key[1]]) for key in page[:spec[1]]],
+                   len(page) > spec[1])
+            for spec, page in zip(pages, keys)}
+
+def iter_matches(filters, fields=None, chunk_size=500):
+    """Yields the matches in `filters` (see `_match_filter`) in (date, id)
+    order, in lists of at most `chunk_size` matches. The rows are read from
+    a single query in one transaction as they are needed, so memory use does
+    not grow with the number of matches."""
+    where, args = _match_filter(filters)
+    names, query = _match_query(fields, where, "m.date, m.id")
+    with transaction() as conn:
+        cursor = conn.execute(query, args)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield list(_read_matches(rows, names, fields).values())
+
+@_db_query
+def get_match_teams(conn, cursor, match_ids):
+    """Returns the player ids of the two teams of each of the matches."""
+    rows = _select_in(cursor, """
+        SELECT match_id, team_number, player_id FROM match_teams
+        WHERE match_id IN ({});""", match_ids)
+    teams = {id: [[], []] for id in match_ids}
+    for match_id, team_number, player_id in rows:
+        team = teams[match_id][team_number - 1]
+        if player_id not in team:
+            team.append(player_id)
+    return teams
+
+# "games" must stay last, since its rows are collected into a list.
+_player_select_columns = [
+    ("id", ["p.id"], None),
+    ("name", ["p.name"], None),
+    ("birthday", ["p.birthday"], None),
+    ("from_nation", ["p.from_nation"], None),
+    ("team", ["t.name"], "LEFT JOIN teams t ON p.team_id == t.id"),
+    ("team_id", ["p.team_id"], None),
+    ("game_ids", ["""(SELECT group_concat(pgi.game_id) FROM player_games pgi
+                      WHERE pgi.player_id == p.id)"""], None),
+    ("games", ["g.name"],
+     """LEFT JOIN player_games pg ON pg.player_id == p.id
+        LEFT JOIN games g ON pg.game_id = g.id""")]
+
+_player_default_fields = ["id", "name", "birthday", "from_nation", "team",
+                          "games"]
+_player_fields = [name for name, _, _ in _player_select_columns]
+
+def _player_records(rows, names):
+    """Builds players from their rows, without converting their birthdays."""
+    with_games = names[-1] == "games"
+    players = {}
+    for row in rows:
+        player = players.get(row[0])
+        if player is None:
+            player = players[row[0]] = dict(zip(names, row))
+            if "game_ids" in player:
+                ids = player["game_ids"]
+                player["game_ids"] = list(map(int, ids.split(","))) \
+                    if ids else []
+            if with_games:
+                player["games"] = []
+        if with_games and row[-1]:
+            player["games"].append(row[-1])
+    return players
+
+def _players_dict(rows, names):
+    players = _player_records(rows, names)
+    if "birthday" in names:
+        _datetime_column(players.values(), "birthday")
+    return players
+
+def _player_rows(cursor, by_column, args, fields):
+    names, exprs, joins = _projection(_player_select_columns, fields,
+                                      _player_default_fields)
+    rows = _select_in(cursor, f"""
+        SELECT {exprs}
+        FROM players p
+        {joins}
+        WHERE {by_column} IN ({{}});""", args)
+    return rows, names
 
 def _players_getter(by_column):
     @_db_query
-    def getter(conn, cursor, args):
-        qs = ", ".join("?"*len(args))
-        cursor.execute(f"""
-            SELECT p.id, p.name, p.birthday, p.from_nation, t.name,
-                g.name
-            FROM players p
-            LEFT JOIN teams t ON p.team_id == t.id
-            LEFT JOIN player_games pg ON pg.player_id == p.id
-            LEFT JOIN games g ON pg.game_id = g.id
-            WHERE {by_column} IN ({qs});""",
-                       args)
-        return _players_dict(cursor.fetchall())
+    def getter(conn, cursor, args, fields=None):
+        return _players_dict(*_player_rows(cursor, by_column, args, fields))
     return getter
 
 get_players = _players_getter("p.id")
 get_players_by_names = _players_getter("p.name")
 
-def _start_of_day(date):
-    """Takes a date in string, datetime, or int format, and returns the int
-    representing the start of the day."""
-    date = _to_int_time(date)
-    struct = time.localtime(date)
-    day_dt = datetime.datetime(*struct[:3])
-    return time.mktime(day_dt.timetuple())
-
-def _get_next_date(date):
-    day = _start_of_day(date)
-    # ensure day is at start of day and handle daylight saving time
-    day_dt = datetime.datetime.fromtimestamp(day)
-    next_day_dt = day_dt + datetime.timedelta(days=1)
-    return time.mktime(next_day_dt.timetuple())
-
-def get_matches_on_day(day):
-    day = _to_int_time(day)
-    # ensure day is at start of day and handle daylight saving time
-    struct = time.localtime(day)
-    day_dt = datetime.datetime(*struct[:3])
-    day = time.mktime(day_dt.timetuple())
-    next_day_dt = day_dt + datetime.timedelta(days=1)
-    next_day = time.mktime(next_day_dt.timetuple())
-    return get_matches_between(day, next_day)
+def _player_filter(filters):
+    """Like `_match_filter`, for the keys "ids" and "names"."""
+    if "ids" in filters:
+        return ("p.id IN (SELECT value FROM json_each(?))",
+                [_json_list(filters["ids"])])
+    if "names" in filters:
+        return ("p.name IN (SELECT value FROM json_each(?))",
+                [_json_list(filters["names"])])
+    return "1", []
+
+@_db_query
+def get_players_page(conn, cursor, filters, first, after=None, fields=None):
+    """Like `get_matches_page`, in id order."""
+    where, args = _player_filter(filters)
+    keys, has_next = _keyset_page(cursor, "players p", ["p.id"],
+                                  where, args, first, after)
+    players = get_players([id for id, in keys], fields)
+    return [(key, players[key[0]]) for key in keys], has_next
+
+# Search results by kind, and the tables of each kind.
+_search_kinds = {"player": "players", "team": "teams",
+                 "tournament": "tournaments"}
+
+# Only this many of the names that match a search, of each kind, are
+# ranked, so that short prefixes, which match many names, are as fast as
+# long ones.
+_search_candidates = 1000
+
+def _search_query(text):
+    """The FTS5 query for the names that have words starting with each word
+    of `text`. Words without letters or digits match nothing, so they are
+    left out."""
+    words = [word for word in text.split() if any(map(str.isalnum, word))]
+    return " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+
+@_db_query
+def search(conn, cursor, text, kinds=None, first=10):
+    """Returns the kinds and ids of at most `first` players, teams and
+    tournaments, or only of the given `kinds`, whose names have words that start
+    with each word of `text`, ignoring case and diacritics. The best
+    matches, by bm25, come first."""
+    query = _search_query(text)
+    kinds = [kind for kind in _search_kinds
+             if kinds is None or kind in kinds]
+    if not query or not kinds or first <= 0:
+        return []
+    selects = " UNION ALL ".join(
+        f"""SELECT * FROM (
+                SELECT '{kind}', rowid, rank FROM {index}
+                WHERE {index} MATCH :query LIMIT :candidates)"""
+        for kind in kinds
+        for index in [_search_indexes[_search_kinds[kind]]])
+    cursor.execute(f"{selects} ORDER BY 3, 1, 2 LIMIT :first;",
+                   {"query": query, "candidates": _search_candidates,
+                    "first": first})
+    return [(kind, id) for kind, id, _ in cursor.fetchall()]
+
+@_db_query
+def rebuild_search(conn, cursor):
+    """Rebuilds the search indexes from the names in their tables."""
+    for index in _search_indexes.values():
+        cursor.execute(f"INSERT INTO {index}({index}) VALUES ('rebuild');")
+        _log_changes(cursor, index)
+
+_start_of_day = times.start_of_day
+_get_next_date = times.next_day
+_day_bounds = times.day_bounds
+
+def get_matches_on_day(day, fields=None):
+    return get_matches_between(*_day_bounds(day), fields)
+
+# match_read is written in the transaction of every write that changes what
+# it shows. Inserting a player changes nothing, since a new player is in no
+# match yet.
+
+def _match_read_rows(cursor, ids):
+    """Builds the match_read rows of the matches from the normalized
+    tables."""
+    match_fields = [name for name, _, _ in _match_select_columns]
+    names, exprs, joins = _projection(_match_select_columns, match_fields,
+                                      None)
+    cursor.execute(f"""SELECT {exprs} FROM matches m {joins}
+                       WHERE m.id IN (SELECT value FROM json_each(?));""",
+                   [_json_list(ids)])
+    rows = cursor.fetchall()
+    player_ids = list({row[-1] for row in rows if row[-1] is not None})
+    players = _player_records(*_player_rows(cursor, "p.id", player_ids,
+                                            _player_fields))
+    players = {id: [player[name] for name in _player_fields]
+               for id, player in players.items()}
+    matches = _match_records(rows, names, players)
+    return [tuple(match[name] for name in names[:-1])
+            + (json.dumps(match["teams"], separators=(",", ":")),)
+            for match in matches.values()]
+
+def _refresh_match_read(cursor, ids):
+    """Rewrites the match_read rows of the matches, and adjusts the
+    standings by the difference between the new and old rows."""
+    qs = ", ".join("?"*len(_match_read_columns))
+    for chunk in u.partition_all(_max_variables, ids):
+        old_rows = _select_in(cursor,
+                              "SELECT * FROM match_read WHERE id IN ({});",
+                              chunk)
+        rows = _match_read_rows(cursor, chunk)
+        cursor.executemany(f"INSERT OR REPLACE INTO match_read VALUES ({qs});",
+                           rows)
+        _log_changes(cursor, "match_read", "id", chunk)
+        deltas = {}
+        _add_standings(deltas, old_rows, -1)
+        _add_standings(deltas, rows, 1)
+        _update_standings(cursor, deltas)
+
+@_db_query
+def rebuild_match_read(conn, cursor):
+    """Rebuilds match_read, and the standings, from the normalized tables and
+    returns the number of matches."""
+    cursor.execute("DELETE FROM match_read;")
+    cursor.execute("DELETE FROM player_standings;")
+    cursor.execute("DELETE FROM team_standings;")
+    for table in ["match_read", "player_standings", "team_standings"]:
+        _log_changes(cursor, table)
+    cursor.execute("SELECT id FROM matches ORDER BY id;")
+    ids = [id for id, in cursor.fetchall()]
+    _refresh_match_read(cursor, ids)
+    return len(ids)
+
+def _decoded_row(row):
+    return row and row[:-1] + (json.loads(row[-1]),)
+
+@_db_query
+def check_match_read(conn, cursor):
+    """Compares match_read with the normalized tables and returns the ids of
+    the matches whose rows are missing, stale or should not be there."""
+    cursor.execute("SELECT id FROM matches UNION SELECT id FROM match_read;")
+    ids = sorted(id for id, in cursor.fetchall())
+    wrong = []
+    for chunk in u.partition_all(_max_variables, ids):
+        expected = {row[0]: row for row in _match_read_rows(cursor, chunk)}
+        stored = {row[0]: row for row in _select_in(
+            cursor, "SELECT * FROM match_read WHERE id IN ({});", chunk)}
+        wrong.extend(id for id in chunk
+                     if _decoded_row(expected.get(id)) !=
+                     _decoded_row(stored.get(id)))
+    return wrong
+
+# The matches whose match_read rows show the name of a game, team or
+# tournament.
+_matches_showing = {
+    "games": """SELECT id FROM matches WHERE game_id = :id
+                UNION
+                SELECT mt.match_id FROM match_teams mt
+                JOIN player_games pg ON pg.player_id = mt.player_id
+                WHERE pg.game_id = :id;""",
+    "teams": """SELECT DISTINCT mt.match_id FROM match_teams mt
+                JOIN players p ON p.id = mt.player_id
+                WHERE p.team_id = :id;""",
+    "tournaments": "SELECT id FROM matches WHERE tournament_id = :id;"}
+
+def _renamer(table):
+    @_db_query
+    def rename(conn, cursor, id, name):
+        indexed = table in _search_indexes
+        if indexed:
+            _index_names(cursor, table, [id], remove=True)
+        cursor.execute(f"UPDATE {table} SET name = ? WHERE id = ?;",
+                       [name, id])
+        if indexed:
+            _index_names(cursor, table, [id])
+        _log_changes(cursor, table, "id", [id])
+        cursor.execute(_matches_showing[table], {"id": id})
+        match_ids = [match_id for match_id, in cursor.fetchall()]
+        _refresh_match_read(cursor, match_ids)
+        _bump_versions(cursor, [table])
+        _record_changes("matches", match_ids)
+        return id
+    return rename
+
+rename_game = _renamer("games")
+rename_team = _renamer("teams")
+rename_tournament = _renamer("tournaments")
+
+# The standings tables have the aggregates of the finished matches of each
+# player and team, per tournament and, with tournament_id 0, of all
+# matches. A team plays on the side of its players, and a player or team
+# on both sides of a match plays neither. Writes add the difference that
+# they make, so the aggregates are never recomputed from the matches.
+
+_stats_columns = ["matches_played", "wins", "losses", "score_difference"]
+_match_read_names = [name for name, _, _ in _match_read_columns]
+
+def _add_standings(deltas, rows, sign):
+    """Adds the contributions of match_read rows, times `sign`, to
+    `deltas`, a dict from (table, tournament_id, id) to stats."""
+    team_id = _player_fields.index("team_id")
+    for row in rows:
+        match = dict(zip(_match_read_names, row))
+        if not match["finished"]:
+            continue
+        tournament_ids = [0]
+        if match["tournament_id"] is not None:
+            tournament_ids.append(match["tournament_id"])
+        teams = json.loads(match["teams"])
+        players = [{player[0] for player in team} for team in teams]
+        team_ids = [{player[team_id] for player in team} - {None}
+                    for team in teams]
+        team1_difference = (match["team1_score"] or 0) - \
+            (match["team2_score"] or 0)
+        for side, other, difference in [(0, 1, team1_difference),
+                                        (1, 0, -team1_difference)]:
+            stats = [sign, sign * (difference > 0), sign * (difference < 0),
+                     sign * difference]
+            for table, ids in [
+                    ("player_standings", players[side] - players[other]),
+                    ("team_standings", team_ids[side] - team_ids[other])]:
+                for id in ids:
+                    for tournament_id in tournament_ids:
+                        key = (table, tournament_id, id)
+                        deltas[key] = [a + b for a, b in
+                                       zip(deltas.get(key, [0]*4), stats)]
+
+def _update_standings(cursor, deltas):
+    updates = ", ".join(f"{c} = {c} + excluded.{c}" for c in _stats_columns)
+    for table, id_column in [("player_standings", "player_id"),
+                             ("team_standings", "team_id")]:
+        rows = [(tournament_id, id, *stats)
+                for (t, tournament_id, id), stats in deltas.items()
+                if t == table and any(stats)]
+        cursor.executemany(f"""INSERT INTO {table} VALUES (?, ?, ?, ?, ?, ?)
+                               ON CONFLICT DO UPDATE SET {updates};""", rows)
+        _log_changes(cursor, table, f"tournament_id,{id_column}",
+                     [json.dumps(row[:2]) for row in rows])
+
+@_db_query
+def check_standings(conn, cursor):
+    """Compares the standings with the ones computed from all of match_read
+    and returns the (table, tournament_id, id) keys that differ."""
+    cursor.execute("SELECT * FROM match_read;")
+    expected = {}
+    _add_standings(expected, cursor, 1)
+    stored = {}
+    for table in ["player_standings", "team_standings"]:
+        cursor.execute(f"SELECT * FROM {table};")
+        stored.update(((table, tournament_id, id), stats)
+                      for tournament_id, id, *stats in cursor.fetchall())
+    zeros = [0]*len(_stats_columns)
+    keys = set(expected) | set(stored)
+    return sorted(key for key in keys
+                  if expected.get(key, zeros) != stored.get(key, zeros))
+
+def _stats_getter(table, id_column):
+    @_db_query
+    def getter(conn, cursor, keys):
+        """Returns the stats of (id, tournament_id) keys, where tournament_id
+        0 means all matches. Those without finished matches have zeros."""
+        columns = ", ".join(_stats_columns)
+        cursor.execute(f"""
+            SELECT {id_column}, tournament_id, {columns} FROM {table}
+            WHERE ({id_column}, tournament_id) IN
+                  (SELECT value ->> 0, value ->> 1 FROM json_each(?));""",
+                       [json.dumps(list(map(list, keys)))])
+        rows = cursor.fetchall()
+        stats = {(id, tournament_id): u.zipmap(_stats_columns, row)
+                 for id, tournament_id, *row in rows}
+        zeros = dict.fromkeys(_stats_columns, 0)
+        return {key: stats.get(tuple(key), zeros) for key in keys}
+    return getter
+
+def _standings_getter(table, id_column):
+    @_db_query
+    def getter(conn, cursor, tournament_id):
+        """Returns the stats of everyone who has played finished matches in
+        the tournament, best first. Only reads their rows."""
+        columns = ", ".join(_stats_columns)
+        cursor.execute(f"""
+            SELECT {id_column}, {columns} FROM {table}
+            WHERE tournament_id = ? AND matches_played > 0
+            ORDER BY wins DESC, score_difference DESC, {id_column};""",
+                       [tournament_id])
+        return [u.zipmap([id_column] + _stats_columns, row)
+                for row in cursor.fetchall()]
+    return getter
+
+get_player_stats = _stats_getter("player_standings", "player_id")
+get_team_stats = _stats_getter("team_standings", "team_id")
+get_player_standings = _standings_getter("player_standings", "player_id")
+get_team_standings = _standings_getter("team_standings", "team_id")
@@ -0,0 +1,169 @@
+import collections
+import hashlib
+import json
+import threading
+from graphql.error import GraphQLError
+from graphql.execution import ExecutionResult, execute
+from graphql.language import ast
+from graphql.language.parser import parse
+from graphql.language.printer import print_ast
+from graphql.validation import validate
+from . import metrics
+
+# `text` is the normalized query text, which is the same for queries that
+# differ only in formatting.
+Document = collections.namedtuple("Document", ["ast", "errors", "text"])
+
+class DocumentCache:
+    """A bounded LRU cache of parsed and validated GraphQL documents, keyed by
+    the query text. Documents that fail to parse or validate are cached
+    together with their errors."""
+    def __init__(self, schema, max_size=1000):
+        self.schema = schema
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _parse_and_validate(self, query):
+        try:
+            with metrics.phase("parse"):
+                document = parse(query)
+        except GraphQLError as e:
+            return Document(None, [e], query)
+        with metrics.phase("validate"):
+            errors = validate(self.schema, document)
+        return Document(document, errors, print_ast(document))
+
+    def get(self, query):
+        """Returns the `Document` of `query`."""
+        with self._lock:
+            entry = self._entries.get(query)
+            if entry is not None:
+                self._entries.move_to_end(query)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        entry = self._parse_and_validate(query)
+        with self._lock:
+            self._entries[query] = entry
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def execute(self, query, **kwargs):
+        """Like `schema.execute`, but parses and validates `query` only the
+        first time it is seen."""
+        if query is None:
+            return ExecutionResult(errors=[GraphQLError("Must provide query")],
+                                   invalid=True)
+        return self.execute_document(self.get(query), **kwargs)
+
+    def execute_document(self, document, **kwargs):
+        if document.errors:
+            return ExecutionResult(errors=document.errors, invalid=True)
+        return execute(self.schema, document.ast, **kwargs)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._entries), "max_size": self.max_size}
+
+def get_operation(document_ast, operation_name=None):
+    """Returns the definition of the operation that would be executed, or
+    None if there is no such operation. Without `operation_name`, that is
+    the only operation of the document."""
+    operations = [d for d in document_ast.definitions
+                  if isinstance(d, ast.OperationDefinition)]
+    if operation_name is None:
+        return operations[0] if len(operations) == 1 else None
+    for definition in operations:
+        if definition.name and definition.name.value == operation_name:
+            return definition
+    return None
+
+def operation_type(document, operation_name=None):
+    """Returns "query", "mutation" or "subscription", or None."""
+    operation = get_operation(document.ast, operation_name)
+    return operation and operation.operation
+
+def operation_name(document, operation_name=None):
+    """Returns the name of the operation, or "anonymous"."""
+    operation = get_operation(document.ast, operation_name)
+    return operation.name.value if operation and operation.name \
+        else "anonymous"
+
+class PersistedQueryError(Exception):
+    pass
+
+def query_hash(query):
+    return hashlib.sha256(query.encode()).hexdigest()
+
+class PersistedQueries:
+    """A registry of query texts keyed by their sha256 hashes, so that
+    clients can send the hash instead of the whole query. The queries of
+    `load` are always kept, and of those that clients register, at most
+    `max_size`, least recently used first out."""
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pinned = {}
+        self._queries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, query, pinned=False):
+        hash = query_hash(query)
+        with self._lock:
+            if pinned:
+                self._pinned[hash] = query
+                self._queries.pop(hash, None)
+            elif hash not in self._pinned:
+                self._queries[hash] = query
+                self._queries.move_to_end(hash)
+                if len(self._queries) > self.max_size:
+                    self._queries.popitem(last=False)
+                    self.evictions += 1
+        return hash
+
+    def load(self, filename):
+        """Registers the queries in a JSON file, which contains either a list
+        of queries or an object that maps hashes to queries."""
+        with open(filename, 'r') as f:
+            queries = json.load(f)
+        if isinstance(queries, dict):
+            for hash, query in queries.items():
+                if query_hash(query) != hash:
+                    raise PersistedQueryError(
+                        f"Hash {hash} in {filename} does not match its query")
+            queries = queries.values()
+        for query in queries:
+            self.register(query, pinned=True)
+
+    def resolve(self, hash, query=None):
+        """Returns the query with the given hash. If the query is given too,
+        it is only checked against the hash: the caller registers it once it
+        is known to be valid, so that later requests can send only the
+        hash."""
+        if query is not None:
+            if query_hash(query) != hash:
+                raise PersistedQueryError("provided sha does not match query")
+            return query
+        with self._lock:
+            query = self._pinned.get(hash)
+            if query is None:
+                query = self._queries.get(hash)
+                if query is not None:
+                    self._queries.move_to_end(hash)
+            if query is None:
+                self.misses += 1
+                raise PersistedQueryError("PersistedQueryNotFound")
+            self.hits += 1
+            return query
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._pinned) + len(self._queries),
+                "max_size": self.max_size}
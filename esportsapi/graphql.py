@@ -1,9 +1,39 @@
+import base64
+import collections
 from . import db_functions as db
+from . import documents
 import graphene as g
+from graphene.utils.str_converters import to_snake_case
+from graphql.error import GraphQLError
+from graphql.execution import execute
+from graphql.execution.values import get_argument_values
+from graphql.language import ast
+from graphql.validation import validate
+import json
+from promise import Promise
+from promise.dataloader import DataLoader
+
+class Stats(g.ObjectType):
+    """Aggregates of the finished matches of a player or team."""
+    matches_played = g.NonNull(g.Int)
+    wins = g.NonNull(g.Int)
+    losses = g.NonNull(g.Int)
+    score_difference = g.NonNull(g.Int)
+
+def _stats_key(id, tournament_id):
+    # Tournament 0 means all matches.
+    return (int(id), 0 if tournament_id == -1 else tournament_id)
+
+_stats_args = dict(tournament_id=g.Int(default_value=-1))
 
 class Team(g.ObjectType):
     id = g.NonNull(g.Int)
     name = g.NonNull(g.String)
+    stats = g.Field(g.NonNull(Stats), **_stats_args)
+
+    def resolve_stats(root, info, tournament_id):
+        id = root["id"] if isinstance(root, dict) else root.id
+        return _loaders(info).team_stats.load(_stats_key(id, tournament_id))
 
 class Game(g.ObjectType):
     id = g.NonNull(g.Int)
@@ -13,6 +43,101 @@ class Tournament(g.ObjectType):
     id = g.NonNull(g.Int)
     name = g.NonNull(g.String)
 
+def _add_to_plan(plan, selection_set, fragments):
+    for selection in selection_set.selections:
+        if isinstance(selection, ast.FragmentSpread):
+            fragment = fragments[selection.name.value]
+            _add_to_plan(plan, fragment.selection_set, fragments)
+        elif isinstance(selection, ast.InlineFragment):
+            _add_to_plan(plan, selection.selection_set, fragments)
+        else:
+            name = to_snake_case(selection.name.value)
+            subplan = plan.setdefault(name, {})
+            if selection.selection_set:
+                _add_to_plan(subplan, selection.selection_set, fragments)
+    return plan
+
+def _field_plan(info):
+    """Returns the field plan (see `db_functions`) of the fields selected
+    under the field being resolved."""
+    plan = {}
+    for field in info.field_asts:
+        if field.selection_set:
+            _add_to_plan(plan, field.selection_set, info.fragments)
+    return plan
+
+def _field_names(plan):
+    for name, subplan in plan.items():
+        yield name
+        yield from _field_names(subplan)
+
+def tables_read(document, operation_name=None):
+    """Returns the database tables that an operation in a parsed document
+    reads from, for the fields at any depth, or None if it has a root field
+    without an entry in `db.tables_read`, which may read any table."""
+    fragments = {d.name.value: d for d in document.definitions
+                 if isinstance(d, ast.FragmentDefinition)}
+    operation = documents.get_operation(document, operation_name)
+    tables = set()
+    if operation is not None:
+        plan = _add_to_plan({}, operation.selection_set, fragments)
+        if any(name not in db.tables_read and not name.startswith("__")
+               for name in plan):
+            return None
+        for field in _field_names(plan):
+            tables.update(db.tables_read.get(field, []))
+    return tables
+
+def _loader(fetch):
+    def batch_load(ids):
+        records = fetch(list(ids))
+        return Promise.resolve([records.get(id) for id in ids])
+    return DataLoader(batch_load)
+
+# Resolvers fetch players only with these fields, so that the same cached
+# record can be used wherever the player appears in a query.
+_player_record_plan = {"name": {}, "birthday": {}, "from_nation": {},
+                       "team_id": {}, "game_ids": {}}
+
+class Loaders:
+    """Request scoped batch loaders. Loads that are made while resolving the
+    same level of a query are collected into one query, and each id is only
+    fetched once."""
+    def __init__(self):
+        self.players = _loader(
+            lambda ids: db.get_players(ids, _player_record_plan))
+        self.teams = _loader(db.get_teams)
+        self.games = _loader(db.get_games)
+        self.tournaments = _loader(db.get_tournaments)
+        self.match_teams = _loader(db.get_match_teams)
+        self.player_stats = _loader(db.get_player_stats)
+        self.team_stats = _loader(db.get_team_stats)
+        self._player_match_pages = {}
+
+    def player_match_pages(self, fields):
+        """The loader of pages of the matches of players, by (player_id,
+        first, after, finished), with one loader per plan of match
+        fields."""
+        key = json.dumps(fields, sort_keys=True)
+        if key not in self._player_match_pages:
+            self._player_match_pages[key] = _loader(
+                lambda pages: db.get_player_match_pages(pages, fields))
+        return self._player_match_pages[key]
+
+class Context:
+    def __init__(self):
+        self.loaders = Loaders()
+
+def _loaders(info):
+    # Without a request context nothing can be shared between resolvers.
+    context = info.context
+    return context.loaders if isinstance(context, Context) else Loaders()
+
+def _load_name(loader, id):
+    if id is None:
+        return None
+    return loader.load(id).then(lambda record: record and record["name"])
+
 class Player(g.ObjectType):
     id = g.NonNull(g.ID)
     name = g.NonNull(g.String)
@@ -20,6 +145,28 @@ class Player(g.ObjectType):
     from_nation = g.String()
     team = g.Field(g.String)
     games = g.NonNull(g.List(g.NonNull(g.String)))
+    stats = g.Field(g.NonNull(Stats), **_stats_args)
+    # Latest first, like headToHead.
+    matches = g.Field(lambda: g.NonNull(MatchConnection),
+                      first=g.Int(), after=g.String(), finished=g.Boolean())
+
+    def resolve_team(root, info):
+        return _load_name(_loaders(info).teams, root["team_id"])
+
+    def resolve_games(root, info):
+        games = _loaders(info).games.load_many(root["game_ids"])
+        return games.then(lambda games: [game["name"] for game in games])
+
+    def resolve_stats(root, info, tournament_id):
+        key = _stats_key(root["id"], tournament_id)
+        return _loaders(info).player_stats.load(key)
+
+    def resolve_matches(root, info, first=None, after=None, finished=None):
+        loader = _loaders(info).player_match_pages(
+            _match_plan(_connection_plan(info)))
+        page = loader.load((int(root["id"]), _page_size(first),
+                            _decode_cursor(after, 2), finished))
+        return page.then(lambda page: _connection(*page, after))
 
 class Match(g.ObjectType):
     id = g.NonNull(g.ID)
@@ -31,6 +178,93 @@ class Match(g.ObjectType):
     team2_score = g.Int()
     teams = g.List(g.NonNull(g.List(g.NonNull(Player))))
 
+    def resolve_game(root, info):
+        return _load_name(_loaders(info).games, root["game_id"])
+
+    def resolve_tournament(root, info):
+        return _load_name(_loaders(info).tournaments, root["tournament_id"])
+
+    def resolve_teams(root, info):
+        loaders = _loaders(info)
+        def load_players(teams):
+            return Promise.all([loaders.players.load_many(team)
+                                for team in teams])
+        return loaders.match_teams.load(root["id"]).then(load_players)
+
+def _record_plan(plan, loaded_fields):
+    """Returns the field plan for fetching records for the resolvers above,
+    where fields that are resolved with loaders are replaced by the ids
+    that the loaders need."""
+    record_plan = {}
+    for name in plan:
+        if name not in loaded_fields:
+            record_plan[name] = {}
+        elif loaded_fields[name]:
+            record_plan[loaded_fields[name]] = {}
+    return record_plan
+
+def _match_plan(plan):
+    return _record_plan(plan, {"game": "game_id",
+                               "tournament": "tournament_id",
+                               "teams": None})
+
+def _player_plan(plan):
+    return _record_plan(plan, {"team": "team_id", "games": "game_ids",
+                               "matches": None})
+
+class TeamStanding(g.ObjectType):
+    team = g.NonNull(Team)
+    stats = g.NonNull(Stats)
+
+    def resolve_team(root, info):
+        return _loaders(info).teams.load(root["team_id"])
+
+    def resolve_stats(root, info):
+        return root
+
+class PlayerStanding(g.ObjectType):
+    player = g.NonNull(Player)
+    stats = g.NonNull(Stats)
+
+    def resolve_player(root, info):
+        return _loaders(info).players.load(root["player_id"])
+
+    def resolve_stats(root, info):
+        return root
+
+class Standings(g.ObjectType):
+    """The teams and players that have finished matches in a tournament,
+    ordered by wins and then by score difference."""
+    teams = g.NonNull(g.List(g.NonNull(TeamStanding)))
+    players = g.NonNull(g.List(g.NonNull(PlayerStanding)))
+
+    def resolve_teams(root, info):
+        return db.get_team_standings(root)
+
+    def resolve_players(root, info):
+        return db.get_player_standings(root)
+
+class SearchKind(g.Enum):
+    PLAYER = "player"
+    TEAM = "team"
+    TOURNAMENT = "tournament"
+
+class SearchResult(g.Union):
+    """A player, team or tournament whose name matches a search."""
+    class Meta:
+        types = (Player, Team, Tournament)
+
+    @classmethod
+    def resolve_type(cls, instance, info):
+        return {"player": Player, "team": Team,
+                "tournament": Tournament}[instance["kind"]]
+
+def _load_search_result(loaders, kind, id):
+    loader = {"player": loaders.players, "team": loaders.teams,
+              "tournament": loaders.tournaments}[kind]
+    # The loaded records are shared, so the kind goes on a copy.
+    return loader.load(id).then(lambda record: dict(record, kind=kind))
+
 class MatchInput(g.InputObjectType):
     date = g.NonNull(g.DateTime)
     game_id = g.Int()
@@ -46,8 +280,18 @@ class CreateMatch(g.Mutation):
     match = g.Field(Match)
     def mutate(root, info, data):
         id = db.insert_match(data)
-        d = db.get_matches([id])[id]
-        return CreateMatch(match=Match(**d))
+        plan = _match_plan(_field_plan(info).get("match", {}))
+        return CreateMatch(match=db.get_matches([id], plan)[id])
+
+class CreateMatches(g.Mutation):
+    class Arguments:
+        data = g.NonNull(g.List(g.NonNull(MatchInput)))
+    matches = g.List(g.NonNull(Match))
+    def mutate(root, info, data):
+        ids = db.insert_matches(data)
+        plan = _match_plan(_field_plan(info).get("matches", {}))
+        matches = db.get_matches(ids, plan)
+        return CreateMatches(matches=[matches[id] for id in ids])
 
 class UpdateMatchInput(g.InputObjectType):
     id = g.NonNull(g.Int)
@@ -66,7 +310,8 @@ class UpdateMatch(g.Mutation):
     def mutate(root, info, data):
         db.update_match(data)
         id = data["id"]
-        return UpdateMatch(match=Match(**db.get_matches([id])[id]))
+        plan = _match_plan(_field_plan(info).get("match", {}))
+        return UpdateMatch(match=db.get_matches([id], plan)[id])
 
 class PlayerInput(g.InputObjectType):
     name = g.NonNull(g.String)
@@ -81,8 +326,18 @@ class CreatePlayer(g.Mutation):
     player = g.Field(Player)
     def mutate(root, info, data):
         id = db.insert_player(data)
-        d = db.get_players([id])[id]
-        return CreatePlayer(player=Player(**d))
+        plan = _player_plan(_field_plan(info).get("player", {}))
+        return CreatePlayer(player=db.get_players([id], plan)[id])
+
+class CreatePlayers(g.Mutation):
+    class Arguments:
+        data = g.NonNull(g.List(g.NonNull(PlayerInput)))
+    players = g.List(g.NonNull(Player))
+    def mutate(root, info, data):
+        ids = db.insert_players(data)
+        plan = _player_plan(_field_plan(info).get("players", {}))
+        players = db.get_players(ids, plan)
+        return CreatePlayers(players=[players[id] for id in ids])
 
 class CreateTeam(g.Mutation):
     class Arguments:
@@ -108,44 +363,275 @@ class CreateTournament(g.Mutation):
         id = db.insert_tournament(name)
         return CreateTournament(tournament=Tournament(**db.get_tournament(id)))
 
+# The maximum number of matches or players that a query returns at once.
+max_page_size = 100
+
+def _page_size(first):
+    if first is None:
+        return max_page_size
+    if first < 0:
+        raise GraphQLError("`first` must not be negative")
+    return min(first, max_page_size)
+
+def _encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode()
+
+def _decode_cursor(cursor, key_length):
+    if cursor is None:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        key = None
+    if not isinstance(key, list) or len(key) != key_length or \
+       not all(isinstance(x, int) for x in key):
+        raise GraphQLError(f"Invalid cursor: {cursor}")
+    return tuple(key)
+
+def _connection_type(node_type):
+    name = node_type.__name__
+    edge_type = type(f"{name}Edge", (g.ObjectType,), {
+        "cursor": g.NonNull(g.String),
+        "node": g.NonNull(node_type)})
+    return type(f"{name}Connection", (g.ObjectType,), {
+        "edges": g.NonNull(g.List(g.NonNull(edge_type))),
+        "page_info": g.NonNull(g.relay.PageInfo)})
+
+MatchConnection = _connection_type(Match)
+PlayerConnection = _connection_type(Player)
+
+def _connection(page, has_next, after):
+    edges = [{"cursor": _encode_cursor(key), "node": node}
+             for key, node in page]
+    return {"edges": edges,
+            "page_info": {"has_next_page": has_next,
+                          "has_previous_page": after is not None,
+                          "start_cursor": edges[0]["cursor"] if edges else None,
+                          "end_cursor": edges[-1]["cursor"] if edges else None}}
+
+# The `matches` and `players` lists are one page, and fail instead of
+# leaving out what does not fit in it.
+def _check_list(first, values, name, connection):
+    if first is not None and first > max_page_size:
+        raise GraphQLError(f"`{name}` returns at most {max_page_size}; page "
+                           f"through more with `{connection}`")
+    if values != -1 and len(values) > max_page_size:
+        raise GraphQLError(f"`{name}` takes at most {max_page_size} ids or "
+                           f"names; page through more with `{connection}`")
+
+def _list(page, has_next, first, name, connection):
+    if has_next and first is None:
+        raise GraphQLError(f"There are more than {max_page_size} {name}; "
+                           f"give `first`, or page through them with "
+                           f"`{connection}`")
+    return [node for _, node in page]
+
+def _connection_plan(info):
+    return _field_plan(info).get("edges", {}).get("node", {})
+
+def _match_filters(between, on_date, ids, tournament_name, tournament_id):
+    if ids != -1:
+        return {"ids": ids}
+    elif between != -1:
+        return {"between": between}
+    elif on_date != -1:
+        return {"on_date": on_date}
+    elif tournament_name != -1:
+        return {"tournament_name": tournament_name}
+    elif tournament_id != -1:
+        return {"tournament_id": tournament_id}
+    return {}
+
+def _matches_page(plan, first, after, filters):
+    return db.get_matches_page(_match_filters(**filters), _page_size(first),
+                               _decode_cursor(after, 2), _match_plan(plan))
+
+def _match_history(info, filters, first, after, finished):
+    if finished is not None:
+        filters["finished"] = finished
+    page = db.get_matches_page(filters, _page_size(first),
+                               _decode_cursor(after, 2),
+                               _match_plan(_connection_plan(info)),
+                               descending=True)
+    return _connection(*page, after)
+
+def _player_filters(ids, names):
+    if ids != -1:
+        return {"ids": ids}
+    if names != -1:
+        return {"names": names}
+    return {}
+
+def _players_page(plan, first, after, filters):
+    return db.get_players_page(_player_filters(**filters), _page_size(first),
+                               _decode_cursor(after, 1), _player_plan(plan))
+
 # None does not work as default value
 _ints = g.List(g.Int, default_value=-1)
 
+_match_args = dict(
+    first=g.Int(),
+    after=g.String(),
+    between=g.List(g.Date, default_value=-1),
+    on_date=g.Date(default_value=-1),
+    ids=_ints,
+    tournament_name=g.String(default_value=-1),
+    tournament_id=g.Int(default_value=-1))
+
+_player_args = dict(
+    first=g.Int(),
+    after=g.String(),
+    ids=_ints,
+    names=g.List(g.String, default_value=-1))
+
 class Query(g.ObjectType):
-    matches = g.Field(
-        g.List(Match),
-        between=g.List(g.Date, default_value=-1),
-        on_date=g.Date(default_value=-1),
-        ids=_ints,
-        tournament_name=g.String(default_value=-1),
-        tournament_id=g.Int(default_value=-1))
-    players = g.Field(
-        g.List(Player),
-        ids=_ints,
-        names=g.List(g.String, default_value=-1))
-
-    def resolve_matches(root, info, between, on_date, ids, tournament_name,
-                        tournament_id):
-        if ids != -1:
-            return db.get_matches(ids).values()
-        elif between != -1:
-            return db.get_matches_between(*between).values()
-        elif on_date != -1:
-            return db.get_matches_on_day(on_date).values()
-        elif tournament_name != -1:
-            return db.get_matches_by_tournament_name(tournament_name).values()
-        elif tournament_id != -1:
-            return db.get_matches_by_tournament_id(tournament_id).values()
-
-    def resolve_players(root, info, ids, names):
-        if ids != -1:
-            return db.get_players(ids).values()
-        if names != -1:
-            return db.get_players_by_names(names).values()
+    matches = g.Field(g.List(Match), **_match_args)
+    matches_connection = g.Field(MatchConnection, **_match_args)
+    players = g.Field(g.List(Player), **_player_args)
+    players_connection = g.Field(PlayerConnection, **_player_args)
+    standings = g.Field(g.NonNull(Standings),
+                        tournament_id=g.NonNull(g.Int))
+    head_to_head = g.Field(
+        g.NonNull(MatchConnection), player_a=g.NonNull(g.Int),
+        player_b=g.NonNull(g.Int), first=g.Int(), after=g.String(),
+        finished=g.Boolean())
+    search = g.Field(g.NonNull(g.List(g.NonNull(SearchResult))),
+                     text=g.NonNull(g.String),
+                     kinds=g.List(g.NonNull(SearchKind)), first=g.Int())
+
+    def resolve_matches(root, info, first=None, after=None, **filters):
+        _check_list(first, filters["ids"], "matches", "matchesConnection")
+        page, has_next = _matches_page(_field_plan(info), first, after,
+                                       filters)
+        return _list(page, has_next, first, "matches", "matchesConnection")
+
+    def resolve_matches_connection(root, info, first=None, after=None,
+                                   **filters):
+        plan = _connection_plan(info)
+        return _connection(*_matches_page(plan, first, after, filters), after)
+
+    def resolve_players(root, info, first=None, after=None, **filters):
+        _check_list(first, filters["ids"], "players", "playersConnection")
+        _check_list(first, filters["names"], "players", "playersConnection")
+        page, has_next = _players_page(_field_plan(info), first, after,
+                                       filters)
+        return _list(page, has_next, first, "players", "playersConnection")
+
+    def resolve_players_connection(root, info, first=None, after=None,
+                                   **filters):
+        plan = _connection_plan(info)
+        return _connection(*_players_page(plan, first, after, filters), after)
+
+    def resolve_standings(root, info, tournament_id):
+        return tournament_id
+
+    def resolve_head_to_head(root, info, player_a, player_b, first=None,
+                             after=None, finished=None):
+        return _match_history(info, {"head_to_head": (player_a, player_b)},
+                              first, after, finished)
+
+    def resolve_search(root, info, text, kinds=None, first=None):
+        loaders = _loaders(info)
+        return Promise.all([
+            _load_search_result(loaders, kind, id)
+            for kind, id in db.search(text, kinds, _page_size(first))])
+
+class Subscription(g.ObjectType):
+    """Only describes the subscriptions in the schema. They are run by
+    `subscriptions.Hub`, which resolves `match_updated` with the matches
+    that have changed."""
+    match_updated = g.Field(Match, ids=_ints,
+                            tournament_id=g.Int(default_value=-1))
+
+class _StreamQuery(g.ObjectType):
+    matches = g.List(Match)
+
+    def resolve_matches(root, info):
+        return root
+
+_query_schema = g.Schema(query=Query)
+_stream_schema = g.Schema(query=_StreamQuery)
+_subscription_type = g.Schema(query=Query, subscription=Subscription) \
+    .get_subscription_type()
+
+# A document that resolves the selection of a single `matches` field for a
+# list of match records, and the arguments and field plan of the field.
+MatchesField = collections.namedtuple(
+    "MatchesField", ["key", "args", "plan", "document"])
+
+def _matches_field(document, variables, operation_type, field_name,
+                   root_type):
+    """Prepares the only field of an operation, which must be `field_name`
+    and return matches, to be resolved for match records that are fetched
+    separately."""
+    operation = documents.get_operation(document)
+    fields = operation and operation.selection_set.selections
+    if operation is None or operation.operation != operation_type or \
+       len(fields) != 1 or not isinstance(fields[0], ast.Field) or \
+       fields[0].name.value != field_name:
+        raise GraphQLError(f"Only {operation_type} operations for just "
+                           f"`{field_name}` are supported here")
+    field = fields[0]
+    fragment_definitions = [d for d in document.definitions
+                            if isinstance(d, ast.FragmentDefinition)]
+    fragments = {d.name.value: d for d in fragment_definitions}
+    field_def = root_type.fields[field_name]
+    args = get_argument_values(field_def.args, field.arguments, variables)
+    plan = _match_plan(_add_to_plan({}, field.selection_set, fragments))
+    matches_document = ast.Document(definitions=[
+        ast.OperationDefinition(
+            operation="query",
+            selection_set=ast.SelectionSet(selections=[
+                ast.Field(name=ast.Name("matches"),
+                          selection_set=field.selection_set)]))]
+                                  + fragment_definitions)
+    errors = validate(_stream_schema, matches_document)
+    if errors:
+        raise errors[0]
+    key = field.alias.value if field.alias else field_name
+    return MatchesField(key, args, plan, matches_document)
+
+def resolve_matches(field, matches):
+    """Returns the results of the `MatchesField` for the match records."""
+    result = execute(_stream_schema, field.document, root_value=matches,
+                     context_value=Context())
+    if result.errors:
+        raise GraphQLError(str(result.errors))
+    return result.data["matches"]
+
+def stream_matches(document, variables=None, chunk_size=500):
+    """Prepares a query whose only field is `matches` for streaming. Returns
+    the response key of the field and an iterator over lists of results for
+    at most `chunk_size` matches at a time. The matches are read with
+    `db.iter_matches`, and each chunk is resolved with its own loaders, so
+    memory use does not grow with the number of matches. The pagination
+    arguments are ignored, since every match is returned."""
+    field = _matches_field(document, variables, "query", "matches",
+                           _query_schema.get_query_type())
+    filters = _match_filters(**{k: field.args[k] for k in
+                                ["between", "on_date", "ids",
+                                 "tournament_name", "tournament_id"]})
+    def chunks():
+        for matches in db.iter_matches(filters, field.plan, chunk_size):
+            yield resolve_matches(field, matches)
+    return field.key, chunks()
+
+def match_subscription(document, variables=None):
+    """Prepares a subscription to `matchUpdated`. Returns its `MatchesField`
+    and its filters, which are like those of `db_functions._match_filter`
+    but only use "ids" and "tournament_id"."""
+    field = _matches_field(document, variables, "subscription",
+                           "matchUpdated", _subscription_type)
+    filters = _match_filters(ids=field.args["ids"], between=-1, on_date=-1,
+                             tournament_name=-1,
+                             tournament_id=field.args["tournament_id"])
+    return field, filters
 
 class Mutation(g.ObjectType):
     create_match = CreateMatch.Field()
+    create_matches = CreateMatches.Field()
     create_player = CreatePlayer.Field()
+    create_players = CreatePlayers.Field()
     create_team = CreateTeam.Field()
     create_game = CreateGame.Field()
     create_tournament = CreateTournament.Field()
@@ -1,34 +1,205 @@
-from flask import Flask, request, jsonify
-import graphene as g
+import argparse
+import atexit
+from flask import Flask, Response, g, request, stream_with_context
 import sys
+from . import asgi
+from . import cost
 from . import graphql
 from . import db_functions as db
+from . import metrics
+from . import replica
+from . import service
+from . import times
 
-if len(sys.argv) == 1 or sys.argv[1] not in ["app", "db"]:
-    print('Please give the argument `app` to run the "app API",' +
-          '\nor `db` to run the "database API".')
-    sys.exit(1)
-elif sys.argv[1] == "app":
-    schema = g.Schema(query=graphql.Query)
-else:
-    schema = g.Schema(query=graphql.Query, mutation=graphql.Mutation)
-
-# Get a fresh database on every restart to test more easily.
-# Obviously this wouldn't work in a real app.
-db.recreate_db()
-db.load_example_data()
-
-app = Flask(__name__)
-
-http_bad_request = 400
-
-@app.route("/")
-def index():
-    result = schema.execute(request.args.get("query"))
-    if result.errors:
-        return jsonify({"error": str(result.errors)}), http_bad_request
+def add_arguments(parser):
+    """Adds the options that `main` and `serve` share."""
+    parser.add_argument("api", choices=["app", "db"])
+    parser.add_argument("--server", choices=["flask", "asgi"],
+                        default="flask",
+                        help="Flask's development server, or an ASGI server "
+                        "(uvicorn) that runs queries in a thread pool")
+    parser.add_argument("--threads", type=int, default=8,
+                        help="the number of threads that run queries")
+    parser.add_argument("--max-pending", type=int, default=64,
+                        help="the number of requests that can run or wait "
+                        "for a thread before new ones get 503 (asgi)")
+    parser.add_argument("--timeout", type=float, default=30.0,
+                        help="seconds before a request gets 504 (asgi)")
+    parser.add_argument("--persisted-queries", metavar="FILE",
+                        help="a JSON file with queries to register as "
+                        "persisted")
+    parser.add_argument("--document-cache-size", type=int, default=1000)
+    parser.add_argument("--stream-chunk-size", type=int, default=500,
+                        help="the number of matches streamed at a time")
+    parser.add_argument("--max-page-size", type=int,
+                        default=graphql.max_page_size,
+                        help="the maximum number of matches or players "
+                        "returned")
+    parser.add_argument("--response-cache-bytes", type=int,
+                        default=64 * 2**20,
+                        help="memory budget of the response cache, 0 "
+                        "disables it")
+    parser.add_argument("--timezone",
+                        help="the IANA timezone of dates and days, like "
+                        "Europe/Stockholm, by default the local timezone")
+    parser.add_argument("--metrics", action="store_true",
+                        help="time requests and their database calls, and "
+                        "serve the metrics at /metrics")
+    parser.add_argument("--slow-query-ms", type=float, default=100.0,
+                        help="log database calls that take at least this "
+                        "long (with --metrics)")
+    parser.add_argument("--slow-query-log", metavar="FILE",
+                        help="the file of the slow query log, by default "
+                        "stderr")
+    parser.add_argument("--max-query-cost", type=int, default=1000000,
+                        help="reject queries with a higher estimated cost, "
+                        "0 disables the limit")
+    parser.add_argument("--max-query-depth", type=int, default=10,
+                        help="reject queries that nest fields deeper")
+    parser.add_argument("--client-cost-rate", type=float, default=0.0,
+                        help="the query cost per second that each client "
+                        "may use, 0 disables client budgets")
+    parser.add_argument("--client-cost-burst", type=float,
+                        help="the query cost that a client may use at once, "
+                        "by default 10 seconds of --client-cost-rate")
+    parser.add_argument("--max-batch-size", type=int, default=20,
+                        help="the most operations in one POST request")
+    parser.add_argument("--compress-min-bytes", type=int, default=1024,
+                        help="compress JSON responses of at least this size "
+                        "with gzip, or brotli if it is installed (0 to not "
+                        "compress)")
+    parser.add_argument("--replica", action="store_true",
+                        help="serve the app API from a copy of the database "
+                        "in memory")
+    parser.add_argument("--replica-lag", type=float, default=1.0,
+                        help="seconds between the refreshes of the replica "
+                        "from the database file")
+
+def check_arguments(parser, args):
+    if args.replica and args.api != "app":
+        parser.error("--replica is only for the app API, which does not "
+                     "write")
+
+def create_metrics(args):
+    if not args.metrics:
+        return None
+    request_metrics = metrics.Metrics(
+        args.slow_query_ms / 1000,
+        args.slow_query_log and open(args.slow_query_log, "a"))
+    request_metrics.install()
+    return request_metrics
+
+def create_client_budgets(args):
+    if not args.client_cost_rate:
+        return None
+    burst = args.client_cost_burst or 10 * args.client_cost_rate
+    return cost.ClientBudgets(args.client_cost_rate, burst)
+
+def create_replica(args):
+    if not args.replica:
+        return None
+    database_replica = replica.Replica(args.replica_lag)
+    atexit.register(database_replica.close)
+    database_replica.install()
+    database_replica.start()
+    return database_replica
+
+def create_service(args):
+    graphql.max_page_size = args.max_page_size
+    times.set_timezone(args.timezone)
+    request_metrics = create_metrics(args)
+    database_replica = create_replica(args)
+    if request_metrics is not None and database_replica is not None:
+        request_metrics.add_gauge(
+            "esportsapi_replica_lag_seconds", "Seconds since the replica "
+            "was last known to be up to date with the database file.",
+            database_replica.lag_seconds)
+    return service.Service(args.api, args.document_cache_size,
+                           args.response_cache_bytes, args.stream_chunk_size,
+                           args.persisted_queries, request_metrics,
+                           cost.QueryCosts(args.max_query_cost,
+                                           args.max_query_depth),
+                           create_client_budgets(args), database_replica,
+                           args.max_batch_size, args.compress_min_bytes)
+
+def create_asgi_app(api_service, args):
+    return asgi.AsgiApp(api_service, args.threads, args.max_pending,
+                        args.timeout)
+
+def create_app(api_service):
+    app = Flask(__name__)
+    app.config["MAX_CONTENT_LENGTH"] = asgi.max_body_bytes
+
+    def response(reply):
+        body = reply.body if isinstance(reply.body, bytes) \
+            else stream_with_context(reply.body)
+        return Response(body, reply.status, mimetype=reply.content_type,
+                        headers=list(reply.headers))
+
+    @app.route("/", methods=["GET", "POST"])
+    def index():
+        if request.method == "POST":
+            return response(api_service.handle_post(
+                "/", request.get_data(), request.remote_addr,
+                request.headers))
+        return response(api_service.handle("/", request.args,
+                                           request.remote_addr,
+                                           request.headers))
+
+    @app.route("/subscribe")
+    def subscribe():
+        return response(api_service.handle("/subscribe", request.args))
+
+    @app.route("/stats")
+    def stats():
+        return response(api_service.handle("/stats", request.args))
+
+    @app.route("/metrics")
+    def metrics():
+        return response(api_service.handle("/metrics", request.args))
+
+    request_metrics = api_service.metrics
+    if request_metrics is not None:
+        @app.before_request
+        def start_timing():
+            g.timing = request_metrics.start_request()
+
+        @app.after_request
+        def finish_timing(response):
+            # Streamed responses are only timed until they start.
+            timing = g.pop("timing", None)
+            if timing is not None:
+                request_metrics.finish_request(timing)
+                response.headers["Server-Timing"] = timing.server_timing()
+            return response
+
+        @app.teardown_request
+        def discard_timing(exception):
+            timing = g.pop("timing", None)
+            if timing is not None:
+                request_metrics.finish_request(timing)
+
+    return app
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="python3 -m esportsapi.main",
+        description='Give the argument `app` to run the "app API", ' +
+        'or `db` to run the "database API".')
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    check_arguments(parser, args)
+
+    # Get a fresh database on every restart to test more easily.
+    # Obviously this wouldn't work in a real app, use `esportsapi.serve`.
+    db.recreate_db()
+    db.load_example_data()
+    api_service = create_service(args)
+
+    if args.server == "asgi":
+        asgi.run(create_asgi_app(api_service, args))
     else:
-        return jsonify(result.data)
+        create_app(api_service).run(debug=True)
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    main(sys.argv[1:])
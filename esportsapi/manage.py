@@ -0,0 +1,77 @@
+import argparse
+import os
+import sys
+import time
+from . import db_functions as db
+
+def migrate(args):
+    if not os.path.exists(db.db_name):
+        sys.exit(f"{db.db_name} does not exist")
+    before = db.schema_version()
+    count = db.migrate()
+    print(f"Applied {count} migrations, from schema version {before} to "
+          f"{db.schema_version()}")
+
+def rebuild_match_read(args):
+    start = time.perf_counter()
+    count = db.rebuild_match_read()
+    print(f"Rebuilt match_read with {count} matches in "
+          f"{time.perf_counter() - start:.2f} s")
+
+def rebuild_search(args):
+    start = time.perf_counter()
+    db.rebuild_search()
+    print(f"Rebuilt the search indexes in {time.perf_counter() - start:.2f} s")
+
+def check_match_read(args):
+    wrong = db.check_match_read()
+    if wrong:
+        shown = ", ".join(map(str, wrong[:20]))
+        sys.exit(f"{len(wrong)} matches in match_read differ from the "
+                 f"normalized tables: {shown}"
+                 + (", ..." if len(wrong) > 20 else ""))
+    print("match_read is consistent with the normalized tables")
+
+def check_standings(args):
+    wrong = db.check_standings()
+    if wrong:
+        shown = ", ".join(f"{table} {tournament_id} {id}"
+                          for table, tournament_id, id in wrong[:20])
+        sys.exit(f"{len(wrong)} standings differ from match_read: {shown}"
+                 + (", ..." if len(wrong) > 20 else ""))
+    print("The standings are consistent with match_read")
+
+_commands = {"migrate": migrate,
+             "rebuild-match-read": rebuild_match_read,
+             "rebuild-search": rebuild_search,
+             "check-match-read": check_match_read,
+             "check-standings": check_standings}
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="python3 -m esportsapi.manage",
+        description="Maintenance of an existing database.")
+    parser.add_argument("--db", default=db.db_name,
+                        help=f"the database file, by default {db.db_name}")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("migrate",
+                          help="upgrade the database in place to the "
+                          "latest schema")
+    subparsers.add_parser("rebuild-match-read",
+                          help="rebuild match_read and the standings from "
+                          "the normalized tables")
+    subparsers.add_parser("rebuild-search",
+                          help="rebuild the search indexes from the names "
+                          "of players, teams and tournaments")
+    subparsers.add_parser("check-match-read",
+                          help="compare match_read with the normalized "
+                          "tables, and fail if they differ")
+    subparsers.add_parser("check-standings",
+                          help="compare the standings with match_read, and "
+                          "fail if they differ")
+    args = parser.parse_args(argv)
+    db.db_name = args.db
+    _commands[args.command](args)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,358 @@
+import bisect
+import collections
+import contextlib
+import json
+import sqlite3
+import sys
+import threading
+import time
+from . import db_functions as db
+
+# Per-request timing is only collected while `Metrics.install` is in effect.
+# Otherwise the hooks below find no current request and do nothing, and
+# connections and `_db_query` functions are not wrapped at all.
+
+_local = threading.local()
+
+def current():
+    """Returns the `Request` of the current thread, or None."""
+    return getattr(_local, "request", None)
+
+@contextlib.contextmanager
+def phase(name):
+    """Adds the time of the body to the phase `name` of the current
+    request."""
+    request = current()
+    if request is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        request.phases[name] += time.perf_counter() - start
+
+def bound(f):
+    """Returns `f`, but when there is a current request, wrapped so that it
+    belongs to the request also when it runs in another thread."""
+    request = current()
+    if request is None:
+        return f
+    def run(*args, **kwargs):
+        _local.request = request
+        try:
+            return f(*args, **kwargs)
+        finally:
+            _local.request = None
+    return run
+
+def set_operation(name):
+    request = current()
+    if request is not None:
+        request.operation = name
+
+def set_cost(cost):
+    request = current()
+    if request is not None:
+        request.cost = cost
+
+class _Statement:
+    __slots__ = ["sql", "parameters", "seconds"]
+
+    def __init__(self, sql, parameters):
+        self.sql = sql
+        self.parameters = parameters
+        self.seconds = 0.0
+
+class _Cursor(sqlite3.Cursor):
+    """A cursor that adds the time of executing and fetching to the
+    statements of the current `_db_query` call."""
+    _statement = None
+
+    def _timed(self, run, sql, parameters):
+        statements = getattr(_local, "statements", None)
+        if statements is None:
+            return run(sql, parameters)
+        self._statement = _Statement(sql, parameters)
+        statements.append(self._statement)
+        start = time.perf_counter()
+        try:
+            return run(sql, parameters)
+        finally:
+            self._statement.seconds += time.perf_counter() - start
+
+    def execute(self, sql, parameters=()):
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        # A list, so that the shape of the rows can be logged.
+        return self._timed(super().executemany, sql, list(seq_of_parameters))
+
+    def _fetch(self, fetch, *args):
+        statement = self._statement
+        if statement is None:
+            return fetch(*args)
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            statement.seconds += time.perf_counter() - start
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._fetch(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+    def __next__(self):
+        return self._fetch(super().__next__)
+
+class _Connection(sqlite3.Connection):
+    def cursor(self, factory=_Cursor):
+        return super().cursor(factory)
+
+    # Connection.execute does not call the execute method of the cursor.
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def _shape(value):
+    """Describes a bound parameter without its value. The JSON lists that
+    `_db_query` functions bind for IN (...) are shown with their length."""
+    if isinstance(value, str):
+        if value.startswith("["):
+            try:
+                return f"json[{len(json.loads(value))}]"
+            except ValueError:
+                pass
+        return f"str[{len(value)}]"
+    if isinstance(value, bytes):
+        return f"bytes[{len(value)}]"
+    return "null" if value is None else type(value).__name__
+
+def parameter_shapes(parameters):
+    if isinstance(parameters, list) and parameters and \
+       isinstance(parameters[0], (list, tuple, dict)):
+        # executemany
+        return f"{len(parameters)} x {parameter_shapes(parameters[0])}"
+    if isinstance(parameters, dict):
+        return {k: _shape(v) for k, v in parameters.items()}
+    return [_shape(v) for v in parameters]
+
+# Statements that are not counted as queries, although their time is.
+_transaction_control = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE")
+
+class Request:
+    """The timing of one request: the seconds spent in each phase, and the
+    calls, seconds and queries of each `_db_query` function."""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.operation = None
+        self.cost = None
+        self.phases = collections.defaultdict(float)
+        self.calls = {}
+
+    def add_call(self, name, seconds, queries):
+        calls = self.calls.get(name)
+        if calls is None:
+            calls = self.calls[name] = [0, 0.0, 0]
+        calls[0] += 1
+        calls[1] += seconds
+        calls[2] += queries
+        self.phases["sql"] += seconds
+
+    def server_timing(self):
+        """The timing as a Server-Timing header value, in milliseconds."""
+        entries = [f"{name};dur={seconds * 1000:.3f}"
+                   for name, seconds in self.phases.items()]
+        entries += [f'db.{name};dur={seconds * 1000:.3f};'
+                    f'desc="calls: {calls}, queries: {queries}"'
+                    for name, (calls, seconds, queries)
+                    in self.calls.items()]
+        if self.cost is not None:
+            entries.append(f'cost;desc="{self.cost} units"')
+        return ", ".join(entries)
+
+_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+            2.5, 5.0, 10.0]
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(_buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(_buckets, value)] += 1
+        self.sum += value
+
+def _labels(**labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+                         .replace("\n", "\\n")
+    return ",".join(f'{k}="{escape(v)}"' for k, v in labels.items())
+
+class Metrics:
+    """Collects the timing of requests and exports it in the Prometheus text
+    format. `_db_query` calls that take at least `slow_seconds` are written
+    to `slow_log`, a file, as JSON lines with their statements and the
+    shapes of their parameters.
+
+    Operation names come from clients, so only the first `max_operations`
+    names get their own series, and the rest are counted as "other"."""
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, slow_seconds=0.1, slow_log=None, max_operations=100):
+        self.slow_seconds = slow_seconds
+        self.slow_log = slow_log or sys.stderr
+        self.max_operations = max_operations
+        self.requests = collections.defaultdict(Histogram)
+        self.phases = collections.defaultdict(float)
+        self.calls = collections.defaultdict(Histogram)
+        self.queries = collections.defaultdict(int)
+        self.costs = collections.defaultdict(int)
+        self.slow_queries = 0
+        self.gauges = {}
+        self._lock = threading.Lock()
+        # Getters made by factories are named after the module variables
+        # that hold them.
+        self._names = {f: name for name, f in vars(db).items()
+                       if hasattr(f, "__wrapped__")}
+
+    def install(self):
+        """Starts timing `_db_query` functions and their statements, in every
+        thread. Open connections are reopened to time their statements."""
+        db.query_observer = self._observe
+        db.connection_factory = _Connection
+        db._reset_connections()
+
+    @staticmethod
+    def uninstall():
+        db.query_observer = None
+        db.connection_factory = sqlite3.Connection
+        db._reset_connections()
+
+    def _observe(self, function, call):
+        request = current()
+        if request is None or getattr(_local, "statements", None) is not None:
+            # Outside requests, or nested in another call that is timed.
+            return call()
+        name = self._names.get(function) or function.__name__
+        _local.statements = statements = []
+        start = time.perf_counter()
+        try:
+            return call()
+        finally:
+            _local.statements = None
+            seconds = time.perf_counter() - start
+            queries = sum(not s.sql.startswith(_transaction_control)
+                          for s in statements)
+            request.add_call(name, seconds, queries)
+            with self._lock:
+                self.calls[name].observe(seconds)
+                self.queries[name] += queries
+            if seconds >= self.slow_seconds:
+                self._log_slow(request, name, seconds, statements)
+
+    def _log_slow(self, request, name, seconds, statements):
+        entry = {"time": time.time(), "operation": request.operation,
+                 "function": name, "ms": round(seconds * 1000, 3),
+                 "statements": [
+                     {"sql": " ".join(s.sql.split()),
+                      "parameters": parameter_shapes(s.parameters),
+                      "ms": round(s.seconds * 1000, 3)}
+                     for s in statements]}
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            self.slow_queries += 1
+            self.slow_log.write(line)
+            self.slow_log.flush()
+
+    def add_gauge(self, name, help, f):
+        """Exports the value that `f` returns as the gauge `name`."""
+        self.gauges[name] = (help, f)
+
+    def start_request(self):
+        """Starts timing a request in the current thread."""
+        _local.request = request = Request()
+        return request
+
+    def finish_request(self, request):
+        """Stops timing `request` and adds it to the metrics."""
+        if current() is request:
+            _local.request = None
+        seconds = time.perf_counter() - request.start
+        with self._lock:
+            operation = request.operation or "none"
+            if operation not in self.requests and \
+               len(self.requests) >= self.max_operations:
+                operation = "other"
+            self.requests[operation].observe(seconds)
+            for name, phase_seconds in request.phases.items():
+                self.phases[operation, name] += phase_seconds
+            if request.cost is not None:
+                self.costs[operation] += request.cost
+
+    def timed(self, f):
+        """Returns `f` wrapped to run as one request."""
+        def run(*args, **kwargs):
+            request = self.start_request()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.finish_request(request)
+        return run
+
+    def _histogram(self, lines, name, help, histograms, label):
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+        for value, histogram in sorted(histograms.items()):
+            total = 0
+            for le, count in zip(_buckets + ["+Inf"], histogram.counts):
+                total += count
+                lines.append(f"{name}_bucket{{"
+                             f"{_labels(**{label: value, 'le': le})}}} "
+                             f"{total}")
+            labels = _labels(**{label: value})
+            lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"{name}_count{{{labels}}} {total}")
+
+    def export(self):
+        """Returns the metrics in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            self._histogram(lines, "esportsapi_request_duration_seconds",
+                            "Time to answer requests, by GraphQL operation "
+                            "name.", self.requests, "operation")
+            name = "esportsapi_request_phase_seconds_total"
+            lines += [f"# HELP {name} Time spent in parse, validate, "
+                      "resolve and sql, by operation name.",
+                      f"# TYPE {name} counter"]
+            lines += [f"{name}{{{_labels(operation=o, phase=p)}}} {seconds}"
+                      for (o, p), seconds in sorted(self.phases.items())]
+            name = "esportsapi_query_cost_units_total"
+            lines += [f"# HELP {name} Estimated cost of the queries that "
+                      "were run, by operation name.",
+                      f"# TYPE {name} counter"]
+            lines += [f"{name}{{{_labels(operation=o)}}} {units}"
+                      for o, units in sorted(self.costs.items())]
+            self._histogram(lines, "esportsapi_db_call_duration_seconds",
+                            "Time of database function calls in requests.",
+                            self.calls, "function")
+            name = "esportsapi_db_queries_total"
+            lines += [f"# HELP {name} SQL statements other than transaction "
+                      "control run by database functions in requests.",
+                      f"# TYPE {name} counter"]
+            lines += [f"{name}{{{_labels(function=f)}}} {count}"
+                      for f, count in sorted(self.queries.items())]
+            name = "esportsapi_slow_queries_total"
+            lines += [f"# HELP {name} Database function calls written to the "
+                      "slow query log.", f"# TYPE {name} counter",
+                      f"{name} {self.slow_queries}"]
+        for name, (help, f) in sorted(self.gauges.items()):
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge",
+                      f"{name} {f()}"]
+        return "\n".join(lines) + "\n"
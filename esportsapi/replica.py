@@ -0,0 +1,241 @@
+import contextlib
+import glob
+import itertools
+import os
+import pathlib
+import sqlite3
+import tempfile
+import threading
+import time
+import traceback
+from . import db_functions as db
+
+_names = itertools.count()
+_prefix = "esportsapi-replica-"
+
+def _default_directory():
+    # tmpfs, which is in memory, where there is one.
+    return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+def _remove(path):
+    for suffix in ["", "-wal", "-shm"]:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path + suffix)
+
+def remove_copies(pid, directory=None):
+    """Removes the copies of the process `pid`, which has exited."""
+    directory = directory or _default_directory()
+    for path in glob.glob(os.path.join(directory, f"{_prefix}{pid}-*.db")):
+        _remove(path)
+
+def _remove_stale(directory):
+    """Removes the copies of processes that have exited without removing
+    them."""
+    for path in glob.glob(os.path.join(directory, _prefix + "*.db")):
+        pid = int(os.path.basename(path)[len(_prefix):].split("-")[0])
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            _remove(path)
+        except PermissionError:
+            pass
+
+def _key_filter(key_column):
+    """The WHERE clause of the rows of the change_log entries of one table
+    and key column between :start and :end."""
+    if key_column is None:
+        return ""
+    columns = key_column.split(",")
+    values = "key_value" if len(columns) == 1 else \
+        ", ".join(f"key_value ->> {i}" for i in range(len(columns)))
+    return f"""WHERE ({key_column}) IN (
+                   SELECT {values} FROM source.change_log
+                   WHERE id > :start AND id <= :end
+                   AND table_name = :table AND key_column = :key_column)"""
+
+class Replica:
+    """A copy of the database file `db.db_name` in memory, which the
+    connections of this process read instead of the file after `install`.
+
+    The copy is made with the backup API, into a file in `directory`, by
+    default /dev/shm, which is memory. (sqlite's own in-memory databases
+    cannot hold a copy of a database in WAL mode, and cannot use WAL
+    themselves.) Then every `lag` seconds a thread copies again the rows of
+    the change_log entries that were written since the last refresh, with
+    the file attached read-only. Each refresh is one transaction, so reads
+    see the copy as it was after some commit to the file. When the
+    change_log no longer has every entry since the last refresh, or the file
+    has been replaced or has another schema version, the whole database is
+    copied again.
+
+    The copy is in WAL mode and memory mapped by the connections that read
+    it, so reads neither wait for the writers of the file nor for refreshes.
+    Changes to matches are passed on to `db` listeners, so subscriptions see
+    the writes of other processes."""
+    def __init__(self, lag=1.0, directory=None):
+        self.lag = lag
+        directory = directory or _default_directory()
+        _remove_stale(directory)
+        self.path = os.path.join(
+            directory, f"{_prefix}{os.getpid()}-{next(_names)}.db")
+        self._source_uri = pathlib.Path(db.db_name).absolute().as_uri() + \
+            "?mode=ro"
+        self._conn = sqlite3.connect(self.path, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute("PRAGMA busy_timeout = 5000;")
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.position = 0
+        self.schema_version = None
+        self.synced_at = None
+        self.copies = 0
+        self.refreshes = 0
+        self.changes = 0
+        self._copy()
+
+    def _source_inode(self):
+        return os.stat(db.db_name).st_ino
+
+    def _copy(self):
+        synced_at = time.time()
+        conn = self._conn
+        if "source" in [row[1] for row in
+                        conn.execute("PRAGMA database_list;")]:
+            conn.execute("DETACH DATABASE source;")
+        self.source_inode = self._source_inode()
+        with contextlib.closing(sqlite3.connect(self._source_uri,
+                                                uri=True)) as source:
+            source.backup(conn)
+        # The copy is lost with the process anyway.
+        conn.execute("PRAGMA journal_mode = WAL;")
+        conn.execute("PRAGMA synchronous = OFF;")
+        self.position = conn.execute(
+            "SELECT coalesce(max(id), 0) FROM change_log;").fetchone()[0]
+        self.schema_version = conn.execute(
+            "PRAGMA user_version;").fetchone()[0]
+        conn.execute("DELETE FROM change_log;")
+        conn.execute("ATTACH DATABASE ? AS source;", [self._source_uri])
+        self.synced_at = synced_at
+        self.copies += 1
+
+    def _apply(self, start, end):
+        """Copies the rows of the change_log entries after `start` up to
+        `end`, and returns the ids of the matches among them."""
+        conn = self._conn
+        keys = conn.execute("""SELECT DISTINCT table_name, key_column
+                               FROM source.change_log
+                               WHERE id > ? AND id <= ?;""",
+                            [start, end]).fetchall()
+        whole = {table for table, key_column in keys if key_column is None}
+        indexes = set(db._search_indexes.values())
+        for table, key_column in keys:
+            if table in indexes or \
+               (table in whole and key_column is not None):
+                continue
+            where = _key_filter(key_column)
+            args = {"start": start, "end": end, "table": table,
+                    "key_column": key_column}
+            # The search indexes have no rows of their own to copy. The
+            # copy indexes the names that it copies itself.
+            ids = [id for id, in conn.execute(
+                f"SELECT id FROM main.{table} {where};", args)] \
+                if table in db._search_indexes else None
+            if ids:
+                db._index_names(conn, table, ids, remove=True)
+            conn.execute(f"DELETE FROM main.{table} {where};", args)
+            conn.execute(f"""INSERT INTO main.{table}
+                             SELECT * FROM source.{table} {where};""", args)
+            if ids is not None:
+                ids = [id for id, in conn.execute(
+                    f"SELECT id FROM main.{table} {where};", args)]
+                db._index_names(conn, table, ids)
+        for index in indexes & whole:
+            conn.execute(f"INSERT INTO main.{index}({index}) "
+                         "VALUES ('rebuild');")
+        if not db._listeners:
+            return []
+        return [id for id, in conn.execute("""
+            SELECT DISTINCT key_value FROM source.change_log
+            WHERE id > ? AND id <= ? AND table_name = 'matches'
+            AND key_column = 'id';""", [start, end])]
+
+    def refresh(self):
+        """Brings the copy up to date with the file, and returns the number
+        of change_log entries that it applied."""
+        with self._lock:
+            synced_at = time.time()
+            conn = self._conn
+            start = self.position
+            if self._source_inode() != self.source_inode:
+                self._copy()
+                return 0
+            conn.execute("BEGIN;")
+            try:
+                schema_version = conn.execute(
+                    "PRAGMA source.user_version;").fetchone()[0]
+                first, end = conn.execute(
+                    """SELECT (SELECT min(id) FROM source.change_log),
+                              (SELECT coalesce(max(id), 0)
+                               FROM source.change_log);""").fetchone()
+                if schema_version != self.schema_version or end < start or \
+                   (end > start and first > start + 1):
+                    conn.execute("ROLLBACK;")
+                    self._copy()
+                    return 0
+                match_ids = self._apply(start, end) if end != start else []
+                conn.execute("COMMIT;")
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK;")
+                raise
+            self.position = end
+            self.synced_at = synced_at
+            self.refreshes += 1
+            self.changes += self.position - start
+        if match_ids:
+            db._notify([("matches", id) for id in match_ids])
+        return self.position - start
+
+    def lag_seconds(self):
+        """The seconds since the copy was last known to be up to date."""
+        return time.time() - self.synced_at
+
+    def _run(self):
+        while not self._stopped.wait(self.lag):
+            try:
+                self.refresh()
+            except Exception:
+                traceback.print_exc()
+
+    def start(self):
+        """Starts refreshing in a background thread."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="replica", daemon=True)
+                self._thread.start()
+
+    def install(self):
+        """Makes the connections of every thread read the copy."""
+        db.replica_path = self.path
+        db._reset_connections()
+
+    @staticmethod
+    def uninstall():
+        db.replica_path = None
+        db._reset_connections()
+
+    def close(self):
+        """Stops refreshing and removes the copy."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._conn.close()
+        _remove(self.path)
+
+    def stats(self):
+        with self._lock:
+            return {"lag": self.lag, "lag_seconds": self.lag_seconds(),
+                    "position": self.position, "copies": self.copies,
+                    "refreshes": self.refreshes, "changes": self.changes}
@@ -0,0 +1,124 @@
+import argparse
+import os
+import signal
+import socket
+import sqlite3
+import sys
+import time
+from werkzeug.serving import make_server
+from . import asgi
+from . import db_functions as db
+from . import main as app_main
+from . import replica
+
+def _parse_bind(bind):
+    host, _, port = bind.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+def _listen(host, port):
+    sock = socket.create_server((host, port), backlog=1024)
+    sock.set_inheritable(True)
+    return sock
+
+def _serve_worker(args, sock):
+    """Runs in each worker process, on the socket that all workers share."""
+    db.db_name = args.db
+    db.read_only = args.api == "app"
+    api_service = app_main.create_service(args)
+    host, port = sock.getsockname()[:2]
+    if args.server == "asgi":
+        asgi.run(app_main.create_asgi_app(api_service, args), fd=sock.fileno())
+    else:
+        server = make_server(host, port, app_main.create_app(api_service),
+                             threaded=True, fd=sock.fileno())
+        server.serve_forever()
+
+# Workers that die sooner than this after starting are not restarted, since
+# they would most likely die again.
+_min_lifetime = 5
+
+def _start_worker(args, sock):
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            _serve_worker(args, sock)
+        finally:
+            os._exit(1)
+    return pid, time.monotonic()
+
+def _stop(workers):
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in workers:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+        replica.remove_copies(pid)
+
+def serve(args):
+    """Forks `args.workers` worker processes that accept connections on one
+    listening socket, and restarts workers that die."""
+    db.db_name = args.db
+    db.create_or_migrate_db()
+    # Connections must not be shared with the forked workers.
+    db.close_connection()
+    # WAL lets readers run while the database is written. The connection
+    # stays open, so that the WAL files that read-only workers need exist.
+    keeper = sqlite3.connect(args.db)
+    keeper.execute("PRAGMA journal_mode = WAL;")
+    sock = _listen(*_parse_bind(args.bind))
+    print(f"Serving the {args.api} API on {args.bind} with {args.workers} "
+          f"worker(s)", file=sys.stderr)
+    workers = dict(_start_worker(args, sock) for _ in range(args.workers))
+    def shutdown(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, shutdown)
+    try:
+        while True:
+            pid, _ = os.wait()
+            if pid not in workers:
+                continue
+            # Workers killed by signals leave their replicas behind.
+            replica.remove_copies(pid)
+            if time.monotonic() - workers.pop(pid) < _min_lifetime:
+                sys.exit(f"Worker {pid} died right after starting, stopping")
+            pid, started = _start_worker(args, sock)
+            workers[pid] = started
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Stopping the workers must not be interrupted by another SIGTERM.
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        _stop(workers)
+        keeper.close()
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="python3 -m esportsapi.serve",
+        description="Serves the app API or the database API from a "
+        "persistent database, with several worker processes.")
+    app_main.add_arguments(parser)
+    parser.add_argument("--db", default=db.db_name,
+                        help="the database file, created if it does not exist")
+    parser.add_argument("--workers", type=int,
+                        help="the number of worker processes, by default one "
+                        "per core for the app API and one for the db API")
+    parser.add_argument("--bind", default="127.0.0.1:5000",
+                        help="the address to listen on, as HOST:PORT")
+    args = parser.parse_args(argv)
+    app_main.check_arguments(parser, args)
+    if args.workers is None:
+        args.workers = (os.cpu_count() or 1) if args.api == "app" else 1
+    if args.api == "db" and args.workers != 1:
+        parser.error("the db API is the only writer and runs in one process; "
+                     "serve reads from more processes with the app API")
+    serve(args)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,500 @@
+import collections
+import concurrent.futures
+import graphene as g
+from graphql.error import GraphQLError
+from graphql.execution.values import get_variable_values
+import gzip
+import hashlib
+import json
+import time
+from . import cache
+from . import cost as query_cost
+from . import documents
+from . import graphql
+from . import db_functions as db
+from . import metrics
+from . import subscriptions
+from . import times
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+http_ok = 200
+http_not_modified = 304
+http_bad_request = 400
+http_not_found = 404
+http_too_many_requests = 429
+
+# `body` is bytes, an iterator of str for streamed responses, or an
+# `EventStream` of bytes for subscriptions. `headers` are (name, value)
+# pairs.
+Reply = collections.namedtuple("Reply",
+                               ["status", "content_type", "body", "headers"],
+                               defaults=[()])
+
+json_type = "application/json"
+
+def _dumps(x):
+    return json.dumps(x, separators=(",", ":"))
+
+def json_reply(data, status=http_ok):
+    return Reply(status, json_type, (_dumps(data) + "\n").encode())
+
+def _error(errors):
+    return json_reply({"error": str(errors)}, http_bad_request)
+
+def _ndjson_lines(key, chunks):
+    try:
+        for chunk in chunks:
+            for match in chunk:
+                yield _dumps(match) + "\n"
+    except GraphQLError as e:
+        yield _dumps({"error": str(e)}) + "\n"
+
+def _json_parts(key, chunks):
+    yield '{' + _dumps(key) + ':['
+    separator = ""
+    try:
+        for chunk in chunks:
+            for match in chunk:
+                yield separator + _dumps(match)
+                separator = ","
+    except GraphQLError as e:
+        yield '],"error":' + _dumps(str(e)) + '}\n'
+        return
+    yield ']}\n'
+
+_stream_formats = {"ndjson": (_ndjson_lines, "application/x-ndjson"),
+                   "json": (_json_parts, json_type)}
+
+def _json_arg(args, name):
+    """Returns the JSON object argument `name`, which GET requests give as a
+    JSON string, or {}."""
+    value = args.get(name)
+    if isinstance(value, str):
+        value = json.loads(value) if value else None
+    if value is not None and not isinstance(value, dict):
+        raise ValueError(f"`{name}` must be a JSON object")
+    return value or {}
+
+def _string_arg(args, name):
+    """Returns the string argument `name`, or None."""
+    value = args.get(name)
+    if value is not None and not isinstance(value, str):
+        raise ValueError(f"`{name}` must be a string")
+    return value
+
+def _etags(if_none_match):
+    """The entity tags of an If-None-Match header, without quotes."""
+    return {tag.strip().removeprefix("W/").strip('"')
+            for tag in if_none_match.split(",")}
+
+def _accepted_encoding(accept_encoding):
+    """The content encoding to compress with, brotli if it is installed,
+    or None."""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        q = params.strip().removeprefix("q=")
+        try:
+            accepted[coding.strip().lower()] = float(q) if q else 1.0
+        except ValueError:
+            pass
+    for coding in ["br", "gzip"]:
+        if accepted.get(coding, accepted.get("*", 0)) > 0 and \
+           (coding != "br" or brotli is not None):
+            return coding
+    return None
+
+_compressors = {"gzip": lambda body: gzip.compress(body, compresslevel=6),
+                "br": lambda body: brotli.compress(body, quality=5)}
+
+# The operation of a request: its document, the name of the operation to
+# run, which is needed when the document has several, and its variables,
+# both as given and as values of their types.
+Operation = collections.namedtuple(
+    "Operation", ["document", "name", "variables", "values"])
+
+class Service:
+    """Answers the GraphQL requests of one API ("app" or "db"), independent
+    of the web server. `handle` blocks on the database, so asynchronous
+    servers must call it from a thread. Mutations all run in one writer
+    thread, one at a time, while queries run in the calling threads."""
+    def __init__(self, api, document_cache_size=1000,
+                 response_cache_bytes=64 * 2**20, stream_chunk_size=500,
+                 persisted_queries_file=None, request_metrics=None,
+                 query_costs=None, client_budgets=None, replica=None,
+                 max_batch_size=20, compress_min_bytes=1024):
+        self.api = api
+        self.max_batch_size = max_batch_size
+        self.compress_min_bytes = compress_min_bytes
+        self.metrics = request_metrics
+        self.replica = replica
+        self.query_costs = query_costs
+        self.client_budgets = client_budgets
+        if api == "app":
+            self.schema = g.Schema(query=graphql.Query,
+                                   subscription=graphql.Subscription)
+        else:
+            self.schema = g.Schema(query=graphql.Query,
+                                   mutation=graphql.Mutation,
+                                   subscription=graphql.Subscription)
+        self.document_cache = documents.DocumentCache(self.schema,
+                                                      document_cache_size)
+        self.persisted_queries = documents.PersistedQueries()
+        self.response_cache = cache.ResponseCache(response_cache_bytes) \
+            if response_cache_bytes > 0 else None
+        self.stream_chunk_size = stream_chunk_size
+        self.writer = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix="writer") if api == "db" else None
+        self.hub = subscriptions.Hub()
+        if persisted_queries_file:
+            self.persisted_queries.load(persisted_queries_file)
+
+    def _request_query(self, args):
+        """Returns the query of the request, which is either given in
+        `query`, or as a persisted query hash in `extensions`, in the same
+        way as Apollo's automatic persisted queries, and whether it is to be
+        registered as a persisted query."""
+        query = _string_arg(args, "query")
+        extensions = _json_arg(args, "extensions")
+        persisted = extensions.get("persistedQuery")
+        if persisted is None:
+            return query, False
+        if not isinstance(persisted, dict) or \
+           not isinstance(persisted.get("sha256Hash"), str):
+            raise ValueError("extensions.persistedQuery.sha256Hash must be a "
+                             "string")
+        return (self.persisted_queries.resolve(persisted["sha256Hash"],
+                                               query),
+                query is not None)
+
+    def _execute(self, operation, cost=None):
+        start = time.perf_counter()
+        with metrics.phase("resolve"):
+            result = self.document_cache.execute_document(
+                operation.document, context_value=graphql.Context(),
+                variable_values=operation.variables,
+                operation_name=operation.name)
+        if cost is not None:
+            self.query_costs.record(cost, time.perf_counter() - start)
+        return result
+
+    def _key(self, operation):
+        return (self.api, operation.document.text, operation.name,
+                json.dumps(operation.variables, sort_keys=True))
+
+    def _etag(self, key, tables, versions):
+        """A strong ETag of the answer to a query, from the query and the
+        versions of the tables that it reads (and the timezone of its
+        dates), so it is the same until one of the tables is written."""
+        snapshot = [(t, versions.get(t)) for t in sorted(tables)]
+        data = json.dumps([key, str(times.timezone()), snapshot])
+        return '"' + hashlib.blake2b(data.encode(),
+                                     digest_size=16).hexdigest() + '"'
+
+    @staticmethod
+    def _tables_read(operation, versions):
+        """The tables that a query reads, or every table if that is not
+        known."""
+        tables = graphql.tables_read(operation.document.ast, operation.name)
+        return list(versions) if tables is None else tables
+
+    def _not_modified(self, operation, if_none_match, accept_encoding):
+        """Returns a 304 `Reply` if the client already has the current
+        answer to a query, without executing it, and otherwise None. The
+        client has it in the encoding that it accepts, as `_compress` would
+        send it, or, when the answer is too small to be compressed or the
+        client accepts no encoding, as it is."""
+        versions = db.get_data_versions()
+        etag = self._etag(self._key(operation),
+                          self._tables_read(operation, versions), versions)
+        tags = _etags(if_none_match)
+        encoding = self.compress_min_bytes and \
+            _accepted_encoding(accept_encoding or "")
+        encoded = f'{etag[:-1]}-{encoding}"'
+        if encoding and encoded.strip('"') in tags:
+            return Reply(http_not_modified, json_type, b"",
+                         [("Vary", "Accept-Encoding"), ("ETag", encoded)])
+        if etag.strip('"') in tags or "*" in tags:
+            return Reply(http_not_modified, json_type, b"", [("ETag", etag)])
+        return None
+
+    def _cached_reply(self, operation, cost):
+        """Answers read queries, from the response cache if there is one,
+        with an ETag. The table versions are read in the same transaction as
+        the query, so neither an entry nor an ETag can ever be newer than
+        the versions it is computed from."""
+        key = self._key(operation)
+        with db.transaction():
+            versions = db.get_data_versions()
+            tables = self._tables_read(operation, versions)
+            body = self.response_cache and self.response_cache.get(key,
+                                                                   versions)
+            if body is None:
+                result = self._execute(operation, cost)
+                if result.errors:
+                    return _error(result.errors)
+                body = json_reply(result.data).body
+                if self.response_cache is not None:
+                    self.response_cache.put(key, versions, tables, body)
+        return Reply(http_ok, json_type, body,
+                     [("ETag", self._etag(key, tables, versions))])
+
+    def _compress(self, reply, accept_encoding):
+        """Compresses JSON bodies of at least `compress_min_bytes` in an
+        encoding that the client accepts. Compressed bodies with an ETag are
+        cached, since the ETag stands for the exact bytes."""
+        if not self.compress_min_bytes or reply.status != http_ok or \
+           not isinstance(reply.body, bytes) or \
+           len(reply.body) < self.compress_min_bytes:
+            return reply
+        headers = [("Vary", "Accept-Encoding")]
+        encoding = _accepted_encoding(accept_encoding or "")
+        if encoding is None:
+            return reply._replace(headers=list(reply.headers) + headers)
+        etag = dict(reply.headers).get("ETag")
+        key = etag and ("compressed", etag, encoding)
+        body = None
+        if key and self.response_cache is not None:
+            body = self.response_cache.get(key, {})
+        if body is None:
+            with metrics.phase("compress"):
+                body = _compressors[encoding](reply.body)
+            if key and self.response_cache is not None:
+                self.response_cache.put(key, {}, [], body)
+        headers += [(name, value) for name, value in reply.headers
+                    if name != "ETag"]
+        headers.append(("Content-Encoding", encoding))
+        if etag:
+            # Each encoding is a different representation.
+            headers.append(("ETag", f'{etag[:-1]}-{encoding}"'))
+        return reply._replace(body=body, headers=headers)
+
+    def _stream_reply(self, operation, format):
+        """Writes the matches of the query to the response as they are read,
+        either as one JSON document or as one JSON object per line."""
+        if format not in _stream_formats:
+            return _error([f"Unknown stream format {format}"])
+        try:
+            key, chunks = graphql.stream_matches(
+                operation.document.ast, operation.values,
+                chunk_size=self.stream_chunk_size)
+        except GraphQLError as e:
+            return _error([e])
+        parts, content_type = _stream_formats[format]
+        return Reply(http_ok, content_type, parts(key, chunks))
+
+    def _document(self, args):
+        """Returns the validated document of a request, or an error
+        `Reply`."""
+        try:
+            query, register = self._request_query(args)
+        except (ValueError, documents.PersistedQueryError) as e:
+            return json_reply({"error": str(e)}, http_bad_request)
+        if query is None:
+            return _error(["Must provide query"])
+        document = self.document_cache.get(query)
+        if document.errors:
+            return _error(document.errors)
+        if register:
+            self.persisted_queries.register(query)
+        return document
+
+    def _operation(self, args):
+        """Returns the `Operation` of a request, or an error `Reply`."""
+        document = self._document(args)
+        if isinstance(document, Reply):
+            return document
+        try:
+            name = _string_arg(args, "operationName") or None
+        except ValueError as e:
+            return _error([e])
+        definition = documents.get_operation(document.ast, name)
+        if definition is None:
+            return _error([f"Unknown operation named {name}" if name else
+                           "Give the operationName of the operation to run"])
+        try:
+            variables = _json_arg(args, "variables")
+            values = get_variable_values(
+                self.schema, definition.variable_definitions or [],
+                variables)
+        except (GraphQLError, ValueError, TypeError) as e:
+            return _error([e])
+        if self.metrics is not None:
+            metrics.set_operation(documents.operation_name(document, name))
+        return Operation(document, name, variables, values)
+
+    def subscribe(self, args):
+        """Answers a subscription request with an `EventStream`."""
+        operation = self._operation(args)
+        if isinstance(operation, Reply):
+            return operation
+        try:
+            subscriber = self.hub.subscribe(operation.document,
+                                            operation.values)
+        except GraphQLError as e:
+            return _error([e])
+        self.hub.start()
+        return Reply(http_ok, "text/event-stream",
+                     subscriptions.EventStream(subscriber))
+
+    def _cost(self, operation, args, client):
+        """Returns the estimated cost of an operation, or an error `Reply` if
+        it is over the limits or `client` is over its budget."""
+        if self.query_costs is None:
+            return None
+        try:
+            cost = self.query_costs.check(
+                self.schema, operation.document, "stream" not in args,
+                operation.values, operation.name)
+        except query_cost.QueryCostError as e:
+            return json_reply({"error": str(e)}, http_bad_request)
+        except (ValueError, TypeError) as e:
+            # Arguments that the estimate cannot use would fail the query.
+            return _error([f"Cannot estimate the cost of the query: {e}"])
+        if self.metrics is not None:
+            metrics.set_cost(cost)
+        if self.client_budgets is not None and client is not None:
+            wait = self.client_budgets.spend(client, cost)
+            if wait > 0:
+                return json_reply({"error": "The query cost budget of the "
+                                   "client is used up",
+                                   "retry_after": round(wait, 3)},
+                                  http_too_many_requests)
+        return cost
+
+    def _prepare(self, args, client, headers=None):
+        """Returns the `Operation` of a request, its type and its estimated
+        cost, or an error `Reply`, or a 304 `Reply` for a query whose answer
+        still has an ETag in the If-None-Match of the request `headers`."""
+        headers = headers or {}
+        operation = self._operation(args)
+        if isinstance(operation, Reply):
+            return operation
+        operation_type = documents.operation_type(operation.document,
+                                                  operation.name)
+        if operation_type == "subscription":
+            return _error(["Subscriptions are served at /subscribe"])
+        if headers.get("if-none-match") and operation_type == "query" and \
+           "stream" not in args:
+            reply = self._not_modified(operation, headers["if-none-match"],
+                                       headers.get("accept-encoding"))
+            if reply is not None:
+                return reply
+        cost = self._cost(operation, args, client)
+        if isinstance(cost, Reply):
+            return cost
+        return operation, operation_type, cost
+
+    def _answer(self, operation, operation_type, cost, in_writer=False):
+        """Executes a prepared operation. Mutations run in the writer
+        thread, unless `in_writer` says that this is it."""
+        if operation_type == "query" and not in_writer:
+            return self._cached_reply(operation, cost)
+        if self.writer is not None and operation_type == "mutation" and \
+           not in_writer:
+            result = self.writer.submit(metrics.bound(self._execute),
+                                        operation, cost).result()
+        else:
+            result = self._execute(operation, cost)
+        if result.errors:
+            return _error(result.errors)
+        return json_reply(result.data)
+
+    def query(self, args, client=None, headers=None):
+        """Answers a GraphQL request with the arguments `args`: `query`,
+        `variables`, `operationName` and `extensions`, and `stream`.
+        `client` identifies the client for its query cost budget, and
+        `headers` are the request headers, for conditional requests."""
+        prepared = self._prepare(args, client, headers)
+        if isinstance(prepared, Reply):
+            return prepared
+        operation, _, _ = prepared
+        if "stream" in args:
+            return self._stream_reply(operation, args["stream"])
+        return self._answer(*prepared)
+
+    def query_batch(self, batch, client=None):
+        """Answers a list of GraphQL requests with a JSON list of their
+        answers, in order. They run in one transaction, so that they all
+        read the same snapshot of the database. A batch with mutations runs
+        in the writer thread, where later operations see the writes of
+        earlier ones, and does not use the response cache, since its reads
+        are not committed yet."""
+        if not 0 < len(batch) <= self.max_batch_size:
+            return _error([f"A batch must have between 1 and "
+                           f"{self.max_batch_size} operations"])
+        prepared = []
+        for args in batch:
+            if not isinstance(args, dict):
+                prepared.append(_error(["Each operation of a batch must be "
+                                        "a JSON object"]))
+            elif "stream" in args:
+                prepared.append(_error(["Streams cannot be batched"]))
+            else:
+                prepared.append(self._prepare(args, client))
+        if self.metrics is not None:
+            metrics.set_operation("batch")
+            metrics.set_cost(sum(p[2] or 0 for p in prepared
+                                 if not isinstance(p, Reply)))
+        in_writer = self.writer is not None and any(
+            not isinstance(p, Reply) and p[1] == "mutation"
+            for p in prepared)
+        def run():
+            with db.transaction():
+                return [p if isinstance(p, Reply) else
+                        self._answer(*p, in_writer=in_writer)
+                        for p in prepared]
+        replies = self.writer.submit(metrics.bound(run)).result() \
+            if in_writer else run()
+        return Reply(http_ok, json_type,
+                     b"[" + b",".join(reply.body.rstrip(b"\n")
+                                      for reply in replies) + b"]\n")
+
+    def stats(self):
+        return {"documents": self.document_cache.stats(),
+                "persisted_queries": self.persisted_queries.stats(),
+                "responses": self.response_cache and
+                self.response_cache.stats(),
+                "subscriptions": self.hub.stats(),
+                "costs": self.query_costs and self.query_costs.stats(),
+                "budgets": self.client_budgets and
+                self.client_budgets.stats(),
+                "replica": self.replica and self.replica.stats()}
+
+    def handle_post(self, path, body, client=None, headers=None):
+        """Returns the `Reply` to a POST request, whose body is the JSON of
+        the arguments of one request (see `query`), or a list of them (see
+        `query_batch`)."""
+        if path != "/":
+            return json_reply({"error": "Not found"}, http_not_found)
+        try:
+            request = json.loads(body)
+        except ValueError:
+            return _error(["The body must be JSON"])
+        if isinstance(request, list):
+            reply = self.query_batch(request, client)
+        elif isinstance(request, dict):
+            reply = self.query(request, client)
+        else:
+            return _error(["The body must be a JSON object or list"])
+        return self._compress(reply, (headers or {}).get("accept-encoding"))
+
+    def handle(self, path, args, client=None, headers=None):
+        """Returns the `Reply` to a GET request. `headers` are the request
+        headers, looked up by lowercase names."""
+        headers = headers or {}
+        if path == "/":
+            return self._compress(self.query(args, client, headers),
+                                  headers.get("accept-encoding"))
+        if path == "/subscribe":
+            return self.subscribe(args)
+        if path == "/stats":
+            return json_reply(self.stats())
+        if path == "/metrics" and self.metrics is not None:
+            return Reply(http_ok, self.metrics.content_type,
+                         self.metrics.export().encode())
+        return json_reply({"error": "Not found"}, http_not_found)
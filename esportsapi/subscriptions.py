@@ -0,0 +1,210 @@
+import collections
+import json
+import threading
+import time
+import traceback
+from . import db_functions as db
+from . import graphql
+
+keepalive = b": keepalive\n\n"
+
+def _event(data):
+    # A Server-Sent Event. JSON has no raw newlines, so one data line is
+    # enough.
+    return b"data: " + json.dumps(data, separators=(",", ":")).encode() + \
+        b"\n\n"
+
+class Subscriber:
+    """The queue of events of one client. A newer event about a match
+    replaces an older one that the client has not taken yet, so slow clients
+    get the latest state of each match instead of a growing backlog.
+
+    `wake` is called whenever an event arrives. By default it sets an event
+    that `wait` waits for, but asynchronous servers can replace it."""
+    def __init__(self, hub, group):
+        self._hub = hub
+        self.group = group
+        self._events = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._arrived = threading.Event()
+        self.wake = self._arrived.set
+
+    def push(self, match_id, event):
+        with self._lock:
+            self._events.pop(match_id, None)
+            self._events[match_id] = event
+        self.wake()
+
+    def take(self):
+        with self._lock:
+            events = list(self._events.values())
+            self._events.clear()
+        return events
+
+    def wait(self, timeout=None):
+        """Waits at most `timeout` seconds for events and takes them."""
+        self._arrived.wait(timeout)
+        self._arrived.clear()
+        return self.take()
+
+    def close(self):
+        self._hub.unsubscribe(self)
+
+class _Group:
+    """The subscribers of the same subscription, with the same variables,
+    which get the very same event bytes."""
+    def __init__(self, key, field, filters):
+        self.key = key
+        self.field = field
+        self.filters = filters
+        self.subscribers = set()
+
+class Hub:
+    """Publishes changes to matches to the subscribers of `matchUpdated`.
+
+    Committed inserts and updates of matches are collected, and at most
+    every `interval` seconds the changed matches are fetched and resolved
+    once per group of subscribers with the same subscription. Each event is
+    serialized once and shared by the whole group, so the cost of an update
+    grows with the number of different subscriptions rather than the number
+    of subscribers. Changes to a match within an interval are coalesced into
+    one event.
+
+    Only changes made in this process, or copied into its replica (see
+    `replica.Replica`), are seen."""
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self._groups = {}
+        self._changed = set()
+        self._lock = threading.Lock()
+        self._has_changes = threading.Event()
+        self._thread = None
+        self._listening = False
+        self.published = 0
+        self.events = 0
+
+    def _on_commit(self, table, ids):
+        if table == "matches":
+            with self._lock:
+                self._changed.update(ids)
+                self.published += len(ids)
+            self._has_changes.set()
+
+    def start(self):
+        """Starts publishing in a background thread."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="subscriptions",
+                                                daemon=True)
+                self._thread.start()
+
+    def close(self):
+        with self._lock:
+            if self._listening:
+                db.remove_listener(self._on_commit)
+                self._listening = False
+
+    def subscribe(self, document, variables=None):
+        """Returns a `Subscriber` for a validated subscription document.
+        Raises GraphQLError if it is not a `matchUpdated` subscription."""
+        field, filters = graphql.match_subscription(document.ast, variables)
+        key = (document.text, json.dumps(variables, sort_keys=True))
+        with self._lock:
+            if not self._listening:
+                db.add_listener(self._on_commit)
+                self._listening = True
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = _Group(key, field, filters)
+            subscriber = Subscriber(self, group)
+            group.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            group = subscriber.group
+            group.subscribers.discard(subscriber)
+            if not group.subscribers and \
+               self._groups.get(group.key) is group:
+                del self._groups[group.key]
+
+    def _run(self):
+        while True:
+            self._has_changes.wait()
+            # Let more changes arrive, so that they are published together.
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    def flush(self):
+        """Publishes the changes collected so far."""
+        with self._lock:
+            self._has_changes.clear()
+            changed, self._changed = self._changed, set()
+            groups = list(self._groups.values())
+        if changed and groups:
+            self._publish(sorted(changed), groups)
+
+    def _publish(self, ids, groups):
+        tournament_ids = None
+        if any("tournament_id" in group.filters for group in groups):
+            tournament_ids = {id: match["tournament_id"] for id, match in
+                              db.get_matches(ids, {"tournament_id": {}})
+                              .items()}
+        # Groups that select the same fields share the fetched records.
+        records = {}
+        for group in groups:
+            if "ids" in group.filters:
+                wanted = set(group.filters["ids"])
+                matching = [id for id in ids if id in wanted]
+            elif "tournament_id" in group.filters:
+                tournament_id = group.filters["tournament_id"]
+                matching = [id for id in ids
+                            if tournament_ids.get(id) == tournament_id]
+            else:
+                matching = ids
+            if not matching:
+                continue
+            plan_key = json.dumps(group.field.plan, sort_keys=True)
+            if plan_key not in records:
+                records[plan_key] = db.get_matches(ids, group.field.plan)
+            matches = [records[plan_key][id] for id in matching
+                       if id in records[plan_key]]
+            results = graphql.resolve_matches(group.field, matches)
+            for match, result in zip(matches, results):
+                event = _event({"data": {group.field.key: result}})
+                self.events += 1
+                with self._lock:
+                    subscribers = list(group.subscribers)
+                for subscriber in subscribers:
+                    subscriber.push(match["id"], event)
+
+    def stats(self):
+        with self._lock:
+            return {"groups": len(self._groups),
+                    "subscribers": sum(len(group.subscribers)
+                                       for group in self._groups.values()),
+                    "published": self.published, "events": self.events}
+
+class EventStream:
+    """The events of a subscriber as a Server-Sent Events response body.
+    Iterating blocks, and sends a comment every `keepalive_interval` seconds
+    so that closed connections are noticed."""
+    def __init__(self, subscriber, keepalive_interval=15):
+        self.subscriber = subscriber
+        self.keepalive_interval = keepalive_interval
+
+    def __iter__(self):
+        try:
+            yield keepalive
+            while True:
+                yield from self.subscriber.wait(self.keepalive_interval) \
+                    or [keepalive]
+        finally:
+            self.close()
+
+    def close(self):
+        self.subscriber.close()
@@ -1,14 +1,64 @@
+import asyncio
 import datetime as dt
 import graphene as g
+from graphql.error import GraphQLError
+import gzip
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import threading
 import unittest as ut
+import urllib.parse
+from .. import asgi
+from .. import benchmarks
+from .. import bulk_load
+from .. import cache
+from .. import cost
 from .. import db_functions as db
+from .. import documents
 from .. import graphql as ql
+from .. import main
+from .. import metrics
+from .. import replica
+from .. import service
+from .. import subscriptions
+from .. import times
 from .. import utils as u
 
+# The expected dates below are in this timezone.
+times.set_timezone("Europe/Stockholm")
+
 int_time = 1587852000
 string_time_short = "2020-04-26"
 string_time = string_time_short + " 00:00:00"
 
+def traced_selects(f, *args, **kwargs):
+    """Calls `f` and returns its result and the SELECT statements it ran."""
+    statements = []
+    with db.transaction() as conn:
+        conn.set_trace_callback(statements.append)
+        try:
+            result = f(*args, **kwargs)
+        finally:
+            conn.set_trace_callback(None)
+    return result, [s for s in statements if s.lstrip().startswith("SELECT")]
+
+async def asgi_request(app, path, query_string=b"", method="GET", body=b"",
+                       headers=()):
+    """Returns the status, headers and body of a request to an ASGI app."""
+    messages = []
+    async def receive():
+        return {"type": "http.request", "body": body}
+    async def send(message):
+        messages.append(message)
+    await app({"type": "http", "method": method, "path": path,
+               "query_string": query_string, "headers": list(headers)},
+              receive, send)
+    return (messages[0]["status"], dict(messages[0]["headers"]),
+            b"".join(m.get("body", b"") for m in messages[1:]))
+
 class TestDBFunctions(ut.TestCase):
     def setUp(self):
         db.recreate_db()
@@ -34,6 +84,102 @@ class TestDBFunctions(ut.TestCase):
         self.assertEqual(start_of_day_str, "2020-03-29 00:00:00")
         self.assertEqual(next_day_str, "2020-03-30 00:00:00")
 
+    def test_times(self):
+        self.assertEqual(times.to_int("2020-04-26T00:00:00Z"), int_time + 7200)
+        self.assertEqual(times.to_int("26 April 2020"), int_time)
+        self.assertEqual(times.to_int(dt.date(2020, 4, 26)), int_time)
+        # The last day of summer time is 25 hours long.
+        start, end = times.day_bounds("2020-10-25 23:00")
+        self.assertEqual(end - start, 25 * 3600)
+        column = [start + h * 3600 for h in range(25)] + [None]
+        self.assertEqual(times.to_datetimes(column),
+                         [dt.datetime.fromtimestamp(t, times.timezone())
+                          .replace(tzinfo=None) if t else None
+                          for t in column])
+        try:
+            times.set_timezone("UTC")
+            self.assertEqual(times.to_string(int_time), "2020-04-25 22:00:00")
+            self.assertEqual(times.day_bounds(int_time),
+                             (int_time - 86400 + 7200, int_time + 7200))
+        finally:
+            times.set_timezone("Europe/Stockholm")
+
+    def test_connections(self):
+        conn = db.connection()
+        db.insert_game("QuakeLive")
+        self.assertIs(db.connection(), conn)
+        self.assertEqual(conn.execute("PRAGMA journal_mode;").fetchone(),
+                         ("wal",))
+        self.assertEqual(conn.execute("PRAGMA foreign_keys;").fetchone(),
+                         (1,))
+        db.recreate_db()
+        self.assertIsNot(db.connection(), conn)
+
+    def test_connection_pool(self):
+        connections = []
+        def request():
+            # Like the threads of Werkzeug's threaded server.
+            db.get_game_ids(["QuakeLive"])
+            with db.checked_out() as conn:
+                connections.append(conn)
+        for _ in range(5):
+            thread = threading.Thread(target=request)
+            thread.start()
+            thread.join()
+        self.assertEqual(len({id(conn) for conn in connections}), 1)
+        # Threads that run at the same time get their own connections, and
+        # at most `pool_size` idle ones are kept.
+        held = threading.Barrier(4)
+        def hold():
+            with db.checked_out() as conn:
+                connections.append(conn)
+                held.wait()
+                held.wait()
+        try:
+            db.pool_size = 2
+            threads = [threading.Thread(target=hold) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            held.wait()
+            held.wait()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len({id(conn) for conn in connections}), 3)
+            self.assertEqual(len(db._pool), 2)
+        finally:
+            db.pool_size = 16
+
+    def test_read_only(self):
+        db.insert_game("QuakeLive")
+        try:
+            db.read_only = True
+            db._reset_connections()
+            self.assertEqual(db.get_game_ids(["QuakeLive"]), {"QuakeLive": 1})
+            with self.assertRaises(sqlite3.OperationalError):
+                db.insert_game("DOTA 2")
+        finally:
+            db.read_only = False
+            db._reset_connections()
+        # Importing the server module must not touch the database.
+        from .. import main
+        self.assertEqual(db.get_game_ids(["QuakeLive"]), {"QuakeLive": 1})
+
+    def test_transactions(self):
+        def count_games():
+            return db.connection().execute(
+                "SELECT COUNT(*) FROM games;").fetchone()[0]
+        with self.assertRaises(sqlite3.IntegrityError):
+            with db.transaction():
+                db.insert_game("QuakeLive")
+                db.insert_game("QuakeLive")
+        self.assertEqual(count_games(), 0)
+        with db.transaction():
+            db.insert_game("QuakeLive")
+            with self.assertRaises(sqlite3.IntegrityError):
+                db.insert_game("QuakeLive")
+            db.insert_game("DOTA 2")
+        self.assertEqual(count_games(), 2)
+
     def test_matches(self):
         team_name = "SK Telecom"
         team_id = db.insert_team(team_name)
@@ -89,6 +235,232 @@ class TestDBFunctions(ut.TestCase):
         self.assertEqual(db.get_matches_on_day(int_time), expected_result)
         self.assertEqual(db.get_matches_on_day(0), {})
 
+    def test_match_query_count(self):
+        game_id = db.insert_game("StarCraft: Brood War")
+        player_ids = [db.insert_player({"name": name, "game_ids": [game_id]})
+                      for name in ["Flash", "Jaedong", "Bisu", "Stork"]]
+        def count_selects():
+            matches, selects = traced_selects(db.get_matches_between, 0, 2e9)
+            return len(matches), len(selects)
+        def insert_matches(n):
+            for i in range(n):
+                db.insert_match({"date": int_time + i, "game_id": game_id,
+                                 "teams": [player_ids[i % 2::2],
+                                           player_ids[1 - i % 2::2]]})
+        insert_matches(1)
+        self.assertEqual(count_selects(), (1, 1))
+        insert_matches(20)
+        self.assertEqual(count_selects(), (21, 1))
+
+    def test_pages(self):
+        player_ids = [db.insert_player({"name": name})
+                      for name in ["Flash", "Jaedong", "Bisu", "Stork"]]
+        # Inserted out of date order, and with several rows per match.
+        dates = [int_time + d for d in [3, 1, 2, 1, 0]]
+        match_ids = [db.insert_match({"date": date,
+                                      "teams": [player_ids[:2],
+                                                player_ids[2:]]})
+                     for date in dates]
+        order = [5, 2, 4, 3, 1]
+        after = None
+        pages = []
+        while True:
+            page, has_next = db.get_matches_page({}, 2, after)
+            pages.append([match["id"] for _, match in page])
+            for _, match in page:
+                self.assertEqual(len(match["teams"][0]), 2)
+            if not has_next:
+                break
+            after = page[-1][0]
+        self.assertEqual(pages, [order[:2], order[2:4], order[4:]])
+        page, has_next = db.get_matches_page(
+            {"between": (int_time + 1, int_time + 3)}, 10, None, {})
+        self.assertEqual(page, [((int_time + 1, 2), {"id": 2}),
+                                ((int_time + 1, 4), {"id": 4}),
+                                ((int_time + 2, 3), {"id": 3})])
+        self.assertFalse(has_next)
+        page, has_next = db.get_players_page({"names": ["Bisu", "Flash"]},
+                                             1, None, {"name": {}})
+        self.assertEqual(page, [((1,), {"id": 1, "name": "Flash"})])
+        self.assertTrue(has_next)
+        page, has_next = db.get_players_page({"names": ["Bisu", "Flash"]},
+                                             1, (1,), {"name": {}})
+        self.assertEqual(page, [((3,), {"id": 3, "name": "Bisu"})])
+        self.assertFalse(has_next)
+
+    def test_iter_matches(self):
+        player_ids = [db.insert_player({"name": name})
+                      for name in ["Flash", "Jaedong", "Bisu", "Stork"]]
+        for date in [3, 1, 2, 1, 0]:
+            db.insert_match({"date": int_time + date,
+                             "teams": [player_ids[:2], player_ids[2:]]})
+        chunks = list(db.iter_matches({}, chunk_size=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        matches = db.get_matches_between(0, 2e9)
+        self.assertEqual([match for chunk in chunks for match in chunk],
+                         [matches[id] for id in [5, 2, 4, 3, 1]])
+
+    def test_bulk_inserts(self):
+        game_id = db.insert_game("StarCraft: Brood War")
+        player_ids = db.insert_players([{"name": "Flash",
+                                         "game_ids": [game_id]},
+                                        {"name": "Jaedong",
+                                         "birthday": string_time_short}])
+        self.assertEqual(player_ids, [1, 2])
+        self.assertEqual(db.get_players(player_ids)[2]["birthday"],
+                         dt.datetime(2020, 4, 26))
+        match_ids = db.insert_matches(
+            [{"date": int_time, "teams": [[1], [2]]},
+             {"date": int_time + 1, "game_id": game_id, "teams": [[2], [1]]}])
+        self.assertEqual(match_ids, [1, 2])
+        matches = db.get_matches(match_ids)
+        self.assertEqual([[p["name"] for p in team]
+                          for team in matches[2]["teams"]],
+                         [["Jaedong"], ["Flash"]])
+        with self.assertRaises(sqlite3.IntegrityError):
+            db.insert_matches([{"date": int_time, "teams": [[1], [2]]},
+                               {"date": int_time, "teams": [[1], [123]]}])
+        self.assertEqual(len(db.get_matches_between(0, 2e9)), 2)
+
+    def test_bulk_load(self):
+        db.insert_game("StarCraft: Brood War")
+        with tempfile.TemporaryDirectory() as directory:
+            players = os.path.join(directory, "players.csv")
+            with open(players, "w") as f:
+                f.write("name,birthday,team,games\n"
+                        "Flash,1992-07-20,KT Rolster,StarCraft: Brood War\n"
+                        "Jaedong,,,\n")
+            matches = os.path.join(directory, "matches.jsonl")
+            with open(matches, "w") as f:
+                f.write('{"date": "2020-04-26", "game": "StarCraft: Brood War",'
+                        ' "tournament": "ASL Season 9",'
+                        ' "teams": [["Flash"], [2]]}\n')
+            records = map(bulk_load._from_csv, bulk_load.read_records(players))
+            with self.assertRaises(bulk_load.LoadError):
+                bulk_load.load_players(records, bulk_load.NameResolver())
+            resolver = bulk_load.NameResolver(create_missing=True)
+            records = map(bulk_load._from_csv, bulk_load.read_records(players))
+            self.assertEqual(bulk_load.load_players(records, resolver), 2)
+            records = bulk_load.read_records(matches)
+            self.assertEqual(bulk_load.load_matches(records, resolver), 1)
+        match = db.get_matches([1])[1]
+        self.assertEqual(match["tournament"], "ASL Season 9")
+        self.assertEqual([[p["name"] for p in team] for team in match["teams"]],
+                         [["Flash"], ["Jaedong"]])
+        self.assertEqual(match["teams"][0][0]["team"], "KT Rolster")
+
+    def test_records(self):
+        names = ["id", "date", "teams"]
+        players = {7: {"id": 7}, 8: {"id": 8}}
+        rows = [(1, int_time, 2, 8), (1, int_time, 1, 7),
+                (1, int_time, 2, 8), (1, int_time, None, None)]
+        self.assertEqual(db._match_records(rows, names, players),
+                         {1: {"id": 1, "date": int_time,
+                              "teams": [[{"id": 7}], [{"id": 8}]]}})
+        teams = json.dumps([[[7, "Flash", None, None, None, None, [], []]],
+                            [[8, "Bisu", int_time, "South Korea", "KT", 2,
+                              [1], ["SC2"]]]])
+        self.assertEqual(
+            db._read_matches([(1, int_time, teams)], names,
+                             {"date": {}, "teams": {"birthday": {}}}),
+            {1: {"id": 1, "date": dt.datetime(2020, 4, 26),
+                 "teams": [[{"id": 7, "birthday": None}],
+                           [{"id": 8,
+                             "birthday": dt.datetime(2020, 4, 26)}]]}})
+        rows = [(7, "Flash", None, "SC2"), (7, "Flash", None, "BW"),
+                (8, "Bisu", int_time, None)]
+        self.assertEqual(
+            db._players_dict(rows, ["id", "name", "birthday", "games"]),
+            {7: {"id": 7, "name": "Flash", "birthday": None,
+                 "games": ["SC2", "BW"]},
+             8: {"id": 8, "name": "Bisu",
+                 "birthday": dt.datetime(2020, 4, 26),
+                 "games": []}})
+        self.assertEqual(db._match_values({"date": int_time}),
+                         [int_time, None, False, None, 0, 0])
+        data = {"a": [1]}
+        self.assertIs(u.assoc(data, "b", 2)["a"], data["a"])
+
+    def test_match_read(self):
+        game_id = db.insert_game("StarCraft: Brood War")
+        team_id = db.insert_team("KT Rolster")
+        tournament_id = db.insert_tournament("ASL Season 9")
+        flash = db.insert_player({"name": "Flash", "team_id": team_id,
+                                  "game_ids": [game_id]})
+        jaedong = db.insert_player({"name": "Jaedong"})
+        match_ids = db.insert_matches(
+            [{"date": int_time, "game_id": game_id,
+              "tournament_id": tournament_id, "teams": [[flash], [jaedong]]},
+             {"date": int_time + 1, "teams": [[jaedong], []]}])
+        db.update_match({"id": match_ids[1], "team1_score": 2,
+                         "teams": [[jaedong], [flash]]})
+        db.rename_game(game_id, "StarCraft: Remastered")
+        db.rename_team(team_id, "KT")
+        db.rename_tournament(tournament_id, "ASL Season 10")
+        self.assertEqual(db.check_match_read(), [])
+        matches = db.get_matches(match_ids)
+        self.assertEqual(matches[1]["game"], "StarCraft: Remastered")
+        self.assertEqual(matches[1]["tournament"], "ASL Season 10")
+        self.assertEqual(matches[2]["team1_score"], 2)
+        self.assertEqual(matches[2]["teams"][1][0]["team"], "KT")
+        self.assertEqual(matches[2]["teams"][1][0]["games"],
+                         ["StarCraft: Remastered"])
+        with db.transaction() as conn:
+            conn.execute("UPDATE match_read SET team1_score = 5 WHERE id = 1;")
+            conn.execute("DELETE FROM match_read WHERE id = 2;")
+        self.assertEqual(db.check_match_read(), [1, 2])
+        self.assertEqual(db.rebuild_match_read(), 2)
+        self.assertEqual(db.check_match_read(), [])
+        self.assertEqual(db.get_matches(match_ids), matches)
+
+    def test_standings(self):
+        kt = db.insert_team("KT Rolster")
+        sk = db.insert_team("SK Telecom")
+        tournament_id = db.insert_tournament("ASL Season 9")
+        flash = db.insert_player({"name": "Flash", "team_id": kt})
+        bisu = db.insert_player({"name": "Bisu", "team_id": sk})
+        stork = db.insert_player({"name": "Stork", "team_id": kt})
+        match_ids = db.insert_matches(
+            [{"date": int_time, "tournament_id": tournament_id,
+              "finished": True, "team1_score": 3, "team2_score": 1,
+              "teams": [[flash], [bisu]]},
+             {"date": int_time, "tournament_id": tournament_id,
+              "teams": [[bisu], [stork]]},
+             {"date": int_time, "finished": True, "team1_score": 2,
+              "teams": [[stork, bisu], [flash]]}])
+        def stats(played, wins, losses, difference):
+            return {"matches_played": played, "wins": wins,
+                    "losses": losses, "score_difference": difference}
+        self.assertEqual(db.get_team_standings(tournament_id),
+                         [{"team_id": kt, **stats(1, 1, 0, 2)},
+                          {"team_id": sk, **stats(1, 0, 1, -2)}])
+        db.update_match({"id": match_ids[1], "finished": True,
+                         "team1_score": 0, "team2_score": 2})
+        db.update_match({"id": match_ids[0], "team2_score": 5})
+        self.assertEqual(db.get_team_standings(tournament_id),
+                         [{"team_id": kt, **stats(2, 1, 1, 0)},
+                          {"team_id": sk, **stats(2, 1, 1, 0)}])
+        self.assertEqual(
+            db.get_player_stats([(flash, 0), (flash, tournament_id),
+                                 (bisu, 0), (stork, 123)]),
+            {(flash, 0): stats(2, 0, 2, -4),
+             (flash, tournament_id): stats(1, 0, 1, -2),
+             (bisu, 0): stats(3, 2, 1, 2),
+             (stork, 123): stats(0, 0, 0, 0)})
+        # KT is on both sides of the third match, so only SK played it.
+        self.assertEqual(db.get_team_stats([(kt, 0), (sk, 0)]),
+                         {(kt, 0): stats(2, 1, 1, 0),
+                          (sk, 0): stats(3, 2, 1, 2)})
+        db.update_match({"id": match_ids[2], "finished": False})
+        self.assertEqual(db.get_team_stats([(sk, 0)]),
+                         {(sk, 0): stats(2, 1, 1, 0)})
+        self.assertEqual(db.check_standings(), [])
+        with db.transaction() as conn:
+            conn.execute("UPDATE team_standings SET wins = 5;")
+        self.assertEqual(len(db.check_standings()), 4)
+        db.rebuild_match_read()
+        self.assertEqual(db.check_standings(), [])
+
     def test_getters(self):
         team_name = "SK Telecom"
         team_id = db.insert_team(team_name)
@@ -120,6 +492,179 @@ class TestDBFunctions(ut.TestCase):
                               'team': None}})
         self.assertEqual(db.get_team(team_id), result(team_id, team_name))
 
+    def test_migrations(self):
+        db.recreate_db()
+        self.assertEqual(db.schema_version(), len(db._migrations()))
+        self.assertEqual(db.migrate(), 0)
+        # A database with the first version of the schema and some data.
+        db._reset_connections()
+        os.remove(db.db_name)
+        db.load_sql("sql/tables.sql")
+        with sqlite3.connect(db.db_name) as conn:
+            conn.executescript("""
+                INSERT INTO games VALUES (1, 'StarCraft: Brood War');
+                INSERT INTO players VALUES (1, 'Flash', null, null, null);
+                INSERT INTO matches VALUES (1, 1587852000, 1, 1, null, 2, 0);
+                INSERT INTO match_teams VALUES (null, 1, 1, 1);""")
+        conn.close()
+        self.assertEqual(db.schema_version(), 0)
+        db.create_or_migrate_db()
+        self.assertEqual(db.schema_version(), len(db._migrations()))
+        self.assertEqual(db.check_match_read(), [])
+        self.assertEqual(db.get_matches([1], {"game": {}}),
+                         {1: {"id": 1, "game": "StarCraft: Brood War"}})
+        self.assertEqual(db.get_player_stats([(1, 0)])[(1, 0)]["wins"], 1)
+        self.assertIn("matches", db.get_data_versions())
+        db.connection().execute("PRAGMA user_version = 1000;")
+        with self.assertRaises(RuntimeError):
+            db.migrate()
+
+def query_plans(statements):
+    """Returns the EXPLAIN QUERY PLAN details of the statements."""
+    conn = db.connection()
+    return {s: [row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + s)]
+            for s in statements
+            if s.split(None, 1)[0] in ["SELECT", "UPDATE", "DELETE"]}
+
+class TestQueryPlans(ut.TestCase):
+    """Runs every function of db_functions, and fails if any of the queries
+    that they run scans a whole table, unless the function reads or writes
+    whole tables by design."""
+    def setUp(self):
+        db.recreate_db()
+        db.load_example_data()
+
+    def test_query_plans(self):
+        match = {"date": int_time, "game_id": 1, "tournament_id": 1,
+                 "finished": True, "teams": [[1], [2]]}
+        calls = {
+            "insert_game": lambda: db.insert_game("QuakeLive 2"),
+            "insert_team": lambda: db.insert_team("Liquid"),
+            "insert_tournament": lambda: db.insert_tournament("ASL 10"),
+            "get_game": lambda: db.get_game(1),
+            "get_team": lambda: db.get_team(1),
+            "get_tournament": lambda: db.get_tournament(1),
+            "get_games": lambda: db.get_games([1, 2]),
+            "get_teams": lambda: db.get_teams([1, 2]),
+            "get_tournaments": lambda: db.get_tournaments([1, 2]),
+            "get_game_ids": lambda: db.get_game_ids(["DOTA 2"]),
+            "get_team_ids": lambda: db.get_team_ids(["OG"]),
+            "get_tournament_ids": lambda: db.get_tournament_ids(["ASL"]),
+            "insert_player": lambda: db.insert_player(
+                {"name": "Bisu", "team_id": 1, "game_ids": [1]}),
+            "insert_players": lambda: db.insert_players([{"name": "Stork"}]),
+            "insert_match": lambda: db.insert_match(match),
+            "insert_matches": lambda: db.insert_matches([match, match]),
+            "update_match": lambda: db.update_match(
+                {"id": 1, "team1_score": 5, "teams": [[1], [3]]}),
+            "rename_game": lambda: db.rename_game(1, "StarCraft"),
+            "rename_team": lambda: db.rename_team(4, "Woo"),
+            "rename_tournament": lambda: db.rename_tournament(1, "ASL 9"),
+            "get_matches": lambda: db.get_matches([1, 2]),
+            "get_matches_between": lambda: db.get_matches_between(
+                int_time, int_time + 86400),
+            "get_matches_by_tournament_id": lambda:
+                db.get_matches_by_tournament_id(1),
+            "get_matches_by_tournament_name": lambda:
+                db.get_matches_by_tournament_name("ASL 9"),
+            "get_matches_page": lambda: [
+                db.get_matches_page(filters, 2, (int_time, 1))
+                for filters in [{"ids": [1, 2]}, {"on_date": int_time},
+                                {"tournament_id": 1},
+                                {"tournament_name": "ASL 9"},
+                                {"player_id": 4, "finished": True},
+                                {"head_to_head": (4, 5)}]] + [
+                db.get_matches_page({"player_id": 4}, 2, (int_time, 1),
+                                    descending=True)],
+            "get_player_match_pages": lambda: db.get_player_match_pages(
+                [(4, 2, (int_time, 1), True), (5, 2, None, None)]),
+            "get_match_teams": lambda: db.get_match_teams([1, 2]),
+            "get_players": lambda: db.get_players([1, 2]),
+            "get_players_by_names": lambda: db.get_players_by_names(
+                ["Flash"]),
+            "get_players_page": lambda: [
+                db.get_players_page(filters, 2, (1,))
+                for filters in [{"ids": [1, 2, 3]}, {"names": ["Flash"]}]],
+            "get_player_stats": lambda: db.get_player_stats([(1, 0)]),
+            "get_team_stats": lambda: db.get_team_stats([(1, 1)]),
+            "get_player_standings": lambda: db.get_player_standings(1),
+            "get_team_standings": lambda: db.get_team_standings(1),
+            "get_row_estimates": lambda: db.get_row_estimates(),
+            "search": lambda: db.search("fla")}
+        # These read or write whole tables by design.
+        whole_tables = {
+            "get_data_versions": lambda: db.get_data_versions(),
+            "rebuild_match_read": lambda: db.rebuild_match_read(),
+            "rebuild_search": lambda: db.rebuild_search(),
+            "check_match_read": lambda: db.check_match_read(),
+            "check_standings": lambda: db.check_standings(),
+            "unfiltered pages": lambda: [db.get_matches_page({}, 2),
+                                         db.get_players_page({}, 2)],
+            "iter_matches": lambda: list(db.iter_matches({}))}
+        functions = {name for name, f in vars(db).items()
+                     if not name.startswith("_") and
+                     hasattr(f, "__wrapped__") and
+                     f.__wrapped__.__code__.co_varnames[:2] ==
+                     ("conn", "cursor")}
+        self.assertEqual(functions - set(calls) - set(whole_tables), set())
+        for name, call in calls.items():
+            statements = []
+            with db.checked_out() as conn:
+                conn.set_trace_callback(statements.append)
+                try:
+                    call()
+                finally:
+                    conn.set_trace_callback(None)
+            for statement, plan in query_plans(statements).items():
+                # Full-text queries (":M") are index lookups, and so
+                # are the subqueries that rank them.
+                scans = [d for d in plan if d.startswith("SCAN ") and
+                         not d.startswith("SCAN json_each") and
+                         not d.startswith("SCAN (subquery") and
+                         not (" VIRTUAL TABLE INDEX " in d and
+                              ":M" in d) and
+                         d != "SCAN CONSTANT ROW"]
+                self.assertEqual(scans, [], f"{name} runs {statement}")
+        for call in whole_tables.values():
+            call()
+
+class TestBenchmarks(ut.TestCase):
+    def test_generate(self):
+        def dump():
+            conn = db.connection()
+            return [conn.execute(f"SELECT * FROM {table};").fetchall()
+                    for table in ["teams", "tournaments", "players",
+                                  "player_games", "matches", "match_teams"]]
+        benchmarks.generate(60, 2500, 5, seed=1, batch_size=1000)
+        first = dump()
+        self.assertEqual([len(rows) for rows in first],
+                         [12, 3, 60, len(first[3]), 2500, 25000])
+        self.assertEqual(db.check_match_read(), [])
+        self.assertEqual(db.check_standings(), [])
+        benchmarks.generate(60, 2500, 5, seed=1, batch_size=1000)
+        self.assertEqual(dump(), first)
+        benchmarks.generate(60, 2500, 5, seed=2, batch_size=1000)
+        self.assertNotEqual(dump(), first)
+
+    def test_suite(self):
+        benchmarks.generate(60, 200, 5)
+        results = benchmarks.suite(repeat=2)
+        functions = {name for name, f in vars(db).items()
+                     if not name.startswith("_") and
+                     hasattr(f, "__wrapped__") and
+                     f.__wrapped__.__code__.co_varnames[:2] ==
+                     ("conn", "cursor")}
+        self.assertEqual(functions - set(results["cases"]) -
+                         benchmarks._not_benchmarked, set())
+        self.assertEqual(results["cases"]["get_matches"]["queries"], 1)
+        self.assertEqual(results["cases"]["_read_matches 100"]["queries"], 0)
+        self.assertEqual(benchmarks.regressions(results, results), {})
+        baseline = json.loads(json.dumps(results))
+        baseline["cases"]["get_matches"]["queries"] = 0
+        baseline["cases"]["insert_matches"]["p50_ms"] /= 2
+        self.assertEqual(set(benchmarks.regressions(results, baseline)),
+                         {"get_matches", "insert_matches"})
+
 class TestGraphQL(ut.TestCase):
     def setUp(self):
         db.recreate_db()
@@ -309,5 +854,1022 @@ class TestGraphQL(ut.TestCase):
                           map(schema.execute, queries)))
         self.assertEqual(result, expected)
 
+    def test_field_plans(self):
+        schema = g.Schema(query=ql.Query, mutation=ql.Mutation)
+        game_id = db.insert_game("StarCraft: Brood War")
+        team_id = db.insert_team("KT Rolster")
+        flash = db.insert_player({"name": "Flash", "team_id": team_id,
+                                  "game_ids": [game_id]})
+        jaedong = db.insert_player({"name": "Jaedong"})
+        db.insert_match({"date": string_time_short, "game_id": game_id,
+                         "team1_score": 3, "teams": [[flash], [jaedong]]})
+        def execute(query):
+            result, selects = traced_selects(schema.execute, query)
+            return u.normal_dict(result.data), selects
+        data, selects = execute('{ matches(ids: [1]) { id date team1Score } }')
+        self.assertEqual(data, {'matches': [{'id': '1',
+                                             'date': '2020-04-26T00:00:00',
+                                             'team1Score': 3}]})
+        self.assertEqual(len(selects), 2)
+        self.assertFalse(any("JOIN" in s for s in selects))
+        data, selects = execute('''
+            { matches(ids: [1]) { ...m } }
+            fragment m on Match { game teams { ... on Player { name } } }''')
+        self.assertEqual(data, {'matches': [{'game': 'StarCraft: Brood War',
+                                             'teams': [[{'name': 'Flash'}],
+                                                       [{'name': 'Jaedong'}]]}]})
+        self.assertEqual(len(selects), 5)
+        self.assertFalse(any("JOIN" in s for s in selects))
+        self.assertEqual(db.get_players([flash], {"team": {}}),
+                         {flash: {"id": flash, "team": "KT Rolster"}})
+
+    def test_standings(self):
+        schema = g.Schema(query=ql.Query)
+        team_ids = [db.insert_team(name) for name in ["KT", "SKT", "CJ"]]
+        tournament_id = db.insert_tournament("Proleague")
+        player_ids = [db.insert_player({"name": name, "team_id": team_id})
+                      for name, team_id in zip(["Flash", "Bisu", "Jaedong"],
+                                               team_ids)]
+        for (p1, p2), scores in [((0, 1), (3, 0)), ((1, 2), (2, 1)),
+                                 ((0, 2), (1, 2))]:
+            db.insert_match({"date": int_time, "finished": True,
+                             "tournament_id": tournament_id,
+                             "team1_score": scores[0],
+                             "team2_score": scores[1],
+                             "teams": [[player_ids[p1]], [player_ids[p2]]]})
+        result = schema.execute(
+            '''query ($id: Int!) { standings(tournamentId: $id) {
+                 teams { team { name } stats { wins scoreDifference } }
+                 players { player { name stats { matchesPlayed } } } } }''',
+            variable_values={"id": tournament_id})
+        self.assertIsNone(result.errors)
+        standings = u.normal_dict(result.data)["standings"]
+        self.assertEqual([(s["team"]["name"], s["stats"]["wins"],
+                           s["stats"]["scoreDifference"])
+                          for s in standings["teams"]],
+                         [("KT", 1, 2), ("CJ", 1, 0), ("SKT", 1, -2)])
+        self.assertEqual([s["player"] for s in standings["players"]],
+                         [{"name": name, "stats": {"matchesPlayed": 2}}
+                          for name in ["Flash", "Jaedong", "Bisu"]])
+        result = schema.execute('''{ players(names: ["Flash"]) {
+            stats { wins losses }
+            other: stats(tournamentId: 123) { wins } } }''')
+        self.assertEqual(u.normal_dict(result.data)["players"],
+                         [{"stats": {"wins": 1, "losses": 1},
+                           "other": {"wins": 0}}])
+
+    def test_connections(self):
+        schema = g.Schema(query=ql.Query)
+        for name in ["Flash", "Jaedong", "Bisu"]:
+            db.insert_player({"name": name})
+        query = '''query ($after: String) {
+            playersConnection(first: 2, after: $after) {
+                edges { cursor node { name } }
+                pageInfo { hasNextPage endCursor } } }'''
+        data = schema.execute(query).data["playersConnection"]
+        self.assertEqual([e["node"]["name"] for e in data["edges"]],
+                         ["Flash", "Jaedong"])
+        self.assertTrue(data["pageInfo"]["hasNextPage"])
+        self.assertEqual(data["pageInfo"]["endCursor"],
+                         data["edges"][-1]["cursor"])
+        data = schema.execute(
+            query, variable_values={"after": data["pageInfo"]["endCursor"]}
+        ).data["playersConnection"]
+        self.assertEqual([e["node"]["name"] for e in data["edges"]], ["Bisu"])
+        self.assertFalse(data["pageInfo"]["hasNextPage"])
+        result = schema.execute(query, variable_values={"after": "nonsense"})
+        self.assertIn("Invalid cursor", str(result.errors))
+        old_max_page_size = ql.max_page_size
+        ql.max_page_size = 2
+        try:
+            for query in ['{ players { name } }',
+                          '{ players(first: 3) { name } }',
+                          '{ players(ids: [1, 2, 3]) { name } }',
+                          '{ players(names: ["Flash", "Jaedong", "Bisu"]) '
+                          '{ name } }',
+                          '{ matches(ids: [1, 2, 3]) { id } }']:
+                result = schema.execute(query)
+                self.assertEqual(list(result.data.values()), [None], query)
+                self.assertIn("Connection`", str(result.errors), query)
+            data = schema.execute('{ players(first: 2) { name } }').data
+            self.assertEqual(data, {"players": [{"name": "Flash"},
+                                                {"name": "Jaedong"}]})
+            data = schema.execute('{ players(ids: [1, 3]) { name } }').data
+            self.assertEqual(len(data["players"]), 2)
+            data = schema.execute("""{ playersConnection(ids: [1, 2, 3]) {
+                edges { node { name } } pageInfo { hasNextPage } } }""").data
+            self.assertTrue(data["playersConnection"]["pageInfo"]
+                            ["hasNextPage"])
+        finally:
+            ql.max_page_size = old_max_page_size
+
+    def test_match_history(self):
+        a, b, c = db.insert_players([{"name": "Flash"}, {"name": "Jaedong"},
+                                     {"name": "Bisu"}])
+        ids = [db.insert_match({"date": int_time + i, "finished": True,
+                                "teams": teams})
+               for i, teams in enumerate([[[a], [b]], [[b], [a]],
+                                          [[a, b], [c]], [[c], [b]]])]
+        db.update_match({"id": ids[1], "finished": False})
+        schema = g.Schema(query=ql.Query)
+        query = '''query ($after: String, $finished: Boolean) {
+            players(ids: [%d]) { matches(first: 2, after: $after,
+                                         finished: $finished) {
+                edges { node { id teams { name } } }
+                pageInfo { hasNextPage endCursor } } } }''' % a
+        def page(**variables):
+            result = schema.execute(query, variable_values=variables)
+            self.assertIsNone(result.errors)
+            return result.data["players"][0]["matches"]
+        data = page()
+        self.assertEqual([int(e["node"]["id"]) for e in data["edges"]],
+                         [ids[2], ids[1]])
+        self.assertEqual(data["edges"][0]["node"]["teams"],
+                         [[{"name": "Flash"}, {"name": "Jaedong"}],
+                          [{"name": "Bisu"}]])
+        self.assertTrue(data["pageInfo"]["hasNextPage"])
+        data = page(after=data["pageInfo"]["endCursor"])
+        self.assertEqual([int(e["node"]["id"]) for e in data["edges"]],
+                         [ids[0]])
+        self.assertFalse(data["pageInfo"]["hasNextPage"])
+        data = page(finished=True)
+        self.assertEqual([int(e["node"]["id"]) for e in data["edges"]],
+                         [ids[2], ids[0]])
+        # Only the matches with the players on opposite sides.
+        query = '''{ headToHead(playerA: %d, playerB: %d, finished: true) {
+                        edges { node { id } } } }'''
+        data = schema.execute(query % (b, a)).data["headToHead"]
+        self.assertEqual([int(e["node"]["id"]) for e in data["edges"]],
+                         [ids[0]])
+        data = schema.execute(query % (c, b)).data["headToHead"]
+        self.assertEqual([int(e["node"]["id"]) for e in data["edges"]],
+                         [ids[3], ids[2]])
+        # The pages of all the players are read together.
+        statements = []
+        with db.checked_out() as conn:
+            conn.set_trace_callback(statements.append)
+            try:
+                result = schema.execute(
+                    """{ matches { teams { id matches(first: 2) {
+                           edges { node { id } } } } } }""",
+                    context_value=ql.Context())
+            finally:
+                conn.set_trace_callback(None)
+        self.assertIsNone(result.errors)
+        self.assertEqual(sum("UNION ALL" in s for s in statements), 1)
+        for match in result.data["matches"]:
+            for player in sum(match["teams"], []):
+                page, _ = db.get_matches_page({"player_id": int(player["id"])},
+                                              2, descending=True)
+                self.assertEqual(
+                    [int(e["node"]["id"])
+                     for e in player["matches"]["edges"]],
+                    [id for (_, id), _ in page])
+
+    def test_stream_matches(self):
+        player_id = db.insert_player({"name": "Flash"})
+        for i in range(3):
+            db.insert_match({"date": int_time + i, "teams": [[player_id], []]})
+        document = documents.DocumentCache(g.Schema(query=ql.Query)).get(
+            '''{ m: matches(first: 1, between: ["2020-01-01", "2030-01-01"])
+                { ...f } }
+               fragment f on Match { id teams { name } }''')
+        key, chunks = ql.stream_matches(document.ast, chunk_size=2)
+        self.assertEqual(key, "m")
+        self.assertEqual([u.normal_dict(chunk) for chunk in chunks],
+                         [[{"id": "1", "teams": [[{"name": "Flash"}], []]},
+                           {"id": "2", "teams": [[{"name": "Flash"}], []]}],
+                          [{"id": "3", "teams": [[{"name": "Flash"}], []]}]])
+        document = documents.DocumentCache(g.Schema(query=ql.Query)).get(
+            '{ players { id } }')
+        with self.assertRaises(GraphQLError):
+            ql.stream_matches(document.ast)
+
+    def test_loaders(self):
+        schema = g.Schema(query=ql.Query)
+        game_ids = [db.insert_game("StarCraft: Brood War"),
+                    db.insert_game("StarCraft II")]
+        team_id = db.insert_team("KT Rolster")
+        tournament_id = db.insert_tournament("ASL Season 9")
+        player_ids = [db.insert_player({"name": name, "team_id": team_id,
+                                        "game_ids": game_ids})
+                      for name in ["Flash", "Jaedong", "Bisu", "Stork"]]
+        query = '''{ matches(between: ["2020-01-01", "2030-01-01"]) {
+                        game tournament teams { name team games } } }'''
+        def execute(n_matches):
+            for i in range(n_matches):
+                db.insert_match({"date": int_time + i,
+                                 "game_id": game_ids[i % 2],
+                                 "tournament_id": tournament_id,
+                                 "teams": [player_ids[:2], player_ids[2:]]})
+            result, selects = traced_selects(schema.execute, query,
+                                             context_value=ql.Context())
+            self.assertIsNone(result.errors)
+            return result.data["matches"], selects
+        matches, selects = execute(2)
+        self.assertEqual(matches[0]["teams"][1][0],
+                         {"name": "Bisu", "team": "KT Rolster",
+                          "games": ["StarCraft: Brood War", "StarCraft II"]})
+        matches, more_selects = execute(8)
+        self.assertEqual(len(matches), 10)
+        self.assertEqual(len(selects), len(more_selects))
+        player_selects = [s for s in more_selects if "FROM players" in s]
+        self.assertEqual(len(player_selects), 1)
+
+class TestDocuments(ut.TestCase):
+    def setUp(self):
+        db.recreate_db()
+
+    def test_document_cache(self):
+        cache = documents.DocumentCache(g.Schema(query=ql.Query), max_size=2)
+        queries = ['{ players(ids: [1]) { name } }',
+                   '{ matches(ids: [1]) { id } }',
+                   '{ games }']
+        for query in queries[:2] + queries[:2]:
+            self.assertEqual(cache.get(query).errors, [])
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        self.assertEqual(len(cache.get(queries[2]).errors), 1)
+        self.assertTrue(cache.execute(queries[2]).invalid)
+        self.assertEqual((cache.hits, cache.misses), (3, 3))
+        cache.get(queries[0])
+        self.assertEqual(cache.misses, 4)
+        self.assertEqual(cache.execute(queries[1]).data, {"matches": []})
+
+    def test_persisted_queries(self):
+        persisted = documents.PersistedQueries()
+        query = '{ players(ids: [1]) { name } }'
+        hash = documents.query_hash(query)
+        with self.assertRaises(documents.PersistedQueryError):
+            persisted.resolve(hash)
+        with self.assertRaises(documents.PersistedQueryError):
+            persisted.resolve(hash, query + " ")
+        self.assertEqual(persisted.resolve(hash, query), query)
+        persisted.register(query)
+        self.assertEqual(persisted.resolve(hash), query)
+        self.assertEqual(persisted.stats(),
+                         {"hits": 1, "misses": 1, "evictions": 0, "size": 1,
+                          "max_size": 1000})
+
+    def test_persisted_query_eviction(self):
+        persisted = documents.PersistedQueries(max_size=2)
+        queries = [f"{{ players(ids: [{i}]) {{ name }} }}" for i in range(4)]
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+            json.dump(queries[:1], f)
+            f.flush()
+            persisted.load(f.name)
+        hashes = [persisted.register(query) for query in queries[1:3]]
+        persisted.resolve(hashes[0])
+        persisted.register(queries[3])
+        # The least recently used query is dropped, and the loaded one kept.
+        with self.assertRaises(documents.PersistedQueryError):
+            persisted.resolve(hashes[1])
+        for query in [queries[0], queries[1], queries[3]]:
+            self.assertEqual(persisted.resolve(documents.query_hash(query)),
+                             query)
+        self.assertEqual(persisted.evictions, 1)
+        self.assertEqual(persisted.stats()["size"], 3)
+        # Queries are only registered once they are valid.
+        api_service = service.Service("app")
+        for query in ["{ nope }", "{"]:
+            extensions = json.dumps({"persistedQuery": {
+                "sha256Hash": documents.query_hash(query)}})
+            reply = api_service.handle("/", {"query": query,
+                                             "extensions": extensions})
+            self.assertEqual(reply.status, 400)
+            reply = api_service.handle("/", {"extensions": extensions})
+            self.assertIn("PersistedQueryNotFound",
+                          json.loads(reply.body)["error"])
+        self.assertEqual(api_service.persisted_queries.stats()["size"], 0)
+
+    def test_malformed_persisted_queries(self):
+        api_service = service.Service("app")
+        for persisted in [5, {}, {"sha256Hash": 5}]:
+            extensions = {"persistedQuery": persisted}
+            for reply in [
+                    api_service.handle("/", {
+                        "extensions": json.dumps(extensions)}),
+                    api_service.handle_post("/", json.dumps({
+                        "extensions": extensions}).encode())]:
+                self.assertEqual(reply.status, 400)
+                self.assertEqual(json.loads(reply.body)["error"],
+                                 "extensions.persistedQuery.sha256Hash must "
+                                 "be a string")
+
+class TestResponseCache(ut.TestCase):
+    def setUp(self):
+        db.recreate_db()
+
+    def test_data_versions(self):
+        versions = db.get_data_versions()
+        game_id = db.insert_game("StarCraft: Brood War")
+        player_id = db.insert_player({"name": "Flash", "game_ids": [game_id]})
+        match_id = db.insert_match({"date": int_time, "teams": [[player_id]]})
+        db.update_match({"id": match_id, "team1_score": 1})
+        new_versions = db.get_data_versions()
+        changes = {t: new_versions[t] - versions[t] for t in versions}
+        self.assertEqual(changes, {"games": 1, "teams": 0, "tournaments": 0,
+                                   "players": 1, "player_games": 1,
+                                   "matches": 2, "match_teams": 1})
+
+    def test_invalidation_and_eviction(self):
+        responses = cache.ResponseCache(max_bytes=10)
+        versions = db.get_data_versions()
+        responses.put("a", versions, ["matches", "players"], b"12345")
+        responses.put("b", versions, ["teams"], b"12345")
+        self.assertEqual(responses.get("a", versions), b"12345")
+        db.insert_team("KT Rolster")
+        new_versions = db.get_data_versions()
+        self.assertEqual(responses.get("a", new_versions), b"12345")
+        self.assertIsNone(responses.get("b", new_versions))
+        responses.put("c", new_versions, [], b"123")
+        responses.put("d", new_versions, [], b"1234")
+        self.assertIsNone(responses.get("a", new_versions))
+        self.assertEqual(responses.stats()["bytes"], 7)
+        self.assertEqual(responses.evictions, 1)
+
+    def test_tables_read(self):
+        document = documents.DocumentCache(g.Schema(query=ql.Query)).get(
+            '''query A { players(ids: [1]) { name } }
+               query B { ...f }
+               fragment f on Query { matches(ids: [1]) { id } }''')
+        self.assertEqual(ql.tables_read(document.ast, "A"),
+                         {"players", "player_games", "teams", "games"})
+        self.assertIn("match_teams", ql.tables_read(document.ast, "B"))
+        document = documents.DocumentCache(g.Schema(query=ql.Query)).get(
+            "{ players(ids: [1]) { stats { wins } } }")
+        self.assertIn("matches", ql.tables_read(document.ast))
+        document = documents.DocumentCache(g.Schema(query=ql.Query)).get(
+            "{ __typename }")
+        self.assertEqual(ql.tables_read(document.ast), set())
+        # Root fields without an entry may read any table.
+        api_service = service.Service("app")
+        query = {"query": "{ standings(tournamentId: 1) "
+                          "{ players { stats { wins } } } }"}
+        entry = db.tables_read.pop("standings")
+        try:
+            document = api_service.document_cache.get(query["query"])
+            self.assertIsNone(ql.tables_read(document.ast))
+            etag = dict(api_service.handle("/", query).headers)["ETag"]
+            db.insert_tournament("ASL")
+            reply = api_service.handle("/", query, None,
+                                       {"if-none-match": etag})
+            self.assertEqual(reply.status, 200)
+        finally:
+            db.tables_read["standings"] = entry
+
+class TestPost(ut.TestCase):
+    def setUp(self):
+        db.recreate_db()
+        player_id = db.insert_player({"name": "Flash"})
+        for i in range(3):
+            db.insert_match({"date": int_time + i, "teams": [[player_id], []]})
+
+    def post(self, api_service, request):
+        reply = api_service.handle_post("/", json.dumps(request).encode())
+        return reply.status, json.loads(reply.body)
+
+    def test_variables(self):
+        api_service = service.Service("app")
+        query = """query A($ids: [Int]) { matches(ids: $ids) { id } }
+                   query B($name: String!) { players(names: [$name]) { id } }"""
+        self.assertEqual(
+            self.post(api_service, {"query": query, "operationName": "A",
+                                    "variables": {"ids": [1, 3]}}),
+            (200, {"matches": [{"id": "1"}, {"id": "3"}]}))
+        self.assertEqual(
+            self.post(api_service, {"query": query, "operationName": "B",
+                                    "variables": {"name": "Flash"}}),
+            (200, {"players": [{"id": "1"}]}))
+        # The response cache tells the variables apart.
+        self.assertEqual(
+            self.post(api_service, {"query": query, "operationName": "A",
+                                    "variables": {"ids": [2]}})[1],
+            {"matches": [{"id": "2"}]})
+        for request in [{"query": query},
+                        {"query": query, "operationName": "C"},
+                        {"query": query, "operationName": "B"},
+                        {"query": query, "operationName": "A",
+                         "variables": {"ids": ["x"]}},
+                        {"query": query, "operationName": "A",
+                         "variables": [1]}]:
+            self.assertEqual(self.post(api_service, request)[0], 400)
+        self.assertEqual(api_service.handle_post("/", b"{").status, 400)
+        self.assertEqual(api_service.handle_post("/", b"1").status, 400)
+        self.assertEqual(api_service.handle_post("/x", b"{}").status, 404)
+        # GET requests give the variables as JSON.
+        reply = api_service.handle("/", {
+            "query": query, "operationName": "A",
+            "variables": json.dumps({"ids": [3]})})
+        self.assertEqual(json.loads(reply.body), {"matches": [{"id": "3"}]})
+
+    def test_malformed_body(self):
+        api_service = service.Service("app")
+        query = "{ players { id } }"
+        for request, error in [
+                ({"query": 5}, "`query` must be a string"),
+                ({"query": query, "operationName": 5},
+                 "`operationName` must be a string"),
+                ({"query": query, "variables": 5}, "must be a JSON object")]:
+            status, answer = self.post(api_service, request)
+            self.assertEqual(status, 400, request)
+            self.assertIn(error, answer["error"], request)
+        status, answers = self.post(api_service, [{"query": 5}])
+        self.assertIn("error", answers[0])
+
+    def test_batches(self):
+        api_service = service.Service("db", max_batch_size=3)
+        query = "query($ids: [Int]) { matches(ids: $ids) { id } }"
+        status, answers = self.post(api_service, [
+            {"query": query, "variables": {"ids": [2]}},
+            {"query": "{ nope }"},
+            1,
+            ])
+        self.assertEqual(status, 200)
+        self.assertEqual(answers[0], {"matches": [{"id": "2"}]})
+        self.assertIn("error", answers[1])
+        self.assertIn("error", answers[2])
+        self.assertEqual(self.post(api_service, [])[0], 400)
+        self.assertEqual(self.post(api_service, [{"query": query}] * 4)[0],
+                         400)
+        self.assertIn("error", self.post(api_service, [
+            {"query": query, "stream": "json"}])[1][0])
+        # Later operations see the writes of earlier ones.
+        status, answers = self.post(api_service, [
+            {"query": "{ players(names: [\"Bisu\"]) { id } }"},
+            {"query": """mutation($name: String!) {
+                             createPlayer(data: {name: $name, gameIds: []})
+                             { player { id } } }""",
+             "variables": {"name": "Bisu"}},
+            {"query": "{ players(names: [\"Bisu\"]) { id } }"},
+            ])
+        self.assertEqual(answers, [
+            {"players": []},
+            {"createPlayer": {"player": {"id": "2"}}},
+            {"players": [{"id": "2"}]}])
+
+class TestConditionalRequests(ut.TestCase):
+    def setUp(self):
+        db.recreate_db()
+        player_id = db.insert_player({"name": "Flash"})
+        for i in range(100):
+            db.insert_match({"date": int_time + i, "teams": [[player_id], []]})
+
+    def test_etags(self):
+        api_service = service.Service("db")
+        args = {"query": "{ players { name } }"}
+        reply = api_service.handle("/", args)
+        etag = dict(reply.headers)["ETag"]
+        not_modified = api_service.handle("/", args, None,
+                                          {"if-none-match": etag})
+        self.assertEqual((not_modified.status, not_modified.body),
+                         (304, b""))
+        # Without executing the query or reading the response cache.
+        hits = api_service.response_cache.hits
+        for if_none_match in [f'W/{etag}', f'"x", {etag}', "*"]:
+            self.assertEqual(api_service.handle(
+                "/", args, None, {"if-none-match": if_none_match}).status,
+                304)
+        # Revalidations get the ETag of the encoding that the client has.
+        gzipped = etag[:-1] + '-gzip"'
+        not_modified = api_service.handle(
+            "/", args, None, {"if-none-match": gzipped,
+                              "accept-encoding": "gzip"})
+        self.assertEqual(not_modified.status, 304)
+        self.assertEqual(dict(not_modified.headers),
+                         {"ETag": gzipped, "Vary": "Accept-Encoding"})
+        not_modified = api_service.handle(
+            "/", args, None, {"if-none-match": etag,
+                              "accept-encoding": "gzip"})
+        self.assertEqual(dict(not_modified.headers), {"ETag": etag})
+        self.assertEqual(api_service.response_cache.hits, hits)
+        self.assertEqual(api_service.handle(
+            "/", args, None, {"if-none-match": gzipped}).status, 200)
+        # The ETag depends on the query, and changes with writes to the
+        # tables that it reads, but not with writes to other tables.
+        other = api_service.handle("/", {"query": "{ players { id } }"})
+        self.assertNotEqual(dict(other.headers)["ETag"], etag)
+        db.insert_tournament("ASL")
+        self.assertEqual(api_service.handle(
+            "/", args, None, {"if-none-match": etag}).status, 304)
+        db.insert_player({"name": "Bisu"})
+        reply = api_service.handle("/", args, None, {"if-none-match": etag})
+        self.assertEqual(reply.status, 200)
+        self.assertNotEqual(dict(reply.headers)["ETag"], etag)
+        self.assertEqual(len(json.loads(reply.body)["players"]), 2)
+        # Without a response cache too.
+        api_service = service.Service("app", response_cache_bytes=0)
+        reply = api_service.handle("/", args)
+        self.assertEqual(api_service.handle(
+            "/", args, None,
+            {"if-none-match": dict(reply.headers)["ETag"]}).status, 304)
+
+    def test_compression(self):
+        api_service = service.Service("app", compress_min_bytes=1000)
+        args = {"query": "{ matches { id date teams { name } } }"}
+        plain = api_service.handle("/", args)
+        self.assertGreater(len(plain.body), 1000)
+        self.assertNotIn("Content-Encoding", dict(plain.headers))
+        self.assertEqual(dict(plain.headers)["Vary"], "Accept-Encoding")
+        reply = api_service.handle(
+            "/", args, None, {"accept-encoding": "br;q=0, gzip, deflate"})
+        headers = dict(reply.headers)
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(headers["ETag"],
+                         dict(plain.headers)["ETag"][:-1] + '-gzip"')
+        self.assertEqual(gzip.decompress(reply.body), plain.body)
+        self.assertLess(len(reply.body), len(plain.body) / 5)
+        not_modified = api_service.handle(
+            "/", args, None, {"if-none-match": headers["ETag"],
+                              "accept-encoding": "gzip"})
+        self.assertEqual((not_modified.status,
+                          dict(not_modified.headers)["ETag"]),
+                         (304, headers["ETag"]))
+        # The compressed body is cached.
+        hits = api_service.response_cache.hits
+        self.assertEqual(api_service.handle(
+            "/", args, None, {"accept-encoding": "gzip"}).body, reply.body)
+        self.assertEqual(api_service.response_cache.hits, hits + 2)
+        small = api_service.handle("/", {"query": "{ matches(ids: [1]) "
+                                                  "{ id } }"},
+                                   None, {"accept-encoding": "gzip"})
+        self.assertEqual([name for name, _ in small.headers], ["ETag"])
+        batch = api_service.handle_post(
+            "/", json.dumps([args, args]).encode(), None,
+            {"accept-encoding": "gzip"})
+        self.assertEqual(json.loads(gzip.decompress(batch.body)),
+                         [json.loads(plain.body)] * 2)
+
+    def test_connections(self):
+        api_service = service.Service("db")
+        player_id = db.insert_player({"name": "Flash"})
+        match_id = db.insert_match({"date": int_time,
+                                    "teams": [[player_id], []]})
+        queries = {
+            "{ matchesConnection { edges { node { id team1Score } } } }":
+            lambda: db.update_match({"id": match_id, "team1_score": 99}),
+            "{ playersConnection { edges { node { id name } } } }":
+            lambda: db.insert_player({"name": "Bisu"})}
+        for query, write in queries.items():
+            before = api_service.handle("/", {"query": query})
+            write()
+            after = api_service.handle("/", {"query": query})
+            self.assertNotEqual(after.body, before.body)
+            self.assertNotEqual(dict(after.headers)["ETag"],
+                                dict(before.headers)["ETag"])
+
+class SlowService(service.Service):
+    def handle(self, path, args, client=None, headers=None):
+        db.connection().execute("""
+            WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c
+                                    LIMIT 1000000000)
+            SELECT count(*) FROM c;""")
+        return super().handle(path, args, client, headers)
+
+class TestAsgi(ut.TestCase):
+    async def wait_idle(self, app):
+        for _ in range(100):
+            if app.pending == 0:
+                return
+            await asyncio.sleep(0.02)
+        self.fail("requests are still pending")
+
+    def setUp(self):
+        db.recreate_db()
+        player_id = db.insert_player({"name": "Flash"})
+        for i in range(3):
+            db.insert_match({"date": int_time + i, "teams": [[player_id], []]})
+
+    def test_requests(self):
+        app = asgi.AsgiApp(service.Service("app"), threads=2)
+        query = urllib.parse.urlencode(
+            {"query": "{matches { id teams { name } }}"}).encode()
+        async def requests():
+            status, headers, body = await asgi_request(app, "/", query)
+            self.assertEqual(status, 200)
+            self.assertEqual(headers[b"content-type"], b"application/json")
+            self.assertEqual([m["id"] for m in json.loads(body)["matches"]],
+                             ["1", "2", "3"])
+            status, _, body = await asgi_request(
+                app, "/", query,
+                headers=[(b"if-none-match", headers[b"etag"])])
+            self.assertEqual((status, body), (304, b""))
+            status, _, body = await asgi_request(app, "/",
+                                                 query + b"&stream=ndjson")
+            self.assertEqual(body.decode().splitlines()[2],
+                             '{"id":"3","teams":[[{"name":"Flash"}],[]]}')
+            self.assertEqual((await asgi_request(app, "/", b""))[0], 400)
+            self.assertEqual((await asgi_request(app, "/nope"))[0], 404)
+            self.assertEqual(
+                (await asgi_request(app, "/", method="PUT"))[0], 405)
+            post = json.dumps(
+                {"query": "query($ids: [Int!]) {matches(ids: $ids) { id }}",
+                 "variables": {"ids": [2]}}).encode()
+            status, _, body = await asgi_request(app, "/", method="POST",
+                                                 body=post)
+            self.assertEqual(json.loads(body), {"matches": [{"id": "2"}]})
+            status, _, body = await asgi_request(
+                app, "/", method="POST", body=b"[" + post + b"," + post + b"]")
+            self.assertEqual(json.loads(body),
+                             [{"matches": [{"id": "2"}]}] * 2)
+            self.assertEqual((await asgi_request(
+                app, "/", method="POST",
+                body=b" " * (asgi.max_body_bytes + 1)))[0], 413)
+            await self.wait_idle(app)
+        asyncio.run(requests())
+
+    def test_timeouts_and_backpressure(self):
+        app = asgi.AsgiApp(SlowService("app"), threads=1, max_pending=1,
+                           timeout=0.2)
+        async def requests():
+            slow = asyncio.create_task(asgi_request(app, "/stats"))
+            await asyncio.sleep(0.05)
+            status, headers, _ = await asgi_request(app, "/stats")
+            self.assertEqual(status, 503)
+            self.assertEqual(headers[b"retry-after"], b"1")
+            self.assertEqual((await slow)[0], 504)
+            # The slow query is interrupted, which frees the thread.
+            await self.wait_idle(app)
+        asyncio.run(requests())
+
+class TestMetrics(ut.TestCase):
+    def setUp(self):
+        db.recreate_db()
+        db.load_example_data()
+
+    def test_disabled(self):
+        client = main.create_app(service.Service("app")).test_client()
+        response = client.get("/", query_string={"query": "{ games { id } }"})
+        self.assertNotIn("Server-Timing", response.headers)
+        self.assertEqual(client.get("/metrics").status_code, 404)
+        self.assertIsNone(db.query_observer)
+
+    def test_metrics(self):
+        log = io.StringIO()
+        request_metrics = metrics.Metrics(slow_seconds=0, slow_log=log)
+        request_metrics.install()
+        try:
+            client = main.create_app(
+                service.Service("db", request_metrics=request_metrics,
+                                query_costs=cost.QueryCosts())) \
+                .test_client()
+            response = client.get("/", query_string={
+                "query": "query Tour { matches(tournamentId: 1) "
+                "{ id teams { name } } }"})
+            timing = response.headers["Server-Timing"]
+            for name in ["parse", "validate", "resolve", "sql",
+                         "db.get_matches_page", "db.get_players"]:
+                self.assertIn(name + ";dur=", timing)
+            self.assertIn('db.get_matches_page;dur=', timing)
+            self.assertIn('desc="calls: 1, queries: 2"', timing)
+            self.assertIn('cost;desc="6 units"', timing)
+            response = client.get("/", query_string={
+                "query": 'mutation { createGame(name: "Go") { game { id } } }'})
+            self.assertIn("db.insert_game", response.headers["Server-Timing"])
+            text = client.get("/metrics").data.decode()
+        finally:
+            metrics.Metrics.uninstall()
+        self.assertIn('esportsapi_request_duration_seconds_count'
+                      '{operation="Tour"} 1', text)
+        self.assertIn('esportsapi_request_duration_seconds_bucket'
+                      '{operation="anonymous",le="+Inf"} 1', text)
+        self.assertIn('esportsapi_request_phase_seconds_total'
+                      '{operation="Tour",phase="validate"}', text)
+        self.assertIn('esportsapi_db_queries_total'
+                      '{function="get_matches_page"} 2', text)
+        self.assertIn('esportsapi_query_cost_units_total'
+                      '{operation="Tour"} 6', text)
+        entries = [json.loads(line) for line in log.getvalue().splitlines()]
+        self.assertEqual(len(entries), request_metrics.slow_queries)
+        def selects(function):
+            entry = [e for e in entries if e["function"] == function][0]
+            self.assertEqual(entry["operation"], "Tour")
+            return [s for s in entry["statements"]
+                    if s["sql"].startswith("SELECT")]
+        select = selects("get_players")[0]
+        self.assertIn("WHERE p.id IN (?, ?, ?)", select["sql"])
+        self.assertEqual(select["parameters"], ["int", "int", "int"])
+        self.assertEqual(selects("get_matches_page")[1]["parameters"],
+                         ["json[2]"])
+        self.assertIsNone(db.query_observer)
+
+    def test_parameter_shapes(self):
+        self.assertEqual(metrics.parameter_shapes([1, "abc", None, "[1, 2]"]),
+                         ["int", "str[3]", "null", "json[2]"])
+        self.assertEqual(metrics.parameter_shapes([(1, 2.0)] * 3),
+                         "3 x ['int', 'float']")
+
+class TestQueryCost(ut.TestCase):
+    def setUp(self):
+        db.recreate_db()
+        db.load_example_data()
+
+    def test_row_estimates(self):
+        estimates = db.get_row_estimates()
+        self.assertEqual(estimates["matches"], 4)
+        self.assertEqual(estimates["match_teams"], 8)
+        self.assertEqual(estimates["players"], 7)
+        self.assertEqual(estimates["tournaments"], 3)
+        self.assertLess(estimates["first_date"], estimates["last_date"])
+
+    def test_cost(self):
+        schema = g.Schema(query=ql.Query, mutation=ql.Mutation)
+        cache = documents.DocumentCache(schema)
+        costs = cost.QueryCosts()
+        def estimate(query, paged=True):
+            return costs.cost(schema, cache.get(query), paged)
+        # 4 matches with an id and 2 players each with a name.
+        self.assertEqual(estimate("{ matches { id teams { name } } }"),
+                         4 + 4 + 8 + 8)
+        self.assertEqual(estimate("{ matches(ids: [1, 2]) { id } }"), 4)
+        self.assertEqual(
+            estimate('{ matches(between: ["1000-01-01", "3000-01-01"]) '
+                     '{ id } }'), 8)
+        self.assertEqual(
+            estimate('{ matches(between: ["3000-01-01", "3001-01-01"]) '
+                     '{ id } }'), 0)
+        # Malformed ranges are estimated as every match.
+        self.assertEqual(
+            estimate('{ matches(between: ["1000-01-01"]) { id } }'), 8)
+        self.assertEqual(
+            estimate("fragment F on Match { id date } "
+                     "{ matches(ids: [1]) { ...F } }"), 3)
+        self.assertEqual(estimate("{ players { games } }"), 7 + 9)
+        max_page_size, ql.max_page_size = ql.max_page_size, 2
+        try:
+            self.assertEqual(estimate("{ matches { id } }"), 4)
+            self.assertEqual(estimate("{ matches { id } }", paged=False), 8)
+        finally:
+            ql.max_page_size = max_page_size
+        # Each fragment of a union counts for every result.
+        self.assertEqual(
+            estimate('{ search(text: "a", first: 7) { __typename '
+                     '... on Player { name games } ... on Team { name } } }'),
+            7 + 7 + 7 + 9 + 7)
+        self.assertEqual(
+            estimate("mutation { createPlayers(data: [{name: \"A\"}, "
+                     "{name: \"B\"}]) { players { id } } }"), 5)
+        costs.max_depth = 2
+        with self.assertRaisesRegex(cost.QueryCostError, "deeper"):
+            estimate("{ matches { teams { games } } }")
+
+    def test_limits(self):
+        api_service = service.Service(
+            "db", query_costs=cost.QueryCosts(max_cost=20),
+            client_budgets=cost.ClientBudgets(rate=1, burst=30))
+        query = {"query": "{ matches { id teams { name } } }"}
+        reply = api_service.handle("/", query, "a")
+        self.assertEqual(reply.status, service.http_bad_request)
+        self.assertIn("The estimated cost of the query is 24, which is over "
+                      "the limit of 20", json.loads(reply.body)["error"])
+        query = {"query": "{ matches { id } }"}
+        for _ in range(4):
+            self.assertEqual(api_service.handle("/", query, "a").status, 200)
+        self.assertEqual(api_service.handle("/", query, "b").status, 200)
+        # The budget of 30 is below zero after 4 queries of 8.
+        reply = api_service.handle("/", query, "a")
+        self.assertEqual(reply.status, service.http_too_many_requests)
+        self.assertGreater(json.loads(reply.body)["retry_after"], 0)
+        # Malformed ranges are answered as without costs.
+        query = "query($d: [Date]) { matches(between: $d) { id } }"
+        for between, status in [(["1000-01-01"], service.http_bad_request),
+                                ([None, "2030-01-01"], service.http_ok)]:
+            args = {"query": query, "variables": json.dumps({"d": between})}
+            for costs in [None, cost.QueryCosts()]:
+                reply = service.Service("db", query_costs=costs).handle(
+                    "/", args)
+                self.assertEqual(reply.status, status, between)
+        stats = api_service.stats()
+        self.assertEqual(stats["costs"]["rejected"], 1)
+        # The other queries were answered from the response cache.
+        self.assertEqual(stats["costs"]["requests"], 1)
+        self.assertEqual(stats["costs"]["units"], 8)
+        self.assertEqual(stats["budgets"]["limited"], 1)
+
+def check_search_indexes(path):
+    """Fails if the search indexes of the database at `path` differ from the
+    names that they index."""
+    conn = sqlite3.connect(path)
+    try:
+        for index in db._search_indexes.values():
+            conn.execute(f"INSERT INTO {index}({index}, rank) "
+                         "VALUES ('integrity-check', 1);")
+    finally:
+        conn.close()
+
+class TestSearch(ut.TestCase):
+    def setUp(self):
+        db.recreate_db()
+        db.load_example_data()
+
+    def test_search(self):
+        self.assertEqual(db.search("fla"), [("player", 3)])
+        # Prefixes of any word, ignoring case.
+        self.assertEqual(db.search("QUAKE"), [("tournament", 3)])
+        self.assertEqual(db.search("intern 20"), [("tournament", 2)])
+        self.assertEqual(db.search("miracle-"), [("player", 7)])
+        self.assertEqual(db.search('" - *'), [])
+        self.assertEqual(db.search("nothing"), [])
+        # And diacritics.
+        team_id = db.insert_team("Évil Geniuses")
+        self.assertCountEqual(db.search("evil"),
+                              [("player", 2), ("team", team_id)])
+        self.assertEqual(db.search("évi", ["team"]), [("team", team_id)])
+        self.assertEqual(len(db.search("evil", first=1)), 1)
+        self.assertEqual(db.search("evil", first=0), [])
+        player_id = db.insert_players([{"name": "Maru"},
+                                       {"name": "Zoë Ærø"}])[1]
+        self.assertEqual(db.search("zoe"), [("player", player_id)])
+        tournament_id = db.insert_tournament("GSL Code S")
+        self.assertEqual(db.search("code"), [("tournament", tournament_id)])
+        db.rename_team(1, "Team Secret")
+        self.assertEqual(db.search("teamliq"), [])
+        self.assertEqual(db.search("secr"), [("team", 1)])
+        db.rename_tournament(1, "ASL Season 10")
+        self.assertEqual(db.search("asl 10"), [("tournament", 1)])
+        db.rename_game(1, "StarCraft: Remastered")
+        check_search_indexes(db.db_name)
+        db.rebuild_search()
+        check_search_indexes(db.db_name)
+        self.assertEqual(db.search("secr"), [("team", 1)])
+
+    def test_graphql(self):
+        schema = g.Schema(query=ql.Query)
+        query = """{ search(text: "q", kinds: [PLAYER, TOURNAMENT]) {
+                       __typename ... on Player { name team games }
+                       ... on Team { id } ... on Tournament { id name } } }"""
+        result = schema.execute(query, context_value=ql.Context())
+        self.assertIsNone(result.errors)
+        self.assertCountEqual(result.data["search"], [
+            {"__typename": "Player", "name": "Queen", "team": "Moo",
+             "games": ["StarCraft: Brood War"]},
+            {"__typename": "Tournament", "id": 3, "name": "QuakeCon 2016"}])
+        result = schema.execute('{ search(text: "q", first: 1) { '
+                                '__typename } }')
+        self.assertEqual(len(result.data["search"]), 1)
+        document = documents.DocumentCache(schema).get(query)
+        self.assertLessEqual({"players", "teams", "tournaments"},
+                             ql.tables_read(document.ast))
+
+class TestReplica(ut.TestCase):
+    tables = ["games", "teams", "tournaments", "players", "player_games",
+              "matches", "match_teams", "match_read", "player_standings",
+              "team_standings", "data_versions"]
+
+    def setUp(self):
+        db.recreate_db()
+        db.load_example_data()
+        self.directory = tempfile.TemporaryDirectory()
+        self.replica = replica.Replica(directory=self.directory.name)
+
+    def tearDown(self):
+        replica.Replica.uninstall()
+        self.replica.close()
+        self.directory.cleanup()
+        db.change_log_size = 1000000
+
+    def differences(self):
+        def rows(path):
+            conn = sqlite3.connect(path)
+            try:
+                return {t: conn.execute(f"SELECT * FROM {t} ORDER BY 1, 2;")
+                        .fetchall() for t in self.tables}
+            finally:
+                conn.close()
+        primary, copy = rows(db.db_name), rows(self.replica.path)
+        return [t for t in self.tables if primary[t] != copy[t]]
+
+    def test_refresh(self):
+        self.assertEqual(self.differences(), [])
+        player_id = db.insert_player({"name": "Flash", "team_id": 1,
+                                      "game_ids": [1]})
+        match_id = db.insert_match({"date": int_time, "game_id": 1,
+                                    "finished": True, "team1_score": 2,
+                                    "teams": [[player_id], [1]]})
+        db.update_match({"id": 1, "teams": [[2], [player_id]],
+                         "finished": True, "team2_score": 5})
+        db.rename_team(1, "Team Secret")
+        published = []
+        db.add_listener(lambda table, ids: published.extend(ids))
+        try:
+            self.assertGreater(self.replica.refresh(), 0)
+        finally:
+            db._listeners.clear()
+        self.assertEqual(self.differences(), [])
+        # The matches that were inserted, updated or show the renamed team.
+        self.assertLessEqual({1, match_id}, set(published))
+        check_search_indexes(self.replica.path)
+        db.rebuild_match_read()
+        db.rebuild_search()
+        self.replica.refresh()
+        self.assertEqual(self.differences(), [])
+        check_search_indexes(self.replica.path)
+        self.assertEqual(self.replica.refresh(), 0)
+        self.assertEqual(self.replica.copies, 1)
+        self.replica.install()
+        self.assertEqual(db.get_matches([match_id])[match_id]["teams"][1][0]
+                         ["team"], "Team Secret")
+        self.assertEqual(db.search("secret"), [("team", 1)])
+        self.assertIn(("player", player_id), db.search("flash"))
+        self.assertEqual(db.check_match_read(), [])
+        with self.assertRaises(sqlite3.OperationalError):
+            db.insert_game("QuakeLive")
+        request_metrics = metrics.Metrics()
+        request_metrics.add_gauge("esportsapi_replica_lag_seconds", "Lag.",
+                                  self.replica.lag_seconds)
+        self.assertIn("# TYPE esportsapi_replica_lag_seconds gauge",
+                      request_metrics.export())
+
+    def test_copy(self):
+        # The entries since the last refresh have been dropped.
+        db.change_log_size = 3
+        for name in ["Overwatch", "Valorant"]:
+            db.insert_game(name)
+        self.replica.refresh()
+        self.assertEqual(self.replica.copies, 2)
+        self.assertEqual(self.differences(), [])
+        # The database has been replaced.
+        db.recreate_db()
+        db.insert_game("QuakeLive")
+        self.replica.refresh()
+        self.assertEqual(self.replica.copies, 3)
+        self.assertEqual(self.differences(), [])
+
+class TestSubscriptions(ut.TestCase):
+    def setUp(self):
+        db.recreate_db()
+        tournament_id = db.insert_tournament("ASL Season 9")
+        player_id = db.insert_player({"name": "Flash"})
+        db.insert_matches([{"date": int_time + i,
+                            "tournament_id": tournament_id,
+                            "teams": [[player_id], []]} for i in range(3)])
+        self.hub = subscriptions.Hub()
+        self.documents = documents.DocumentCache(
+            g.Schema(query=ql.Query, subscription=ql.Subscription))
+
+    def tearDown(self):
+        self.hub.close()
+
+    def subscribe(self, query):
+        return self.hub.subscribe(self.documents.get(query))
+
+    def test_hub(self):
+        query = """subscription { m: matchUpdated(ids: [1, 2]) {
+                       id team1Score teams { name } } }"""
+        first, second = self.subscribe(query), self.subscribe(query)
+        by_tournament = self.subscribe(
+            "subscription { matchUpdated(tournamentId: 1) { id } }")
+        with self.assertRaises(GraphQLError):
+            self.subscribe("{ matches { id } }")
+        for score in [1, 2, 3]:
+            db.update_match({"id": 1, "team1_score": score})
+        db.update_match({"id": 3, "team1_score": 1})
+        with self.assertRaises(sqlite3.IntegrityError):
+            with db.transaction():
+                db.update_match({"id": 2, "team1_score": 1})
+                db.insert_game(None)
+        self.hub.flush()
+        events = first.take()
+        # Subscribers of the same subscription share the serialized event.
+        self.assertIs(second.take()[0], events[0])
+        self.assertEqual(
+            events, [b'data: {"data":{"m":{"id":"1","team1Score":3,'
+                     b'"teams":[[{"name":"Flash"}],[]]}}}\n\n'])
+        self.assertEqual(len(by_tournament.take()), 2)
+        self.assertEqual(self.hub.stats(),
+                         {"groups": 2, "subscribers": 3, "published": 4,
+                          "events": 3})
+        first.close()
+        second.close()
+        self.assertEqual(self.hub.stats()["groups"], 1)
+
+    def test_event_stream(self):
+        app = asgi.AsgiApp(service.Service("app"))
+        query = urllib.parse.urlencode(
+            {"query": "subscription { matchUpdated(ids: [2]) { id } }"})
+        async def subscribe():
+            messages = []
+            disconnected = asyncio.Event()
+            async def receive():
+                await disconnected.wait()
+                return {"type": "http.disconnect"}
+            async def send(message):
+                messages.append(message)
+                if b"data:" in message.get("body", b""):
+                    disconnected.set()
+            request = asyncio.create_task(app(
+                {"type": "http", "method": "GET", "path": "/subscribe",
+                 "query_string": query.encode()}, receive, send))
+            await asyncio.sleep(0.05)
+            db.update_match({"id": 2, "finished": True})
+            await asyncio.wait_for(request, 5)
+            return messages
+        messages = asyncio.run(subscribe())
+        self.assertEqual(dict(messages[0]["headers"])[b"content-type"],
+                         b"text/event-stream")
+        self.assertEqual(messages[-1]["body"],
+                         b'data: {"data":{"matchUpdated":{"id":"2"}}}\n\n')
+        self.assertEqual(app.service.hub.stats()["subscribers"], 0)
+        app.service.hub.close()
+
 if __name__ == "__main__":
     ut.main()
@@ -0,0 +1,127 @@
+import datetime
+import dateutil.parser as dup
+import functools
+import os
+import zoneinfo
+
+# Dates are stored as Unix times and shown as naive datetimes in the
+# configured timezone, which is also the timezone of naive input dates and
+# of day boundaries.
+
+def _default_zone():
+    name = os.environ.get("TZ", "").lstrip(":")
+    if name:
+        try:
+            return zoneinfo.ZoneInfo(name)
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+            pass
+    try:
+        with open("/etc/localtime", "rb") as f:
+            return zoneinfo.ZoneInfo.from_file(f)
+    except (OSError, ValueError):
+        return datetime.timezone.utc
+
+_zone = _default_zone()
+
+def set_timezone(name=None):
+    """Sets the timezone by its IANA name, like "Europe/Stockholm". None
+    means the local timezone of the process."""
+    global _zone
+    _zone = zoneinfo.ZoneInfo(name) if name else _default_zone()
+
+def timezone():
+    return _zone
+
+_epoch = datetime.datetime(1970, 1, 1)
+_day = 86400
+
+@functools.lru_cache(maxsize=65536)
+def _day_offset(zone, day):
+    """Returns the UTC offset in seconds of `zone` during the UTC day `day`
+    (in days since the epoch), or None if it changes during the day."""
+    first, last = (datetime.datetime.fromtimestamp(seconds, zone).utcoffset()
+                   for seconds in [day * _day, (day + 1) * _day - 1])
+    return first.total_seconds() if first == last else None
+
+def to_datetime(seconds):
+    if seconds is None:
+        return None
+    offset = _day_offset(_zone, seconds // _day)
+    if offset is None:
+        return datetime.datetime.fromtimestamp(seconds, _zone) \
+                               .replace(tzinfo=None)
+    return _epoch + datetime.timedelta(seconds=seconds + offset)
+
+def to_datetimes(column):
+    """Like `to_datetime` for every value of `column`, in one pass."""
+    zone = _zone
+    offsets = {}
+    result = []
+    for seconds in column:
+        if seconds is None:
+            result.append(None)
+            continue
+        day = seconds // _day
+        offset = offsets.get(day, False)
+        if offset is False:
+            offset = offsets[day] = _day_offset(zone, day)
+        if offset is None:
+            result.append(datetime.datetime.fromtimestamp(seconds, zone)
+                          .replace(tzinfo=None))
+        else:
+            result.append(_epoch + datetime.timedelta(seconds=seconds + offset))
+    return result
+
+def parse(string):
+    """Parses an ISO 8601 date or time, and anything else that dateutil
+    understands."""
+    try:
+        return datetime.datetime.fromisoformat(string)
+    except ValueError:
+        return dup.parse(string)
+
+def to_int(date):
+    """Takes a date in string, datetime, date or int format, and returns it
+    as an int."""
+    if date is None or isinstance(date, int):
+        return date
+    if isinstance(date, float):
+        return int(date)
+    if isinstance(date, str):
+        date = parse(date)
+    if not isinstance(date, datetime.datetime):
+        return day_bounds(date)[0]
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=_zone)
+    return int(date.timestamp())
+
+def to_string(date):
+    if date is not None:
+        return date if isinstance(date, str) \
+            else to_datetime(to_int(date)).strftime("%Y-%m-%d %H:%M:%S")
+
+def to_date_string(date):
+    if date is not None:
+        return to_string(date).split()[0]
+
+@functools.lru_cache(maxsize=4096)
+def _midnights(zone, date):
+    next_date = date + datetime.timedelta(days=1)
+    return tuple(int(datetime.datetime(d.year, d.month, d.day, tzinfo=zone)
+                     .timestamp())
+                 for d in [date, next_date])
+
+def day_bounds(date):
+    """Returns the times of the start of the day of `date`, and of the start
+    of the next day. Days are not always 24 hours long, because of daylight
+    saving time."""
+    if not isinstance(date, datetime.date) or \
+       isinstance(date, datetime.datetime):
+        date = to_datetime(to_int(date)).date()
+    return _midnights(_zone, date)
+
+def start_of_day(date):
+    return day_bounds(date)[0]
+
+def next_day(date):
+    return day_bounds(date)[1]
@@ -23,6 +23,10 @@ def group_by(coll, f):
         d[k] = lst
     return d
 
+def partition_all(n, coll):
+    coll = list(coll)
+    return [coll[i:i+n] for i in range(0, len(coll), n)]
+
 def first(coll):
     return coll[0]
 
@@ -32,13 +36,15 @@ def last(coll):
 def getter(n):
     return lambda x: x[n]
 
+# `update` and `assoc` copy only `d` itself; the values are shared.
+
 def update(d, k, f, *args):
-    nd = copy.deepcopy(d)
+    nd = copy.copy(d)
     nd[k] = f(d.get(k, None), *args)
     return nd
 
 def assoc(d, k, v):
-    nd = copy.deepcopy(d)
+    nd = copy.copy(d)
     nd[k] = v
     return nd
 
@@ -0,0 +1,11 @@
+-- Versions of the tables, bumped by every write, so that cached reads can
+-- tell if they are stale. They start at random values, so that a recreated
+-- database does not repeat the versions of the old one.
+CREATE TABLE IF NOT EXISTS data_versions (
+name TEXT PRIMARY KEY,
+version INTEGER NOT NULL) WITHOUT ROWID;
+
+INSERT OR IGNORE INTO data_versions
+SELECT column1, abs(random() % 1000000000) FROM (VALUES
+('games'), ('teams'), ('tournaments'), ('players'), ('player_games'),
+('matches'), ('match_teams'));
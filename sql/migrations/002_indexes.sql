@@ -0,0 +1,11 @@
+-- Indexes for the lookups that are not by id or date: players by name and
+-- team, the games of players and the players of games, and matches by game
+-- and tournament.
+CREATE INDEX IF NOT EXISTS players_name_index ON players (name);
+CREATE INDEX IF NOT EXISTS players_team_index ON players (team_id);
+CREATE INDEX IF NOT EXISTS playergames_player_index
+ON player_games (player_id);
+CREATE INDEX IF NOT EXISTS playergames_game_index ON player_games (game_id);
+CREATE INDEX IF NOT EXISTS matches_game_index ON matches (game_id);
+CREATE INDEX IF NOT EXISTS matches_tournament_index
+ON matches (tournament_id);
@@ -0,0 +1,41 @@
+-- Every match with the names of its game and tournament, and its teams as
+-- JSON lists of players, so that reads need no joins. It is written
+-- by the same transactions that write the tables above, and can be rebuilt
+-- from them with `python3 -m esportsapi.manage rebuild-match-read`, which
+-- this migration also does.
+CREATE TABLE IF NOT EXISTS match_read (
+id INTEGER PRIMARY KEY,
+date INTEGER NOT NULL,
+game TEXT,
+finished INTEGER,
+tournament TEXT,
+team1_score INTEGER,
+team2_score INTEGER,
+game_id INTEGER,
+tournament_id INTEGER,
+teams TEXT NOT NULL);
+
+CREATE INDEX IF NOT EXISTS matchread_date_index ON match_read (date, id);
+CREATE INDEX IF NOT EXISTS matchread_tournament_index
+ON match_read (tournament_id, date, id);
+
+-- The number of finished matches, wins, losses and the sum of score
+-- differences of players and teams, per tournament and, with tournament_id
+-- 0, over all matches. Writes of match_read adjust them.
+CREATE TABLE IF NOT EXISTS player_standings (
+tournament_id INTEGER NOT NULL,
+player_id INTEGER NOT NULL,
+matches_played INTEGER NOT NULL,
+wins INTEGER NOT NULL,
+losses INTEGER NOT NULL,
+score_difference INTEGER NOT NULL,
+PRIMARY KEY (tournament_id, player_id)) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS team_standings (
+tournament_id INTEGER NOT NULL,
+team_id INTEGER NOT NULL,
+matches_played INTEGER NOT NULL,
+wins INTEGER NOT NULL,
+losses INTEGER NOT NULL,
+score_difference INTEGER NOT NULL,
+PRIMARY KEY (tournament_id, team_id)) WITHOUT ROWID;
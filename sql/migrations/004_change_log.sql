@@ -0,0 +1,11 @@
+-- The rows that writes change, for in-memory replicas to copy again (see
+-- esportsapi/replica.py). Each entry names a table and the rows whose
+-- key_column has the value key_value. A key of several columns has them
+-- separated by commas and its value as a JSON list, and an entry without a
+-- key_column stands for the whole table. Writes keep only the latest
+-- entries.
+CREATE TABLE IF NOT EXISTS change_log (
+id INTEGER PRIMARY KEY AUTOINCREMENT,
+table_name TEXT NOT NULL,
+key_column TEXT,
+key_value);
@@ -0,0 +1,22 @@
+-- Full-text indexes of the names of players, teams and tournaments, for
+-- `search`. They keep no copy of the names, which they read from the
+-- tables when they are rebuilt, and are written by the same transactions
+-- that write the names. Case and diacritics are ignored, and prefixes of up
+-- to three characters have entries of their own, so that the names
+-- starting with a short prefix are looked up rather than scanned. They can
+-- be rebuilt with `python3 -m esportsapi.manage rebuild-search`.
+CREATE VIRTUAL TABLE IF NOT EXISTS player_search USING fts5(
+name, content='players', content_rowid='id',
+tokenize='unicode61 remove_diacritics 2', prefix='1 2 3');
+
+CREATE VIRTUAL TABLE IF NOT EXISTS team_search USING fts5(
+name, content='teams', content_rowid='id',
+tokenize='unicode61 remove_diacritics 2', prefix='1 2 3');
+
+CREATE VIRTUAL TABLE IF NOT EXISTS tournament_search USING fts5(
+name, content='tournaments', content_rowid='id',
+tokenize='unicode61 remove_diacritics 2', prefix='1 2 3');
+
+INSERT INTO player_search(player_search) VALUES ('rebuild');
+INSERT INTO team_search(team_search) VALUES ('rebuild');
+INSERT INTO tournament_search(tournament_search) VALUES ('rebuild');
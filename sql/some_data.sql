@@ -54,3 +54,5 @@ INSERT INTO match_teams VALUES
 (null, 2, 3, 3),
 (null, 1, 4, 6),
 (null, 2, 4, 7);
+
+UPDATE data_versions SET version = version + 1;